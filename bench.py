@@ -0,0 +1,367 @@
+"""Нагрузочный бенчмарк бота.
+
+Поднимает настоящий bot:app (uvicorn, startup-хуки, пул БД, очереди) и подменяет
+внешний мир локальными заглушками:
+  * Bot API Telegram — принимает sendMessage/editMessageText и отмечает время ответа;
+  * JSON-RPC MegaNode — отдаёт блоки и receipt с переводом USDT на кошелёк бота
+    с настраиваемой задержкой;
+  * Postgres — локальная база из BENCH_DATABASE_URL. База очищается через /reset_db!
+
+Генератор шлёт в вебхук смесь апдейтов (кнопки, TXID, /start с реф-кодом, розыгрыши)
+с заданной частотой и печатает пропускную способность и p50/p95/p99:
+  * по каждому обработчику aiogram — время самого обработчика;
+  * сквозное время «апдейт → ответ в Bot API» по видам трафика, в том числе
+    «TXID → подтверждение платежа».
+
+Пример:
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/bench python bench.py --rate 200 --duration 30
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+from collections import defaultdict
+from aiohttp import web, ClientSession
+
+# Смесь трафика по умолчанию: вид → вес
+DEFAULT_MIX = {
+    "bank": 30,
+    "members": 15,
+    "stats": 15,
+    "history": 10,
+    "weekly": 10,
+    "start_ref": 10,
+    "txid": 10,
+}
+
+TEXTS = {
+    "bank": "💰 Банк",
+    "members": "👥 Участники",
+    "stats": "📊 Статистика",
+    "history": "📜 История",
+    "weekly": "📆 Неделя",
+}
+
+USDT_CONTRACT = "0x55d398326f99059ff775485246999027b3197955"
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Recorder:
+    """Сквозные замеры: ждём первый ответ (или ответ с нужным префиксом) в чат"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.waiting = {}
+
+    def expect(self, chat_id, kind, prefixes=None):
+        self.waiting.setdefault(str(chat_id), []).append((kind, time.perf_counter(), prefixes))
+
+    def observe(self, chat_id, text):
+        waiting = self.waiting.get(str(chat_id))
+        if not waiting:
+            return
+        now = time.perf_counter()
+        for item in list(waiting):
+            kind, started, prefixes = item
+            if prefixes is None or text.startswith(prefixes):
+                self.samples[kind].append(now - started)
+                waiting.remove(item)
+        if not waiting:
+            del self.waiting[str(chat_id)]
+
+
+class FakeWorld:
+    """Заглушки Bot API и JSON-RPC на одном aiohttp-сервере"""
+
+    def __init__(self, recorder, wallet, rpc_latency, block_time):
+        self.recorder = recorder
+        self.wallet = wallet
+        self.rpc_latency = rpc_latency
+        self.block_time = block_time
+        self.block = 40_000_000
+        self.message_ids = itertools.count(1)
+        self.bot_requests = 0
+        self.rpc_requests = 0
+
+    async def bot_api(self, request):
+        method = request.match_info["method"]
+        data = await request.json() if request.content_type == "application/json" else dict(await request.post())
+        self.bot_requests += 1
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench", "username": "BenchBot"}})
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = data.get("chat_id")
+            text = data.get("text", "")
+            self.recorder.observe(chat_id, text)
+            chat = int(chat_id) if str(chat_id).lstrip("-").isdigit() else -1
+            return web.json_response({"ok": True, "result": {
+                "message_id": int(data.get("message_id") or next(self.message_ids)), "date": int(time.time()),
+                "chat": {"id": chat, "type": "private"}, "text": text,
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+    def _rpc_result(self, method, params):
+        if method == "eth_blockNumber":
+            return hex(self.block)
+        if method == "eth_getBlockByNumber":
+            number = self.block if params[0] == "latest" else int(params[0], 16)
+            if number > self.block:
+                return None
+            return {"number": hex(number), "hash": "0x%064x" % (number * 2654435761)}
+        if method == "eth_getTransactionByHash":
+            return {"hash": params[0], "blockNumber": hex(self.block - 3)}
+        if method == "eth_getTransactionReceipt":
+            return {"status": "0x1", "blockNumber": hex(self.block - 3), "logs": [{
+                "address": USDT_CONTRACT,
+                "topics": [TRANSFER_TOPIC, "0x" + "0" * 24 + "1" * 40, "0x" + "0" * 24 + self.wallet[2:].lower()],
+                "data": hex(5 * 10 ** 18),
+                "transactionHash": params[0],
+                "blockNumber": hex(self.block - 3),
+                "logIndex": "0x0",
+            }]}
+        if method == "eth_getLogs":
+            return []
+        return None
+
+    async def rpc(self, request):
+        payload = await request.json()
+        self.rpc_requests += 1
+        await asyncio.sleep(self.rpc_latency * random.uniform(0.5, 1.5))
+        if isinstance(payload, list):
+            return web.json_response([
+                {"jsonrpc": "2.0", "id": call["id"], "result": self._rpc_result(call["method"], call.get("params", []))}
+                for call in payload
+            ])
+        return web.json_response({"jsonrpc": "2.0", "id": payload["id"],
+                                  "result": self._rpc_result(payload["method"], payload.get("params", []))})
+
+    async def tick_blocks(self):
+        while True:
+            await asyncio.sleep(self.block_time)
+            self.block += 1
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_post("/rpc", self.rpc)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+class TrafficGenerator:
+    def __init__(self, session, webhook_url, recorder, admin_id, mix):
+        self.session = session
+        self.webhook_url = webhook_url
+        self.recorder = recorder
+        self.admin_id = admin_id
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.update_ids = itertools.count(1)
+        self.user_ids = itertools.count(10_000_000)
+        self.sent = defaultdict(int)
+        self.rejected = 0
+
+    def _update(self, user_id, text):
+        update_id = next(self.update_ids)
+        message = {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench", "username": f"bench{user_id}"},
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    async def _post(self, update):
+        async with self.session.post(self.webhook_url, json=update) as response:
+            if response.status != 200:
+                self.rejected += 1
+
+    async def send(self, kind):
+        user_id = next(self.user_ids)
+        if kind == "txid":
+            text = "0x%064x" % random.getrandbits(256)
+            self.recorder.expect(user_id, "txid_ack", ("🔄",))
+            self.recorder.expect(user_id, "txid_verified", ("✅", "❌", "⚠️"))
+        elif kind == "start_ref":
+            text = f"/start ref_bench_{random.randint(1, 20)}_camp_{random.randint(1000, 9999)}"
+            self.recorder.expect(user_id, kind)
+        else:
+            text = TEXTS[kind]
+            self.recorder.expect(user_id, kind)
+        self.sent[kind] += 1
+        await self._post(self._update(user_id, text))
+
+    async def draw(self):
+        # Вебхук отвечает сразу, поэтому /start_draw уходит по расписанию, даже если прошлый
+        # розыгрыш ещё идёт: отказ «уже запущен» — тоже ответ, и его время тоже меряется
+        self.recorder.expect(self.admin_id, "draw", ("✅ Розыгрыш", "❌", "⚠️"))
+        self.sent["draw"] += 1
+        await self._post(self._update(self.admin_id, "/start_draw"))
+
+    async def run(self, rate, duration, draw_every):
+        tasks = set()
+        started = time.perf_counter()
+        next_draw = started + draw_every if draw_every else None
+        interval = 1 / rate
+        n = 0
+        while True:
+            now = time.perf_counter()
+            if now - started >= duration:
+                break
+            if next_draw and now >= next_draw:
+                tasks.add(asyncio.create_task(self.draw()))
+                next_draw += draw_every
+            kind = random.choices(self.kinds, self.weights)[0]
+            task = asyncio.create_task(self.send(kind))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            n += 1
+            # Открытая модель нагрузки: темп не зависит от скорости ответов бота
+            await asyncio.sleep(max(0, started + n * interval - time.perf_counter()))
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return time.perf_counter() - started
+
+
+def instrument_handlers(dp, samples):
+    """Оборачивает обработчики aiogram замером времени"""
+    def timed(name, handler):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                samples[name].append(time.perf_counter() - started)
+        return wrapper
+
+    for handlers in (dp.message_handlers, dp.callback_query_handlers):
+        for obj in handlers.handlers:
+            obj.handler = timed(obj.handler.__name__, obj.handler)
+
+
+def report(title, samples, elapsed):
+    lines = [title, f"{'':<22}{'count':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+    for name in sorted(samples):
+        values = samples[name]
+        lines.append(
+            f"{name:<22}{len(values):>8}{len(values) / elapsed:>9.1f}"
+            f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        kind, weight = part.split("=")
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"неизвестный вид трафика: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+async def main(args):
+    database_url = os.getenv("BENCH_DATABASE_URL")
+    if not database_url:
+        sys.exit("Укажите BENCH_DATABASE_URL — отдельную базу, она будет очищена")
+
+    # Окружение бота задаётся до импорта bot.py
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.pop("RENDER_EXTERNAL_URL", None)
+    os.environ.setdefault("TG_GLOBAL_RATE", str(args.tg_rate))
+    os.environ.setdefault("TG_CHAT_RATE", str(args.tg_rate))
+    os.environ.setdefault("BSC_HEAD_POLL", str(args.block_time))
+    os.environ["BSC_RPC_URLS"] = f"http://127.0.0.1:{args.fake_port}/rpc"
+    # Нагрузка идёт от генератора, а не от флудящих пользователей — общий лимит TXID не мешает замеру
+    os.environ.setdefault("FLOOD_TXID_GLOBAL_RATE", "100000")
+    os.environ.setdefault("FLOOD_TXID_GLOBAL_BURST", "100000")
+
+    import uvicorn
+    from aiogram.bot.api import TelegramAPIServer
+    import bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    recorder = Recorder()
+    world = FakeWorld(recorder, bot.WALLET_ADDRESS, args.rpc_latency / 1000, args.block_time)
+    fake_runner = await world.start(args.fake_port)
+    ticker = asyncio.create_task(world.tick_blocks())
+
+    base = f"http://127.0.0.1:{args.fake_port}"
+    bot.bot.server = TelegramAPIServer.from_base(base)
+
+    handler_samples = defaultdict(list)
+    instrument_handlers(bot.dp, handler_samples)
+
+    server = uvicorn.Server(uvicorn.Config(bot.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    webhook_url = f"http://127.0.0.1:{args.port}/webhook/{bot.API_TOKEN}"
+    async with ClientSession() as session:
+        generator = TrafficGenerator(session, webhook_url, recorder, bot.ADMIN_ID, args.mix)
+        await generator._post(generator._update(bot.ADMIN_ID, "/reset_db"))
+        await asyncio.sleep(1)
+        handler_samples.clear()
+        recorder.samples.clear()
+
+        print(f"▶️ {args.duration} с, {args.rate} апдейтов/с, смесь: {args.mix}")
+        elapsed = await generator.run(args.rate, args.duration, args.draw_every)
+
+        # Даём догнать очередь и дождаться подтверждений TXID
+        deadline = time.monotonic() + args.drain
+        while recorder.waiting and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+
+        async with session.get(f"http://127.0.0.1:{args.port}/health") as response:
+            health = await response.json()
+
+    server.should_exit = True
+    await server_task
+    ticker.cancel()
+    await fake_runner.cleanup()
+
+    completed = sum(len(v) for v in handler_samples.values())
+    output = "\n\n".join([
+        f"Отправлено апдейтов: {sum(generator.sent.values())} ({dict(generator.sent)}), отклонено вебхуком: {generator.rejected}",
+        f"Обработано: {completed} за {elapsed:.1f} с — {completed / elapsed:.1f} апдейтов/с",
+        f"Запросов к Bot API: {world.bot_requests}, к RPC: {world.rpc_requests}, без ответа: {sum(len(v) for v in recorder.waiting.values())}",
+        report("Обработчики aiogram", handler_samples, elapsed),
+        report("Сквозное время (апдейт → ответ в Bot API)", recorder.samples, elapsed),
+        f"Очередь апдейтов: {health.get('updates')}",
+    ])
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк CryptoFortunaBot на локальных заглушках")
+    parser.add_argument("--rate", type=float, default=100, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=30, help="длительность, с")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="смесь, например bank=5,txid=1")
+    parser.add_argument("--draw-every", type=float, default=0, help="запускать /start_draw раз в N секунд (0 — не запускать)")
+    parser.add_argument("--rpc-latency", type=float, default=50, help="средняя задержка RPC, мс")
+    parser.add_argument("--block-time", type=float, default=0.2, help="интервал блоков заглушки, с")
+    parser.add_argument("--tg-rate", type=float, default=100000, help="лимит Telegram в outbox (по умолчанию не ограничивает)")
+    parser.add_argument("--drain", type=float, default=30, help="сколько ждать хвост после окончания нагрузки, с")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fake-port", type=int, default=8766)
+    parser.add_argument("--out", default=None, help="файл для отчёта, например bench_output.txt")
+    asyncio.run(main(parser.parse_args()))
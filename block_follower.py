@@ -0,0 +1,176 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict
+import database
+
+
+class BlockFollower:
+    """Фоновое слежение за головой BSC с LRU-кэшем «номер блока → хэш».
+
+    Один запрос eth_getBlockByNumber("latest") за цикл опроса даёт и номер,
+    и хэш новой головы; пропущенные между опросами блоки догружаются одним
+    batch-запросом. Код розыгрыша ждёт нужный блок через wait_for_block()
+    и просыпается сразу, как только блок появился.
+
+    Узел опрашивает только ведущий процесс (leader = True, см. leader.py): новую
+    голову он записывает в chain_heads. Остальные процессы читают голову оттуда,
+    а у узла спрашивают лишь хэши блоков, которых кто-то ждёт.
+    """
+
+    def __init__(self, rpc, poll_interval=1.5, cache_size=2048, batch_size=100, name="bsc"):
+        self._rpc = rpc
+        self.name = name
+        self.leader = False
+        self.poll_interval = poll_interval
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.head = None
+        # Время (monotonic) последнего успешного опроса головы
+        self.checked_at = None
+        self._hashes = OrderedDict()
+        self._waiters = defaultdict(list)
+        self._head_ready = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logging.info("✅ Слежение за блоками BSC запущено")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def get_hash(self, block_number):
+        block_hash = self._hashes.get(block_number)
+        if block_hash is not None:
+            self._hashes.move_to_end(block_number)
+        return block_hash
+
+    def fresh_head(self, max_age):
+        """Номер головы, если узел подтверждал его не раньше max_age секунд назад, иначе None.
+
+        При ошибках опроса голова остаётся прежней, пока идут повторы с паузой, —
+        там, где важно, что блок ещё не вышел, старую голову брать нельзя.
+        """
+        if self.checked_at is None or time.monotonic() - self.checked_at > max_age:
+            return None
+        return self.head
+
+    def confirmations(self, block_number):
+        """Сколько блоков прошло с block_number включительно (0, если голова неизвестна)"""
+        if self.head is None or block_number > self.head:
+            return 0
+        return self.head - block_number + 1
+
+    async def wait_for_head(self, timeout=None):
+        """Номер текущей головы; при холодном старте ждёт первый опрос"""
+        await asyncio.wait_for(self._head_ready.wait(), timeout)
+        return self.head
+
+    async def wait_for_block(self, block_number, timeout=None):
+        """Хэш блока block_number; если блок ещё не вышел — ждёт его появления"""
+        block_hash = self.get_hash(block_number)
+        if block_hash is not None:
+            return block_hash
+
+        if self.head is not None and block_number <= self.head:
+            # Блок старше кэша — спрашиваем узел напрямую
+            block = await self._rpc.call("eth_getBlockByNumber", [hex(block_number), False])
+            if block:
+                self._store(block_number, block["hash"])
+                return block["hash"]
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[block_number].append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self._waiters.get(block_number)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiters[block_number]
+
+    def _store(self, block_number, block_hash):
+        self._hashes[block_number] = block_hash
+        self._hashes.move_to_end(block_number)
+        while len(self._hashes) > self.cache_size:
+            self._hashes.popitem(last=False)
+
+        for future in self._waiters.pop(block_number, []):
+            if not future.done():
+                future.set_result(block_hash)
+
+    async def _poll(self):
+        if self.leader:
+            await self._poll_node()
+        else:
+            await self._poll_shared()
+
+    async def _poll_shared(self):
+        """Голова, опубликованная ведущим процессом; хэши — только для ждущих блоков"""
+        row = await database.fetchrow(
+            "SELECT number, hash, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - updated_at) AS age FROM chain_heads WHERE name = $1",
+            self.name
+        )
+        if row is None:
+            return
+        if self.head is None or row['number'] > self.head:
+            self._store(row['number'], row['hash'])
+            self.head = row['number']
+            self._head_ready.set()
+        self.checked_at = time.monotonic() - max(0.0, float(row['age']))
+
+        due = [n for n in self._waiters if n <= self.head]
+        for chunk_start in range(0, len(due), self.batch_size):
+            chunk = due[chunk_start:chunk_start + self.batch_size]
+            blocks = await self._rpc.batch([("eth_getBlockByNumber", [hex(n), False]) for n in chunk])
+            for n, block in zip(chunk, blocks):
+                if block:
+                    self._store(n, block["hash"])
+
+    async def _poll_node(self):
+        latest = await self._rpc.call("eth_getBlockByNumber", ["latest", False])
+        if not latest:
+            return
+        number = int(latest["number"], 16)
+        if self.head is not None and number <= self.head:
+            self.checked_at = time.monotonic()
+            return
+
+        if self.head is not None:
+            start = max(self.head + 1, number - self.cache_size + 1)
+            for chunk_start in range(start, number, self.batch_size):
+                missing = range(chunk_start, min(chunk_start + self.batch_size, number))
+                blocks = await self._rpc.batch([
+                    ("eth_getBlockByNumber", [hex(n), False]) for n in missing
+                ])
+                for n, block in zip(missing, blocks):
+                    if block:
+                        self._store(n, block["hash"])
+
+        self._store(number, latest["hash"])
+        self.head = number
+        self.checked_at = time.monotonic()
+        self._head_ready.set()
+        await database.execute("""
+            INSERT INTO chain_heads (name, number, hash) VALUES ($1, $2, $3)
+            ON CONFLICT (name) DO UPDATE SET number = EXCLUDED.number, hash = EXCLUDED.hash, updated_at = CURRENT_TIMESTAMP
+            WHERE chain_heads.number < EXCLUDED.number
+        """, self.name, number, latest["hash"])
+
+    async def _run(self):
+        delay = self.poll_interval
+        while True:
+            try:
+                await self._poll()
+                delay = self.poll_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ Ошибка слежения за блоками BSC: {type(e).__name__}: {e}")
+                delay = min(delay * 2, 30)
+            await asyncio.sleep(delay)
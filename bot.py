@@ -1,18 +1,40 @@
 import os
 import logging
 import random
-import requests
 import time
 import asyncio
 import hashlib
+import re
+import datetime
 from fastapi import FastAPI, Request
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from fastapi.responses import JSONResponse, Response
+from aiogram import Dispatcher, types
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.exceptions import TelegramAPIError
 import uvicorn
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
-draw_in_progress = False
+import asyncpg
+import database
+import migrations
+import stats
+import referrals
+import rounds
+import draws
+import metrics
+import tracing
+from live_state import LiveRound
+from response_cache import ResponseCache
+from outbox import Outbox, QueuedBot
+from broadcast import Broadcaster
+from update_queue import UpdateQueue
+from verify_queue import VerificationQueue, VerificationJob, RetryLater, ShutdownInterrupted
+from bsc_rpc import BscRpcClient, JsonRpcError
+from rpc_pool import RpcPool, Provider
+from block_follower import BlockFollower
+from transfer_indexer import TransferIndexer
+from leader import LeaderLock
+from payments import BscVerifier, TronVerifier, detect_verifiers, resolve_verifier
+from flood_control import FloodControl
+from draws import DrawScheduler
 
 # === НАСТРОЙКИ ===
 API_TOKEN = os.getenv("BOT_TOKEN")
@@ -20,88 +42,42 @@ WALLET_ADDRESS = "0xFd434c30aCeF2815fE895a2144b11122e31c0B93"
 ADMIN_ID = 8333494757
 ENTRY_FEE = 5
 CHANNEL_ID = "@realcryptofortuna"
+BSC_MIN_CONFIRMATIONS = int(os.getenv("BSC_MIN_CONFIRMATIONS", 1))
+# Без адреса кошелька приём оплаты в TRON выключен
+TRON_WALLET_ADDRESS = os.getenv("TRON_WALLET_ADDRESS")
+TRON_API_URL = os.getenv("TRON_API_URL", "https://api.trongrid.io")
 
 # Логирование
 logging.basicConfig(level=logging.INFO)
 
 # === ИНИЦИАЛИЗАЦИЯ БОТА ===
-bot = Bot(token=API_TOKEN)
+# Исходящие сообщения идут через очередь с лимитами Telegram, см. outbox.py
+outbox = Outbox(
+    global_rate=float(os.getenv("TG_GLOBAL_RATE", 30)),
+    chat_rate=float(os.getenv("TG_CHAT_RATE", 1)),
+    group_rate=float(os.getenv("TG_GROUP_RATE_PER_MIN", 20)) / 60,
+    channel_id=CHANNEL_ID
+)
+bot = QueuedBot(token=API_TOKEN, outbox=outbox)
 dp = Dispatcher(bot)
 
 # === ПОДКЛЮЧЕНИЕ К БАЗЕ ДАННЫХ (SUPABASE) ===
+# Пул соединений открывается в startup-хуке, см. database.py
 DATABASE_URL = os.getenv("DATABASE_URL")
-conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-conn.autocommit = True
-cursor = conn.cursor()
-
-# Таблица участников (с номерами билетов)
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS participants (
-        id SERIAL PRIMARY KEY,
-        ticket_number INTEGER UNIQUE,
-        username TEXT UNIQUE,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-""")
-
-# Если таблица уже существовала без ticket_number, добавляем колонку
-try:
-    cursor.execute("ALTER TABLE participants ADD COLUMN ticket_number INTEGER UNIQUE")
-    conn.commit()
-    logging.info("✅ Колонка ticket_number добавлена в существующую таблицу")
-except psycopg2.errors.DuplicateColumn:
-    # Колонка уже есть — всё ок
-    pass
-except Exception as e:
-    logging.error(f"Ошибка при добавлении колонки: {e}")
-
-# Таблица транзакций
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS transactions (
-        txid TEXT PRIMARY KEY,
-        user_id BIGINT,
-        username TEXT,
-        amount REAL,
-        status TEXT DEFAULT 'confirmed',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-""")
-
-# Таблица для хранения истории розыгрышей
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS draw_history (
-        id SERIAL PRIMARY KEY,
-        round_number INTEGER,
-        draw_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        participants_count INTEGER,
-        total_bank REAL,
-        winner_username TEXT,
-        winner_prize REAL,
-        commission REAL,
-        target_block INTEGER,
-        block_hash TEXT
-    )
-""")
-
-# Добавляем все недостающие колонки по очереди
-try:
-    cursor.execute("ALTER TABLE draw_history ADD COLUMN winner_ticket INTEGER")
-    conn.commit()
-    logging.info("✅ Колонка winner_ticket добавлена")
-except psycopg2.errors.DuplicateColumn:
-    pass
-except Exception as e:
-    logging.error(f"Ошибка при добавлении winner_ticket: {e}")
-
-# Также проверим, есть ли другие новые колонки
-try:
-    cursor.execute("ALTER TABLE draw_history ADD COLUMN block_hash TEXT")
-    conn.commit()
-    logging.info("✅ Колонка block_hash добавлена")
-except psycopg2.errors.DuplicateColumn:
-    pass
-except Exception as e:
-    logging.error(f"Ошибка при добавлении block_hash: {e}")
+
+# Состояние открытого раунда в памяти: счётчик, участники, фильтр использованных TXID
+live_round = LiveRound(
+    txid_capacity=int(os.getenv("TXID_FILTER_CAPACITY", 1_000_000)),
+    refresh_ttl=float(os.getenv("LIVE_ROUND_REFRESH", 5))
+)
+
+# Готовые тексты /stats, /history, /weekly, /monthly, /announce; сбрасываются после розыгрыша и записи участника
+responses = ResponseCache(ttl=int(os.getenv("RESPONSE_CACHE_TTL", 60)))
+
+# === РАЗМЕТКА ===
+def escape_md(text):
+    """Экранирует символы разметки Markdown (legacy) в username и других данных пользователя"""
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
 
 # === КЛАВИАТУРА ===
 keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
@@ -116,152 +92,106 @@ keyboard.add(
     KeyboardButton("📆 Неделя")
 )
 
-# === ФУНКЦИИ ПРОВЕРКИ ПЛАТЕЖЕЙ BSC ===
-def check_bsc_payment(txid, expected_amount=5, expected_address=None):
-    """Проверяет транзакцию USDT BEP-20 через BSCTrace API (MegaNode)"""
-    if expected_address is None:
-        expected_address = WALLET_ADDRESS
-    
-    for attempt in range(1, 4):
-        try:
-            time.sleep(10 * attempt)
-            
-            api_key = os.getenv("MEGANODE_API_KEY")
-            url = f"https://bsc-mainnet.nodereal.io/v1/{api_key}"
-            
-            tx_payload = {
-                "jsonrpc": "2.0",
-                "method": "eth_getTransactionByHash",
-                "params": [txid],
-                "id": 1
-            }
-            tx_response = requests.post(url, json=tx_payload)
-            
-            if tx_response.status_code != 200:
-                if attempt < 3:
-                    continue
-                return False, "Ошибка при обращении к BSCTrace"
-            
-            tx_data = tx_response.json()
-            if 'result' not in tx_data or not tx_data['result']:
-                if attempt < 3:
-                    continue
-                return False, "Транзакция не найдена"
-            
-            receipt_payload = {
-                "jsonrpc": "2.0",
-                "method": "eth_getTransactionReceipt",
-                "params": [txid],
-                "id": 2
-            }
-            receipt_response = requests.post(url, json=receipt_payload)
-            
-            if receipt_response.status_code != 200:
-                return False, "Не удалось получить подтверждение транзакции"
-            
-            receipt_data = receipt_response.json()
-            if 'result' not in receipt_data or not receipt_data['result']:
-                return False, "Транзакция не подтверждена"
-            
-            receipt = receipt_data['result']
-            
-            usdt_contract = "0x55d398326f99059ff775485246999027b3197955"
-            found_transfer = False
-            
-            if 'logs' in receipt:
-                for log in receipt['logs']:
-                    if log['address'].lower() == usdt_contract.lower():
-                        if len(log['topics']) >= 3 and log['topics'][0] == "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef":
-                            to_address_hex = log['topics'][2][2:]
-                            if len(to_address_hex) > 40:
-                                to_address_hex = to_address_hex[-40:]
-                            to_address = '0x' + to_address_hex
-                            
-                            print(f"🔍 Найден Transfer: Получатель: {to_address}, Ожидаемый: {expected_address}")
-                            
-                            if to_address.lower() == expected_address.lower():
-                                amount = int(log['data'], 16) / 10**18
-                                if amount >= expected_amount:
-                                    return True, f"OK: {amount} USDT"
-                                else:
-                                    return False, f"Недостаточно средств: {amount} USDT"
-            
-            if not found_transfer:
-                return False, "Не найден перевод USDT в этой транзакции"
-            
-        except Exception as e:
-            if attempt == 3:
-                return False, f"Ошибка: {str(e)}"
-            continue
-    
-    return False, "Не удалось проверить транзакцию после нескольких попыток"
+# === ФУНКЦИИ ПРОВЕРКИ ПЛАТЕЖЕЙ ===
+# Пул JSON-RPC провайдеров: BSC_RPC_URLS через запятую, BSC_RPC_BUDGETS — лимиты запросов в секунду
+# в том же порядке (пусто — без лимита). По умолчанию — один MegaNode, см. rpc_pool.py
+BSC_RPC_URLS = [url.strip() for url in os.getenv("BSC_RPC_URLS", "").split(",") if url.strip()] or [
+    f"https://bsc-mainnet.nodereal.io/v1/{os.getenv('MEGANODE_API_KEY')}"
+]
+BSC_RPC_BUDGETS = [float(b) if b.strip() else None for b in os.getenv("BSC_RPC_BUDGETS", "").split(",")]
+
+rpc = RpcPool(
+    [
+        Provider(
+            BscRpcClient(url, timeout=10, pool_size=int(os.getenv("RPC_POOL_SIZE", 20))),
+            rps=BSC_RPC_BUDGETS[i] if i < len(BSC_RPC_BUDGETS) else None
+        )
+        for i, url in enumerate(BSC_RPC_URLS)
+    ],
+    failure_threshold=int(os.getenv("BSC_RPC_FAILURES", 5)),
+    cooldown=float(os.getenv("BSC_RPC_COOLDOWN", 30)),
+    hedge_delay=float(os.getenv("BSC_RPC_HEDGE_DELAY", 0.3))
+)
 
 # === ФУНКЦИИ ДЛЯ ПОЛУЧЕНИЯ БЛОКОВ BSC ===
-def get_current_bsc_block():
+async def get_current_bsc_block():
     """Получает номер последнего блока BSC через MegaNode JSON-RPC"""
     try:
-        api_key = os.getenv("MEGANODE_API_KEY")
-        url = f"https://bsc-mainnet.nodereal.io/v1/{api_key}"
-        
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "eth_blockNumber",
-            "params": [],
-            "id": 1
-        }
-        
-        response = requests.post(url, json=payload, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if 'result' in data:
-                block_number = int(data['result'], 16)
-                logging.info(f"✅ Текущий блок BSC: {block_number}")
-                return block_number
-        else:
-            logging.error(f"Ошибка HTTP: {response.status_code}")
-            logging.error(f"Ответ: {response.text[:200]}")
-            
-    except Exception as e:
+        result = await rpc.call("eth_blockNumber")
+        if result:
+            block_number = int(result, 16)
+            logging.info(f"✅ Текущий блок BSC: {block_number}")
+            return block_number
+    except JsonRpcError as e:
         logging.error(f"Ошибка получения блока BSC: {str(e)}")
     
     return None
 
-def get_bsc_block_hash(block_number):
-    """Получает хэш блока BSC по номеру через MegaNode JSON-RPC"""
-    try:
-        api_key = os.getenv("MEGANODE_API_KEY")
-        url = f"https://bsc-mainnet.nodereal.io/v1/{api_key}"
-        
-        block_hex = hex(block_number)
-        
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "eth_getBlockByNumber",
-            "params": [block_hex, False],
-            "id": 1
-        }
-        
-        response = requests.post(url, json=payload, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if 'result' in data and data['result']:
-                block_hash = data['result']['hash']
-                logging.info(f"✅ Хэш блока {block_number}: {block_hash[:32]}...")
-                return block_hash
-        else:
-            logging.error(f"Ошибка HTTP: {response.status_code}")
-            logging.error(f"Ответ: {response.text[:200]}")
-            
-    except Exception as e:
-        logging.error(f"Ошибка получения хэша BSC: {str(e)}")
-    
-    return None
+# Сколько секунд голова из BlockFollower считается актуальной для выбора целевого блока розыгрыша
+BSC_HEAD_MAX_AGE = float(os.getenv("BSC_HEAD_MAX_AGE", 10))
+
+block_follower = BlockFollower(
+    rpc,
+    poll_interval=float(os.getenv("BSC_HEAD_POLL", 1.5)),
+    cache_size=int(os.getenv("BSC_BLOCK_CACHE", 2048))
+)
+
+# Входящие переводы USDT на кошелёк индексируются в фоне через eth_getLogs
+transfer_indexer = TransferIndexer(
+    rpc,
+    block_follower,
+    WALLET_ADDRESS,
+    confirmations=BSC_MIN_CONFIRMATIONS,
+    batch_blocks=int(os.getenv("INDEXER_BATCH_BLOCKS", 5000)),
+    backfill_blocks=int(os.getenv("INDEXER_BACKFILL_BLOCKS", 20000)),
+    start_block=int(os.getenv("INDEXER_START_BLOCK")) if os.getenv("INDEXER_START_BLOCK") else None
+)
+
+# Опрос головы BSC и индексер идут только в ведущем процессе, чтобы число запросов к RPC
+# и бюджеты провайдеров не умножались на число воркеров, см. leader.py
+async def become_chain_leader():
+    block_follower.leader = True
+    transfer_indexer.start()
+
+async def resign_chain_leader():
+    block_follower.leader = False
+    await transfer_indexer.stop()
+
+chain_leader = LeaderLock("bsc_chain", become_chain_leader, resign_chain_leader)
+
+# Проверка оплаты по сетям; сеть выбирается по формату TXID, см. payments.py
+payment_verifiers = {
+    "bsc": BscVerifier(rpc, block_follower, transfer_indexer, WALLET_ADDRESS, min_confirmations=BSC_MIN_CONFIRMATIONS),
+}
+if TRON_WALLET_ADDRESS:
+    payment_verifiers["tron"] = TronVerifier(
+        TRON_API_URL,
+        TRON_WALLET_ADDRESS,
+        api_key=os.getenv("TRONGRID_API_KEY"),
+        pool_size=int(os.getenv("RPC_POOL_SIZE", 20))
+    )
+else:
+    logging.warning("⚠️ TRON_WALLET_ADDRESS не задан — приём оплаты в TRON выключен")
+
+# Тексты для пользователей перечисляют только включённые сети
+PAYMENT_NETWORKS = " или ".join(verifier.network.upper() for verifier in payment_verifiers.values())
+TXID_FORMAT_HINT = "0x и 64 символа для BSC или 64 символа для TRON" if "tron" in payment_verifiers else "0x и 64 символа"
+
+# Лимиты частоты на пользователя и общий лимит проверок TXID — до любых запросов в БД и RPC, см. flood_control.py
+dp.middleware.setup(FloodControl(
+    lambda text: bool(detect_verifiers(payment_verifiers, text)),
+    user_rate=float(os.getenv("FLOOD_USER_RATE", 1)),
+    user_burst=int(os.getenv("FLOOD_USER_BURST", 5)),
+    txid_rate=float(os.getenv("FLOOD_TXID_PER_MIN", 6)) / 60,
+    txid_burst=int(os.getenv("FLOOD_TXID_BURST", 3)),
+    global_txid_rate=float(os.getenv("FLOOD_TXID_GLOBAL_RATE", 20)),
+    global_txid_burst=int(os.getenv("FLOOD_TXID_GLOBAL_BURST", 50)),
+    exempt_ids={ADMIN_ID}
+))
 
 async def publish_round_info(chat_id, round_number, participants_with_tickets, target_block):
     """Публикует информацию о раунде перед розыгрышем"""
-    tickets_text = "\n".join(participants_with_tickets[:20])
+    tickets_text = "\n".join(escape_md(line) for line in participants_with_tickets[:20])
     if len(participants_with_tickets) > 20:
         tickets_text += f"\n... и ещё {len(participants_with_tickets) - 20}"
     
@@ -271,58 +201,87 @@ async def publish_round_info(chat_id, round_number, participants_with_tickets, t
         f"**Список участников:**\n{tickets_text}\n\n"
         f"🔐 **Прозрачный выбор победителя:**\n"
         f"1️⃣ Будет взят хэш блока BSC **#{target_block}**\n"
-        f"2️⃣ Победитель = хэш % {len(participants_with_tickets)}\n"
+        f"2️⃣ Позиция победителя в списке = хэш % {len(participants_with_tickets)} (считая с 0)\n"
         f"3️⃣ Результат появится здесь сразу после получения блока\n\n"
         f"⏳ Ожидайте розыгрыша..."
     )
     await bot.send_message(chat_id, message, parse_mode="Markdown")
 
+# === ЛИЧНЫЕ УВЕДОМЛЕНИЯ О РОЗЫГРЫШЕ ===
+def render_draw_start_notice(payload, ticket_number):
+    if ticket_number is not None:
+        return (
+            f"🎲 Розыгрыш #{payload['round_number']} начался!\n\n"
+            f"🎟 Твой билет №{ticket_number} участвует.\n"
+            f"🔐 Победитель определится по хэшу блока BSC #{payload['target_block']}.\n"
+            f"Результат придёт сюда и в канал {CHANNEL_ID}"
+        )
+    return (
+        f"🎲 Начался розыгрыш #{payload['round_number']}!\n\n"
+        f"🎟 Билетов: {payload['tickets']}\n"
+        f"💰 Банк: {payload['bank']} USDT\n\n"
+        f"Следи за результатом в канале {CHANNEL_ID} и участвуй в следующем раунде 🍀"
+    )
+
+def render_draw_result_notice(payload, ticket_number):
+    if ticket_number == payload['winner_ticket']:
+        return (
+            f"🎉 Поздравляем! Твой билет №{ticket_number} выиграл розыгрыш #{payload['round_number']}!\n\n"
+            f"🎁 Приз: {payload['winner_prize']:.2f} USDT"
+        )
+    if ticket_number is not None:
+        return (
+            f"Розыгрыш #{payload['round_number']} завершён.\n\n"
+            f"🎟 Твой билет №{ticket_number} в этот раз не выиграл — победил билет №{payload['winner_ticket']}.\n"
+            f"Удачи в следующем раунде! 🍀"
+        )
+    return (
+        f"🏆 Розыгрыш #{payload['round_number']} завершён!\n\n"
+        f"🎉 Победитель: билет №{payload['winner_ticket']} — {payload['winner_username']}\n"
+        f"🎁 Приз: {payload['winner_prize']:.2f} USDT\n\n"
+        f"Хочешь в следующий розыгрыш? Нажми «🎟 Участвовать»"
+    )
+
+broadcaster = Broadcaster(
+    outbox,
+    {"draw_start": render_draw_start_notice, "draw_result": render_draw_result_notice},
+    workers=int(os.getenv("BROADCAST_WORKERS", 50))
+)
+
 # === ФУНКЦИИ ДЛЯ ПРОВЕДЕНИЯ РОЗЫГРЫША ===
-async def execute_provable_draw_bsc(chat_id, round_number, participants_with_tickets, target_block):
-    """Проводит provably fair розыгрыш на BSC и публикует красивый пост"""
-    
-    if hasattr(execute_provable_draw_bsc, f"completed_{round_number}"):
-        return None
-    
-    wait_msg = await bot.send_message(chat_id, "⏳ **Получаю хэш блока BSC...**", parse_mode="Markdown")
-    
-    block_hash = None
-    for attempt in range(36):
-        await asyncio.sleep(5)
-        block_hash = get_bsc_block_hash(target_block)
-        if block_hash:
-            break
-        if attempt % 6 == 0 and attempt > 0:
-            await bot.edit_message_text(
-                f"⏳ **Получаю хэш блока BSC...** (попытка {attempt//6+1}/6)",
-                chat_id, wait_msg.message_id, parse_mode="Markdown"
-            )
-    
-    if not block_hash:
-        await bot.edit_message_text(
-            "❌ **Ошибка:** не удалось получить хэш блока. Попробуйте позже.",
-            chat_id, wait_msg.message_id, parse_mode="Markdown"
+# Розыгрыш по шагам ведёт фоновый планировщик, состояние хранится в таблице draws, см. draws.py.
+# Здесь — то, что на каждом шаге видят канал, админ и участники.
+def ticket_lines(tickets):
+    return [f"{row['ticket_number']}. {row['username']}" for row in tickets]
+
+async def announce_draw(draw, tickets):
+    """Публикует анонс розыгрыша и запускает рассылку о старте"""
+    await publish_round_info(CHANNEL_ID, draw['round_number'], ticket_lines(tickets), draw['target_block'])
+    await broadcaster.start_once("draw_start", draw['round_id'], {
+        "round_number": draw['round_number'],
+        "target_block": draw['target_block'],
+        "tickets": len(tickets),
+        "bank": len(tickets) * ENTRY_FEE,
+    })
+    if draw['chat_id']:
+        await bot.send_message(
+            draw['chat_id'],
+            f"✅ Информация о розыгрыше #{draw['round_number']} опубликована в канале\n"
+            f"⏳ Розыгрыш состоится сразу после выхода блока #{draw['target_block']}"
         )
-        return None
-    
-    hash_int = int(block_hash, 16)
-    winner_index = hash_int % len(participants_with_tickets)
-    winner_line = participants_with_tickets[winner_index]
-    
-    # Извлекаем номер билета и username
-    winner_parts = winner_line.split('. ')
-    winner_ticket = int(winner_parts[0])
-    winner_username = winner_parts[1] if len(winner_parts) > 1 else "Неизвестно"
-    
-    # Рассчитываем данные
-    total_users = len(participants_with_tickets)
+
+async def publish_draw_result(draw, tickets):
+    """Публикует в канал пост с итогом provably fair розыгрыша на BSC"""
+    target_block = draw['target_block']
+    block_hash = draw['block_hash']
+    total_users = draw['participants_count']
     bank = total_users * ENTRY_FEE
     commission = bank * 0.10
-    winner_prize = bank - commission
+    winner_prize = draw['winner_prize']
     
     # Формируем красивый пост
     result = (
-        f"🏆 **РОЗЫГРЫШ #{round_number} ЗАВЕРШЁН!** 🏆\n\n"
+        f"🏆 **РОЗЫГРЫШ #{draw['round_number']} ЗАВЕРШЁН!** 🏆\n\n"
         f"📅 **Дата:** {time.strftime('%d.%m.%Y %H:%M')} (UTC)\n"
         f"🔗 **Блок BSC:** [#{target_block}](https://bscscan.com/block/{target_block})\n"
         f"🔐 **Хэш блока:**\n`{block_hash[:32]}...`\n\n"
@@ -332,8 +291,9 @@ async def execute_provable_draw_bsc(chat_id, round_number, participants_with_tic
         f"💸 Комиссия (10%): **{commission:.2f} USDT**\n"
         f"🎁 Приз победителю: **{winner_prize:.2f} USDT**\n\n"
         f"🧮 **Расчёт победителя:**\n"
-        f"`{block_hash[:16]}...` (хэш) % {total_users} = **{winner_ticket}**\n\n"
-        f"🎉 **Победитель: Билет №{winner_ticket} — {winner_username}**\n\n"
+        f"`{block_hash[:16]}...` (хэш) % {total_users} = **{draws.winner_index(block_hash, total_users)}** — "
+        f"позиция в списке билетов по возрастанию номера, считая с 0\n\n"
+        f"🎉 **Победитель: Билет №{draw['winner_ticket']} — {escape_md(draw['winner_username'])}**\n\n"
         f"🔍 **[Проверить на BscScan](https://bscscan.com/block/{target_block})**\n\n"
         f"Следующий розыгрыш уже скоро! 🚀"
     )
@@ -345,60 +305,85 @@ async def execute_provable_draw_bsc(chat_id, round_number, participants_with_tic
         parse_mode="Markdown",
         disable_web_page_preview=True
     )
-    
-    return winner_username, winner_ticket, winner_prize
+
+async def finish_draw(draw):
+    """Розыгрыш в архиве: сбрасывает кэши итогов и рассылает результат"""
+    responses.on_draw_recorded()
+    if draw['chat_id']:
+        await bot.send_message(
+            draw['chat_id'],
+            f"✅ Розыгрыш #{draw['round_number']} завершён! Победитель: билет {draw['winner_ticket']} — {draw['winner_username']}"
+        )
+    await broadcaster.start_once("draw_result", draw['round_id'], {
+        "round_number": draw['round_number'],
+        "winner_ticket": draw['winner_ticket'],
+        "winner_username": draw['winner_username'],
+        "winner_prize": draw['winner_prize'],
+    })
+
+async def report_draw_stalled(draw, error):
+    if draw['chat_id']:
+        await bot.send_message(
+            draw['chat_id'],
+            f"⚠️ Розыгрыш #{draw['round_number']}: ошибка на шаге {draw['state']} ({error}).\n"
+            f"Участники сохранены, шаг повторяется автоматически."
+        )
+
+async def report_draw_failed(draw, error):
+    if draw['chat_id']:
+        resume = "продолжит его с того же шага и блока" if draw['announce_attempted'] else "начнёт его заново"
+        await bot.send_message(
+            draw['chat_id'],
+            f"❌ Розыгрыш #{draw['round_number']} остановлен после {draw['attempts']} ошибок подряд "
+            f"на шаге {draw['failed_state']}: {error}\n"
+            f"Участники сохранены, раунд заморожен. /start_draw {resume}."
+        )
+
+draw_scheduler = DrawScheduler(
+    block_follower,
+    announce=announce_draw,
+    publish_result=publish_draw_result,
+    on_archived=finish_draw,
+    on_stalled=report_draw_stalled,
+    on_failed=report_draw_failed,
+    entry_fee=ENTRY_FEE,
+    poll_interval=float(os.getenv("DRAW_POLL_INTERVAL", 5)),
+    block_timeout=float(os.getenv("DRAW_BLOCK_TIMEOUT", 180)),
+    max_attempts=int(os.getenv("DRAW_MAX_ATTEMPTS", 10))
+)
 
 # === СТАТИСТИКА И ИСТОРИЯ ===
-@dp.message_handler(commands=['stats'])
-async def cmd_stats(message: types.Message):
-    """Показывает общую статистику бота"""
-    
-    cursor.execute("SELECT COUNT(*) FROM draw_history")
-    total_draws = cursor.fetchone()['count'] or 0
-    
-    cursor.execute("SELECT SUM(participants_count) FROM draw_history")
-    total_participants = cursor.fetchone()['sum'] or 0
+async def render_stats():
+    # Итоги поддерживаются в draw_totals при каждом розыгрыше — здесь одно чтение строки
+    totals = await stats.get_totals()
     
-    cursor.execute("SELECT SUM(total_bank) FROM draw_history")
-    total_bank_all = cursor.fetchone()['sum'] or 0
-    
-    cursor.execute("SELECT SUM(commission) FROM draw_history")
-    total_commission = cursor.fetchone()['sum'] or 0
-    
-    cursor.execute("SELECT MAX(winner_prize) FROM draw_history")
-    max_prize = cursor.fetchone()['max'] or 0
-    
-    cursor.execute("SELECT MAX(total_bank) FROM draw_history")
-    max_bank = cursor.fetchone()['max'] or 0
-    
-    stats_text = (
+    return (
         f"📊 **ОБЩАЯ СТАТИСТИКА**\n\n"
-        f"🎲 Всего розыгрышей: **{total_draws}**\n"
-        f"👥 Всего участников: **{total_participants}**\n"
-        f"💰 Общий банк: **{total_bank_all:.2f} USDT**\n"
-        f"💸 Твоя комиссия (10%): **{total_commission:.2f} USDT**\n\n"
+        f"🎲 Всего розыгрышей: **{totals['total_draws']}**\n"
+        f"👥 Всего участников: **{totals['total_participants']}**\n"
+        f"💰 Общий банк: **{totals['total_bank']:.2f} USDT**\n"
+        f"💸 Твоя комиссия (10%): **{totals['total_commission']:.2f} USDT**\n\n"
         f"🏆 **Рекорды:**\n"
-        f"• Самый крупный банк: **{max_bank:.2f} USDT**\n"
-        f"• Самый крупный выигрыш: **{max_prize:.2f} USDT**"
+        f"• Самый крупный банк: **{totals['max_bank']:.2f} USDT**\n"
+        f"• Самый крупный выигрыш: **{totals['max_prize']:.2f} USDT**"
     )
-    
+
+@dp.message_handler(commands=['stats'])
+async def cmd_stats(message: types.Message):
+    """Показывает общую статистику бота"""
+    stats_text = await responses.get("stats", render_stats)
     await message.answer(stats_text, parse_mode="Markdown")
 
-@dp.message_handler(commands=['history'])
-async def cmd_history(message: types.Message):
-    """Показывает историю последних 10 розыгрышей"""
-    
-    cursor.execute("""
+async def render_history():
+    rows = await database.fetch("""
         SELECT round_number, draw_date, participants_count, total_bank, winner_username, winner_ticket, winner_prize 
         FROM draw_history 
         ORDER BY draw_date DESC 
         LIMIT 10
     """)
-    rows = cursor.fetchall()
     
     if not rows:
-        await message.answer("📭 История розыгрышей пока пуста")
-        return
+        return "📭 История розыгрышей пока пуста"
     
     text = "📜 **ПОСЛЕДНИЕ РОЗЫГРЫШИ**\n\n"
     
@@ -407,49 +392,74 @@ async def cmd_history(message: types.Message):
         text += (
             f"🎲 **#{row['round_number']}** — {date_str}\n"
             f"👥 {row['participants_count']} уч. | 💰 {row['total_bank']:.2f} USDT\n"
-            f"🏆 Билет №{row['winner_ticket']} — {row['winner_username']} — {row['winner_prize']:.2f} USDT\n\n"
+            f"🏆 Билет №{row['winner_ticket']} — {escape_md(row['winner_username'])} — {row['winner_prize']:.2f} USDT\n\n"
         )
     
+    return text
+
+@dp.message_handler(commands=['history'])
+async def cmd_history(message: types.Message):
+    """Показывает историю последних 10 розыгрышей"""
+    text = await responses.get("history", render_history)
     await message.answer(text, parse_mode="Markdown")
 
+def format_window_stats(title, window, top_winner):
+    """Текст сводки за период из дневных корзин"""
+    text = (
+        f"{title}\n\n"
+        f"🎲 Розыгрышей: **{window['draws']}**\n"
+        f"👥 Участников: **{window['participants']}**\n"
+        f"💰 Общий банк: **{window['total_bank']:.2f} USDT**\n"
+        f"💸 Комиссия: **{window['total_commission']:.2f} USDT**\n"
+        f"🏆 Макс. выигрыш: **{window['max_prize']:.2f} USDT**\n"
+    )
+    
+    if top_winner:
+        text += f"👑 Лучший игрок: {escape_md(top_winner['winner_username'])} ({top_winner['wins']} побед)\n"
+    
+    return text
+
 @dp.message_handler(commands=['weekly'])
 async def cmd_weekly(message: types.Message):
     """Показывает статистику за последние 7 дней"""
+    async def render():
+        window, top_winner = await stats.get_last_days(7)
+        return format_window_stats("📆 **СТАТИСТИКА ЗА НЕДЕЛЮ**", window, top_winner)
     
-    cursor.execute("""
-        SELECT COUNT(*) as draws, 
-               SUM(participants_count) as participants,
-               SUM(total_bank) as total_bank,
-               SUM(commission) as total_commission,
-               MAX(winner_prize) as max_prize
-        FROM draw_history 
-        WHERE draw_date > NOW() - INTERVAL '7 days'
-    """)
-    stats = cursor.fetchone()
-    
-    cursor.execute("""
-        SELECT winner_username, COUNT(*) as wins
-        FROM draw_history 
-        WHERE draw_date > NOW() - INTERVAL '7 days'
-        GROUP BY winner_username
-        ORDER BY wins DESC
-        LIMIT 1
-    """)
-    top_winner = cursor.fetchone()
-    
-    week_text = (
-        f"📆 **СТАТИСТИКА ЗА НЕДЕЛЮ**\n\n"
-        f"🎲 Розыгрышей: **{stats['draws'] or 0}**\n"
-        f"👥 Участников: **{stats['participants'] or 0}**\n"
-        f"💰 Общий банк: **{stats['total_bank'] or 0:.2f} USDT**\n"
-        f"💸 Комиссия: **{stats['total_commission'] or 0:.2f} USDT**\n"
-        f"🏆 Макс. выигрыш: **{stats['max_prize'] or 0:.2f} USDT**\n"
-    )
+    # Окно сдвигается в полночь UTC, поэтому день входит в ключ кэша
+    week_text = await responses.get("weekly", render, stats.utc_today())
+    await bot.send_message(message.chat.id, week_text, parse_mode="Markdown")
+
+@dp.message_handler(commands=['monthly'])
+async def cmd_monthly(message: types.Message):
+    """Показывает статистику за последние 30 дней"""
+    async def render():
+        window, top_winner = await stats.get_last_days(30)
+        return format_window_stats("🗓 **СТАТИСТИКА ЗА МЕСЯЦ**", window, top_winner)
+    
+    month_text = await responses.get("monthly", render, stats.utc_today())
+    await bot.send_message(message.chat.id, month_text, parse_mode="Markdown")
+
+@dp.message_handler(commands=['period'])
+async def cmd_period(message: types.Message):
+    """Статистика за произвольный период (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        return
     
-    if top_winner:
-        week_text += f"👑 Лучший игрок: {top_winner['winner_username']} ({top_winner['wins']} побед)\n"
+    args = message.get_args().split()
+    try:
+        date_from = datetime.date.fromisoformat(args[0])
+        date_to = datetime.date.fromisoformat(args[1]) if len(args) > 1 else stats.utc_today()
+    except (IndexError, ValueError):
+        await message.answer(
+            "❌ Используй: /period [с] [по]\n"
+            "Пример: /period 2026-03-01 2026-03-31"
+        )
+        return
     
-    await bot.send_message(message.chat.id, week_text, parse_mode="Markdown")
+    window, top_winner = await stats.get_window(date_from, date_to)
+    title = f"📅 **СТАТИСТИКА {date_from:%d.%m.%Y} — {date_to:%d.%m.%Y}**"
+    await message.answer(format_window_stats(title, window, top_winner), parse_mode="Markdown")
 
 # === РЕФЕРАЛЬНАЯ СИСТЕМА И АНАЛИТИКА ===
 @dp.message_handler(commands=['gen_link'])
@@ -491,17 +501,8 @@ async def show_sources_stats(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    cursor.execute("""
-        SELECT 
-            source, 
-            COUNT(*) as users,
-            COUNT(DISTINCT user_id) as unique_users,
-            COUNT(CASE WHEN invited_by IS NOT NULL THEN 1 END) as referrals
-        FROM referral_sources 
-        GROUP BY source 
-        ORDER BY users DESC
-    """)
-    rows = cursor.fetchall()
+    # Воронка поддерживается в source_funnel при каждом /start и оплате
+    rows = await referrals.get_funnel()
     
     if not rows:
         await message.answer("📭 Нет данных по источникам")
@@ -510,18 +511,13 @@ async def show_sources_stats(message: types.Message):
     text = "📊 **СТАТИСТИКА ПО ИСТОЧНИКАМ**\n\n"
     
     for row in rows:
-        cursor.execute("""
-            SELECT COUNT(*) FROM participants p 
-            JOIN referral_sources rs ON p.username = '@' || rs.user_id::text
-            WHERE rs.source = %s
-        """, (row['source'],))
-        participants = cursor.fetchone()['count'] or 0
-        conversion_rate = (participants / row['users']) * 100 if row['users'] > 0 else 0
+        conversion_rate = (row['paid_users'] / row['unique_users']) * 100 if row['unique_users'] > 0 else 0
         
         text += (
             f"📌 **{row['source']}**\n"
-            f"   👥 Переходов: {row['users']}\n"
-            f"   🎟 Участников: {participants}\n"
+            f"   👥 Переходов: {row['visits']}\n"
+            f"   🙋 Уникальных: {row['unique_users']}\n"
+            f"   🎟 Оплатили: {row['paid_users']}\n"
             f"   📈 Конверсия: {conversion_rate:.1f}%\n"
             f"   🔗 Рефералов: {row['referrals']}\n\n"
         )
@@ -549,18 +545,19 @@ async def start(message: types.Message):
             if len(parts) > 4 and parts[4].isdigit():
                 source_info['invited_by'] = int(parts[4])
     
-    cursor.execute("""
-        INSERT INTO referral_sources 
-        (user_id, source, medium, campaign, invited_by) 
-        VALUES (%s, %s, %s, %s, %s)
-    """, (
-        message.from_user.id,
-        source_info['source'],
-        source_info['medium'],
-        source_info['campaign'],
-        source_info['invited_by']
-    ))
-    conn.commit()
+    async with database.transaction() as conn:
+        await conn.execute("""
+            INSERT INTO referral_sources 
+            (user_id, source, medium, campaign, invited_by) 
+            VALUES ($1, $2, $3, $4, $5)
+        """,
+            message.from_user.id,
+            source_info['source'],
+            source_info['medium'],
+            source_info['campaign'],
+            source_info['invited_by']
+        )
+        await referrals.record_visit(conn, source_info, message.from_user.id)
     
     # Жёстко задаём правильную ссылку
     channel_link = "@real_crypto_fortuna"
@@ -580,51 +577,95 @@ async def start(message: types.Message):
 @dp.message_handler(lambda message: message.text == "🎟 Участвовать")
 async def participate(message: types.Message):
     await message.answer(
-        f"🔹 **Для участия переведи {ENTRY_FEE} USDT**\n"
-        f"🔹 Сеть: **BSC (BEP-20)**\n\n"
-        f"👇 **Адрес для перевода:**",
+        f"🔹 **Для участия переведи {ENTRY_FEE} USDT в любой из сетей**\n\n"
+        f"👇 **Адреса для перевода:**",
         parse_mode="Markdown"
     )
     
-    await message.answer(
-        f"`{WALLET_ADDRESS}`",
-        parse_mode="Markdown"
-    )
+    for verifier in payment_verifiers.values():
+        await message.answer(
+            f"🔹 {verifier.title}\n`{verifier.address}`",
+            parse_mode="Markdown"
+        )
     
     await message.answer(
         "📤 **После оплаты отправь сюда TXID** (хэш транзакции)\n"
-        "Он выглядит как длинный набор букв и цифр, начинается с 0x",
+        f"Он выглядит как длинный набор букв и цифр: {TXID_FORMAT_HINT}",
         parse_mode="Markdown"
     )
 
 @dp.message_handler(lambda message: message.text == "💰 Банк")
 async def bank(message: types.Message):
-    cursor.execute("SELECT COUNT(*) FROM participants")
-    result = cursor.fetchone()
-    count = result['count'] if result else 0
-    total_bank = count * ENTRY_FEE
+    await live_round.refresh()
+    total_bank = live_round.count * ENTRY_FEE
     await message.answer(f"💰 Текущий банк: {total_bank} USDT")
 
-@dp.message_handler(lambda message: message.text == "👥 Участники")
-async def members(message: types.Message):
-    cursor.execute("SELECT ticket_number, username FROM participants ORDER BY ticket_number")
-    rows = cursor.fetchall()
+MEMBERS_PAGE_SIZE = 20
+
+async def render_members_page(round_id, after=0, before=None):
+    """Страница списка участников и кнопки навигации (keyset по номеру билета)"""
+    # Берём на одну строку больше страницы, чтобы знать, есть ли куда листать дальше
+    if before is not None:
+        rows = await database.fetch(database.SQL_PARTICIPANTS_PAGE_BEFORE, round_id, before, MEMBERS_PAGE_SIZE + 1)
+        has_prev, has_next = len(rows) > MEMBERS_PAGE_SIZE, True
+        rows = rows[-MEMBERS_PAGE_SIZE:]
+    else:
+        rows = await database.fetch(database.SQL_PARTICIPANTS_PAGE_AFTER, round_id, after, MEMBERS_PAGE_SIZE + 1)
+        has_prev, has_next = after > 0, len(rows) > MEMBERS_PAGE_SIZE
+        rows = rows[:MEMBERS_PAGE_SIZE]
     
     if not rows:
-        await message.answer("👥 Пока нет участников. Ты можешь стать первым!")
-        return
+        return None, None
+    
+    count = live_round.count_for(round_id)
+    if count is None:
+        count = await rounds.count_participants(round_id)
+    first_ticket = rows[0]['ticket_number']
+    last_ticket = rows[-1]['ticket_number']
     
-    count = len(rows)
     text = f"👥 **Всего участников: {count}**\n\n"
     text += "**Текущие билеты:**\n"
     
-    for row in rows[:20]:
-        text += f"#{row['ticket_number']} — {row['username']}\n"
+    for row in rows:
+        text += f"#{row['ticket_number']} — {escape_md(row['username'])}\n"
+    
+    markup = InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"members:{round_id}:before:{first_ticket}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Далее ▶️", callback_data=f"members:{round_id}:after:{last_ticket}"))
+    if buttons:
+        text += f"\nБилеты {first_ticket}–{last_ticket} из {count}"
+        markup.row(*buttons)
+    
+    return text, markup
+
+@dp.message_handler(lambda message: message.text == "👥 Участники")
+async def members(message: types.Message):
+    await live_round.refresh()
+    text, markup = await render_members_page(live_round.round_id)
     
-    if count > 20:
-        text += f"\n... и ещё {count - 20}"
+    if not text:
+        await message.answer("👥 Пока нет участников. Ты можешь стать первым!")
+        return
     
-    await message.answer(text, parse_mode="Markdown")
+    await message.answer(text, parse_mode="Markdown", reply_markup=markup)
+
+@dp.callback_query_handler(lambda call: call.data.startswith("members:"))
+async def members_page(call: types.CallbackQuery):
+    _, round_id, direction, ticket = call.data.split(":")
+    if direction == "before":
+        text, markup = await render_members_page(int(round_id), before=int(ticket))
+    else:
+        text, markup = await render_members_page(int(round_id), after=int(ticket))
+    
+    if not text:
+        await call.answer("Этот розыгрыш уже завершён")
+        return
+    
+    await call.message.edit_text(text, parse_mode="Markdown", reply_markup=markup)
+    await call.answer()
 
 @dp.message_handler(lambda message: message.text == "📊 Статистика")
 async def stats_button(message: types.Message):
@@ -648,19 +689,13 @@ async def add_participant(message: types.Message):
         await message.answer("Используй: /add @username")
         return
     
-    cursor.execute("SELECT COALESCE(MAX(ticket_number), 0) + 1 as next_num FROM participants")
-    result = cursor.fetchone()
-    next_number = result['next_num'] if result else 1
-    
     try:
-        cursor.execute(
-            "INSERT INTO participants (ticket_number, username) VALUES (%s, %s)", 
-            (next_number, username)
-        )
-        conn.commit()
+        async with database.acquire() as conn:
+            round_id, next_number = await rounds.add_participant(conn, username, None)
+        await live_round.on_participant_added(round_id, username, None)
+        responses.on_participant_added()
         await message.answer(f"✅ Участник {username} добавлен! Билет №{next_number}")
-    except psycopg2.errors.UniqueViolation:
-        conn.rollback()
+    except asyncpg.exceptions.UniqueViolationError:
         await message.answer("⚠️ Этот участник уже добавлен")
 
 @dp.message_handler(commands=['reset_db'])
@@ -669,11 +704,13 @@ async def cmd_reset_db(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    cursor.execute("DELETE FROM participants")
-    cursor.execute("DELETE FROM transactions")
-    cursor.execute("DELETE FROM draw_history")
-    cursor.execute("DELETE FROM referral_sources")
-    conn.commit()
+    async with database.transaction() as conn:
+        await conn.execute("TRUNCATE participants_archive, transactions, draw_history, draws, referral_sources, broadcasts, broadcast_deliveries")
+        await rounds.drop_all(conn)
+        await stats.reset(conn)
+        await referrals.reset(conn)
+    await live_round.warm()
+    responses.invalidate()
     await message.answer("✅ База данных очищена! Все TXID теперь будут считаться новыми.")
 
 @dp.message_handler(commands=['find_txid'])
@@ -687,18 +724,16 @@ async def cmd_find_txid(message: types.Message):
     if args:
         search_txid = args.strip().lower()
         
-        cursor.execute("SELECT * FROM transactions WHERE txid = %s", (search_txid,))
-        result = cursor.fetchone()
-        
-        if not result and search_txid.startswith('0x'):
-            search_txid_no_prefix = search_txid[2:]
-            cursor.execute("SELECT * FROM transactions WHERE txid LIKE %s", (f'%{search_txid_no_prefix}%',))
-            result = cursor.fetchone()
-        
-        if not result:
-            short_txid = search_txid[-20:] if len(search_txid) > 20 else search_txid
-            cursor.execute("SELECT * FROM transactions WHERE txid LIKE %s", (f'%{short_txid}%',))
-            result = cursor.fetchone()
+        async with database.acquire() as conn:
+            result = await conn.fetchrow("SELECT * FROM transactions WHERE txid = $1", search_txid)
+            
+            if not result and search_txid.startswith('0x'):
+                search_txid_no_prefix = search_txid[2:]
+                result = await conn.fetchrow("SELECT * FROM transactions WHERE txid LIKE $1", f'%{search_txid_no_prefix}%')
+            
+            if not result:
+                short_txid = search_txid[-20:] if len(search_txid) > 20 else search_txid
+                result = await conn.fetchrow("SELECT * FROM transactions WHERE txid LIKE $1", f'%{short_txid}%')
         
         if result:
             await message.answer(
@@ -712,43 +747,35 @@ async def cmd_find_txid(message: types.Message):
                 parse_mode="Markdown"
             )
     
-    cursor.execute("SELECT txid, username, created_at FROM transactions ORDER BY created_at DESC LIMIT 10")
-    rows = cursor.fetchall()
+    rows = await database.fetch("SELECT txid, username, created_at FROM transactions ORDER BY created_at DESC LIMIT 10")
     
     if rows:
         text = "📋 **Последние 10 TXID в базе:**\n\n"
         for row in rows:
             short_tx = row['txid'][:15] + "..." + row['txid'][-10:]
-            text += f"• `{short_tx}` — {row['username']} — {row['created_at']}\n"
+            text += f"• `{short_tx}` — {escape_md(row['username'])} — {row['created_at']}\n"
         await message.answer(text, parse_mode="Markdown")
     else:
         await message.answer("📭 База транзакций пуста.")
 
-@dp.message_handler(commands=['announce'])
-async def cmd_announce(message: types.Message):
-    """Публикует красивый пост-анонс о начале розыгрыша (только для админа)"""
-    if message.from_user.id != ADMIN_ID:
-        return
-    
-    cursor.execute("SELECT COUNT(*) FROM participants")
-    count = cursor.fetchone()['count'] or 0
-    current_bank = count * ENTRY_FEE
-    
-    cursor.execute("""
+async def render_announce():
+    await live_round.refresh()
+    count = live_round.count
+    last_winner = await database.fetchrow("""
         SELECT winner_username, winner_prize, winner_ticket FROM draw_history 
         ORDER BY draw_date DESC LIMIT 1
     """)
-    last_winner = cursor.fetchone()
+    current_bank = count * ENTRY_FEE
     
-    last_winner_text = f"@{last_winner['winner_username']}" if last_winner else "пока нет"
+    last_winner_text = escape_md(f"@{last_winner['winner_username']}") if last_winner else "пока нет"
     last_ticket_text = f"№{last_winner['winner_ticket']}" if last_winner else ""
     last_prize_text = f"{last_winner['winner_prize']:.2f}" if last_winner else "0"
     
-    post = (
+    return (
         f"🎲 **CRYPTO FORTUNA — НОВЫЙ РОЗЫГРЫШ!** 🎲\n\n"
         f"💰 **Банк уже собран:** {current_bank} USDT\n"
         f"👥 **Участников:** {count}\n"
-        f"🎟 **Взнос:** {ENTRY_FEE} USDT (BSC)\n\n"
+        f"🎟 **Взнос:** {ENTRY_FEE} USDT ({PAYMENT_NETWORKS})\n\n"
         f"🔐 **Почему нам можно верить:**\n"
         f"• Победитель определяется хэшем блока BSC (проверяемо!)\n"
         f"• Все транзакции публичны\n"
@@ -762,80 +789,124 @@ async def cmd_announce(message: types.Message):
         f"🏆 **Предыдущий победитель:** {last_winner_text} (билет {last_ticket_text}) — {last_prize_text} USDT\n\n"
         f"Не упусти свой шанс! Удача любит смелых 🔥"
     )
+
+# Профайлер живёт в процессе, включается и выключается командой /profile
+profiler = tracing.SamplingProfiler()
+
+@dp.message_handler(commands=['profile'])
+async def cmd_profile(message: types.Message):
+    """Сэмплирующий профайлер: /profile on [интервал_мс] | /profile off (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        return
     
+    args = message.get_args().split()
+    if args and args[0] == "on":
+        if profiler.running:
+            await message.answer("⚠️ Профайлер уже запущен")
+            return
+        if len(args) > 1 and args[1].isdigit():
+            profiler.interval = int(args[1]) / 1000
+        profiler.start()
+        await message.answer(f"✅ Профайлер запущен, сэмпл каждые {profiler.interval * 1000:.0f} мс. Останови: /profile off")
+    elif args and args[0] == "off":
+        if not profiler.running:
+            await message.answer("⚠️ Профайлер не запущен")
+            return
+        profiler.stop()
+        await message.answer(profiler.report()[:4000])
+    else:
+        await message.answer("Используй: /profile on [интервал_мс] или /profile off")
+
+@dp.message_handler(commands=['slow'])
+async def cmd_slow(message: types.Message):
+    """Последние медленные обработки с разбивкой по span'ам (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    if not tracing.slow_traces:
+        await message.answer(f"✅ Обработок дольше {tracing.SLOW_TRACE_MS:.0f} мс не было")
+        return
+    
+    text = "\n\n".join(list(tracing.slow_traces)[-3:])
+    await message.answer(text[-4000:])
+
+@dp.message_handler(commands=['announce'])
+async def cmd_announce(message: types.Message):
+    """Публикует красивый пост-анонс о начале розыгрыша (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    post = await responses.get("announce", render_announce)
     await bot.send_message(CHANNEL_ID, post, parse_mode="Markdown")
     await message.answer("✅ Пост-анонс опубликован в канале!")
 
 @dp.message_handler(commands=['start_draw'])
 async def cmd_start_draw(message: types.Message):
-    global draw_in_progress
-
     await asyncio.sleep(0.5)
     
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Эта команда только для админа")
         return
     
-    if draw_in_progress:
+    # Идущий розыгрыш виден всем процессам через таблицу draws
+    if await draws.get_active_draw():
         await message.answer("⚠️ **Розыгрыш уже запущен!** Подождите завершения.")
         return
     
-    cursor.execute("SELECT ticket_number, username FROM participants ORDER BY ticket_number")
-    rows = cursor.fetchall()
-    participants_with_tickets = [f"{row['ticket_number']}. {row['username']}" for row in rows]
+    # Целевой блок должен быть ещё не выпущен: голову из кэша берём, только если она свежая
+    current_block = block_follower.fresh_head(BSC_HEAD_MAX_AGE) or await get_current_bsc_block()
+    if not current_block:
+        await message.answer("❌ Не удалось получить номер блока BSC")
+        return
+    
+    round_number = random.randint(1000, 9999)
+    target_block = current_block + 20
+    
+    # Раунд замораживается на время розыгрыша, новые оплаты уходят в следующий раунд
+    try:
+        async with database.transaction() as conn:
+            round_id, rows = await rounds.begin_draw(conn, min_participants=2)
+            if len(rows) >= 2:
+                draw, resumed = await draws.start_draw(conn, round_id, round_number, target_block, message.chat.id)
+    except asyncpg.exceptions.UniqueViolationError:
+        # Розыгрыш успели запустить из другого процесса
+        await message.answer("⚠️ **Розыгрыш уже запущен!** Подождите завершения.")
+        return
+    await live_round.reload_round()
+    responses.invalidate("announce")  # банк в анонсе теперь считается по новому раунду
     
-    if len(participants_with_tickets) < 2:
+    if len(rows) < 2:
         await message.answer("❌ Для розыгрыша нужно минимум 2 участника")
         return
     
-    draw_in_progress = True
+    if resumed:
+        await message.answer(
+            f"✅ Розыгрыш #{draw['round_number']} возобновлён с шага {draw['state']}: блок BSC #{draw['target_block']}"
+        )
+    else:
+        await message.answer(f"✅ Розыгрыш #{round_number} запущен: {len(rows)} билетов, блок BSC #{target_block}")
+    # Анонс, ожидание блока и итог проводит планировщик, см. draws.py
+    draw_scheduler.wake()
+
+@dp.message_handler(commands=['cancel_draw'])
+async def cmd_cancel_draw(message: types.Message):
+    """Отменяет розыгрыш, пока анонс с целевым блоком не отправлялся (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда только для админа")
+        return
     
-    try:
-        round_number = random.randint(1000, 9999)
-        
-        current_block = get_current_bsc_block()
-        if not current_block:
-            await message.answer("❌ Не удалось получить номер блока BSC")
-            draw_in_progress = False
-            return
-        
-        target_block = current_block + 20
-        
-        await publish_round_info(CHANNEL_ID, round_number, participants_with_tickets, target_block)
-        await message.answer(f"✅ Информация о розыгрыше #{round_number} опубликована в канале")
-        await message.answer(f"⏳ Розыгрыш состоится через 2 минуты (блок #{target_block})")
-        
-        await asyncio.sleep(120)
-        
-        result = await execute_provable_draw_bsc(CHANNEL_ID, round_number, participants_with_tickets, target_block)
-        
-        if result:
-            winner_username, winner_ticket, winner_prize = result
-            
-            cursor.execute("""
-                INSERT INTO draw_history 
-                (round_number, participants_count, total_bank, winner_username, winner_ticket, winner_prize, commission, target_block, block_hash) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                round_number, 
-                len(participants_with_tickets), 
-                len(participants_with_tickets) * ENTRY_FEE,
-                winner_username,
-                winner_ticket,
-                winner_prize,
-                len(participants_with_tickets) * ENTRY_FEE * 0.1,
-                target_block,
-                "saved_in_post"
-            ))
-            
-            cursor.execute("DELETE FROM participants")
-            conn.commit()
-            await message.answer(f"✅ Розыгрыш #{round_number} завершён! Победитель: билет {winner_ticket} — {winner_username}")
+    draw = await draws.cancel_draw()
+    if draw is None:
+        if await draws.get_active_draw():
+            # Иначе отмена после выхода блока позволяла бы перевыбрать победителя
+            await message.answer("⚠️ Анонс с целевым блоком уже отправлен — розыгрыш будет доведён до конца.")
         else:
-            await message.answer(f"❌ Розыгрыш #{round_number} не удался. Участники сохранены.")
+            await message.answer("📭 Нет активного розыгрыша.")
+        return
     
-    finally:
-        draw_in_progress = False
+    await message.answer(
+        f"✅ Розыгрыш #{draw['round_number']} отменён. Участники сохранены, /start_draw начнёт новый розыгрыш этого раунда."
+    )
 
 @dp.message_handler()
 async def handle_txid(message: types.Message):
@@ -846,83 +917,217 @@ async def handle_txid(message: types.Message):
     if message.text in button_texts:
         return
     
-    if len(message.text) < 60 or len(message.text) > 70:
-        await message.answer("❌ Это не похоже на TXID. Отправь хэш транзакции (64-66 символов).")
+    # Формат хэша проверяется до любых запросов: 0x и 64 hex-символа (BSC) или 64 hex-символа (TRON)
+    candidates = detect_verifiers(payment_verifiers, message.text.strip())
+    if not candidates:
+        await message.answer(f"❌ Это не похоже на TXID. Отправь хэш транзакции: {TXID_FORMAT_HINT}.")
+        return
+    
+    # 64 символа без 0x бывают и в BSC, и в TRON — сеть выбирается по тому, где транзакция есть
+    verifier = await resolve_verifier(candidates, message.text)
+    if verifier is None:
+        await message.answer(
+            "❓ Не удалось определить сеть по этому хэшу: транзакция пока не найдена.\n"
+            "Если перевод был в BSC — отправь хэш с 0x в начале. "
+            "Если в TRON — отправь TXID ещё раз через минуту, когда транзакция появится в сети."
+        )
         return
     
-    txid = message.text.strip()
+    txid = verifier.normalize(message.text)
     user_id = message.from_user.id
     username = message.from_user.username or f"user_{user_id}"
     
-    cursor.execute("SELECT * FROM transactions WHERE txid = %s", (txid,))
-    if cursor.fetchone():
+    # Проверки дублей идут по памяти; база только подтверждает возможное совпадение
+    if live_round.might_have_txid(txid) and await database.fetchval(database.SQL_TXID_EXISTS, txid):
         await message.answer("❌ Этот TXID уже был использован")
         return
 
-    cursor.execute("SELECT * FROM participants WHERE username = %s", (f"@{username}",))
-    if cursor.fetchone():
+    if live_round.might_have_participant(f"@{username}", user_id) and \
+            await database.fetchval(database.SQL_PARTICIPANT_EXISTS, f"@{username}", user_id):
         await message.answer("❌ Вы уже участвуете в текущем розыгрыше")
         return
     
+    # Недавний отказ по этому TXID отдаём из памяти, без повторной проверки в сети
+    rejection = verification_queue.cached_rejection(txid)
+    if rejection:
+        await message.answer(txid_rejection_text(*rejection))
+        return
+    
+    if verification_queue.is_pending(txid):
+        wait_msg = await message.answer("⏳ Этот TXID уже проверяется. Результат появится в этом сообщении.")
+        if not verification_queue.join(txid, message.chat.id, wait_msg.message_id, user_id):
+            await bot.edit_message_text("🔄 Проверка только что закончилась — отправь TXID ещё раз", message.chat.id, wait_msg.message_id)
+        return
+    
     wait_msg = await message.answer(
         "🔄 **Проверяю транзакцию...**\n"
-        "⏱ Это может занять до 30-40 секунд из-за задержек API\n"
-        "Пожалуйста, подожди...",
+        "⏱ Если транзакция ещё не попала в блок, я дождусь её и проверю снова\n"
+        "Результат появится в этом сообщении.",
         parse_mode="Markdown"
     )
     
-    success, msg = check_bsc_payment(txid)
+    job = VerificationJob(txid, message.chat.id, user_id, username, wait_msg.message_id, network=verifier.network)
+    if not verification_queue.submit(job):
+        await bot.edit_message_text(
+            "⚠️ Сейчас слишком много проверок. Отправь TXID ещё раз через пару минут.",
+            message.chat.id, wait_msg.message_id
+        )
+
+# === ОЧЕРЕДЬ ПРОВЕРКИ TXID ===
+async def verify_txid_job(job):
+    """Одна попытка проверки платежа"""
+    try:
+        return await payment_verifiers[job.network].verify(job.txid, ENTRY_FEE)
+    except RetryLater:
+        metrics.VERIFICATIONS.labels("retry").inc()
+        raise
+
+def txid_rejection_text(msg, expired):
+    if expired:
+        return (
+            "⏳ Транзакция пока не найдена в сети.\n"
+            "Если ты только что её отправил, пришли TXID ещё раз через пару минут."
+        )
+    return f"❌ Ошибка: {msg}"
+
+async def notify_txid_result(job, text, confirmed=False, parse_mode=None):
+    """Редактирует сообщение о проверке у отправителя TXID и у всех, кто прислал тот же TXID повторно"""
+    await bot.edit_message_text(text, job.chat_id, job.message_id, parse_mode=parse_mode)
+    for chat_id, message_id, user_id in job.followers:
+        if confirmed and user_id != job.user_id:
+            # Билет по этому TXID уже получил отправитель
+            await bot.edit_message_text("❌ Этот TXID уже был использован", chat_id, message_id)
+        else:
+            await bot.edit_message_text(text, chat_id, message_id, parse_mode=parse_mode)
+
+async def finish_txid_job(job, success, msg):
+    """Сохраняет результат проверки и редактирует сообщения «Проверяю транзакцию...»"""
+    if not success:
+        metrics.VERIFICATIONS.labels("expired" if job.expired else "rejected").inc()
+        await notify_txid_result(job, txid_rejection_text(msg, job.expired))
+        return
     
-    if success:
-        cursor.execute("SELECT COALESCE(MAX(ticket_number), 0) + 1 as next_num FROM participants")
-        result = cursor.fetchone()
-        next_number = result['next_num'] if result else 1
-        
-        cursor.execute(
-            "INSERT INTO transactions (txid, user_id, username, amount) VALUES (%s, %s, %s, %s) ON CONFLICT (txid) DO NOTHING",
-            (txid, user_id, username, 5)
+    error_text = None
+    async with database.transaction() as conn:
+        inserted = await conn.fetchval(
+            "INSERT INTO transactions (txid, user_id, username, amount, network) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (txid) DO NOTHING RETURNING txid",
+            job.txid, job.user_id, job.username, ENTRY_FEE, job.network
         )
-        
-        try:
-            cursor.execute(
-                "INSERT INTO participants (ticket_number, username) VALUES (%s, %s)", 
-                (next_number, f"@{username}")
-            )
-            conn.commit()
-            
-            await message.answer(
-                f"✅ **Транзакция подтверждена!**\n"
-                f"🎟 **Твой номер билета: {next_number}**\n"
-                f"Ты добавлен в розыгрыш. Удачи! 🍀",
-                parse_mode="Markdown"
-            )
-        except psycopg2.errors.UniqueViolation:
-            conn.commit()
-            await message.answer("⚠️ Вы уже участвуете в этом розыгрыше")
-    else:
-        await message.answer(f"❌ Ошибка: {msg}")
+        if not inserted:
+            error_text = "❌ Этот TXID уже был использован"
+            outcome = "duplicate_txid"
+        else:
+            try:
+                async with conn.transaction():
+                    round_id, next_number = await rounds.add_participant(conn, f"@{job.username}", job.user_id)
+            except asyncpg.exceptions.UniqueViolationError:
+                error_text = "⚠️ Вы уже участвуете в этом розыгрыше"
+                outcome = "already_participant"
+            else:
+                await conn.execute("UPDATE transactions SET round_id = $1 WHERE txid = $2", round_id, job.txid)
+                await referrals.record_payment(conn, job.user_id)
+    
+    if error_text:
+        metrics.VERIFICATIONS.labels(outcome).inc()
+        live_round.on_txid_used(job.txid)
+        await notify_txid_result(job, error_text)
+        return
     
-    await wait_msg.delete()
+    await live_round.on_participant_added(round_id, f"@{job.username}", job.user_id, job.txid)
+    responses.on_participant_added()
+    metrics.VERIFICATIONS.labels("confirmed").inc()
+    
+    await notify_txid_result(
+        job,
+        f"✅ **Транзакция подтверждена!**\n"
+        f"🎟 **Твой номер билета: {next_number}**\n"
+        f"Ты добавлен в розыгрыш. Удачи! 🍀",
+        confirmed=True,
+        parse_mode="Markdown"
+    )
+
+async def fail_txid_job(job, error):
+    """Проверка упала или прервана остановкой бота: сообщение «Проверяю транзакцию...» не должно висеть"""
+    if isinstance(error, ShutdownInterrupted):
+        metrics.VERIFICATIONS.labels("interrupted").inc()
+        reason = "⚠️ Проверка прервана перезапуском бота."
+    else:
+        metrics.VERIFICATIONS.labels("error").inc()
+        reason = "⚠️ Не удалось завершить проверку из-за временной ошибки."
+    text = f"{reason}\nОтправь TXID ещё раз через минуту — если билет уже выдан, я так и отвечу."
+    for chat_id, message_id, _ in [(job.chat_id, job.message_id, job.user_id)] + job.followers:
+        try:
+            await bot.edit_message_text(text, chat_id, message_id)
+        except TelegramAPIError as e:
+            logging.warning(f"⚠️ Не удалось обновить сообщение о проверке {job.txid}: {e}")
+
+async def wait_txid_blocks(job, count):
+    """Пауза перед повторной проверкой: count новых блоков в сети платежа"""
+    await payment_verifiers[job.network].wait_blocks(count)
+
+# Повторы по мере выхода блоков, отказы кэшируются, см. verify_queue.py
+verification_queue = VerificationQueue(
+    verify_txid_job,
+    finish_txid_job,
+    wait_txid_blocks,
+    fail_txid_job,
+    workers=int(os.getenv("VERIFY_WORKERS", 8)),
+    max_wait=int(os.getenv("VERIFY_MAX_WAIT", 600)),
+    not_found_ttl=int(os.getenv("VERIFY_NOT_FOUND_TTL", 60)),
+    invalid_ttl=int(os.getenv("VERIFY_INVALID_TTL", 600))
+)
+
+# === МЕТРИКИ ===
+# Все обработчики уже зарегистрированы — оборачиваем их замером времени
+metrics.instrument_dispatcher(dp)
 
 # === WEBHOOK ЧАСТЬ ===
 app = FastAPI()
 
+# Апдейты обрабатываются в фоне, вебхук отвечает Telegram сразу, см. update_queue.py
+updates = UpdateQueue(
+    dp,
+    workers=int(os.getenv("UPDATE_WORKERS", 16)),
+    maxsize=int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+)
+
 @app.post(f"/webhook/{API_TOKEN}")
 async def telegram_webhook(request: Request):
     update_data = await request.json()
-    update = types.Update.to_object(update_data)
-    Bot.set_current(bot)
-    await dp.process_update(update)
+    if not updates.submit(update_data):
+        # Очередь полна — Telegram повторит доставку позже
+        logging.warning(f"⚠️ Очередь апдейтов заполнена, апдейт {update_data.get('update_id')} отклонён")
+        return JSONResponse({"ok": False}, status_code=503)
     return {"ok": True}
 
+metrics.UPDATE_QUEUE_DEPTH.set_function(lambda: updates.depth)
+metrics.OUTBOX_PENDING.set_function(outbox.pending)
+metrics.VERIFY_QUEUE_PENDING.set_function(lambda: verification_queue.pending_count)
+
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """Метрики в формате Prometheus; при заданном METRICS_TOKEN нужен заголовок Authorization: Bearer"""
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("authorization") != f"Bearer {token}":
+        return Response(status_code=401)
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "time": time.time()}
+    return {"status": "healthy", "time": time.time(), "updates": updates.metrics(), "rpc": rpc.status()}
 
 @app.get("/")
 async def root():
     return {"status": "Crypto Fortuna Bot is running on Render"}
 
+@app.on_event("startup")
+async def init_db():
+    await database.init_pool(DATABASE_URL)
+    # Схема уже актуальна — это один запрос, см. migrations.py
+    await migrations.migrate()
+    await live_round.warm()
+
 @app.on_event("startup")
 async def on_startup():
     render_url = os.getenv("RENDER_EXTERNAL_URL")
@@ -936,25 +1141,31 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     await bot.delete_webhook()
+    await updates.stop()
+    await verification_queue.stop()
+    await live_round.stop()
+    await draw_scheduler.stop()
+    await broadcaster.stop()
+    await outbox.stop()
+    await chain_leader.stop()
+    await block_follower.stop()
+    for verifier in payment_verifiers.values():
+        await verifier.close()
+    await rpc.close()
+    await database.close_pool()
+    await bot.session.close()
+
+# Запускаем фоновые задачи при старте бота
+@app.on_event("startup")
+async def start_background_tasks():
+    outbox.start()
+    updates.start()
+    broadcaster.start_resuming()
+    block_follower.start()
+    chain_leader.start()
+    verification_queue.start()
+    draw_scheduler.start()
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
-
-# === ПИНГ БАЗЫ ДАННЫХ (чтобы Supabase не засыпала) ===
-async def keep_db_alive():
-    """Каждый час пингует базу, чтобы она не засыпала"""
-    while True:
-        await asyncio.sleep(3600)  # ждём 1 час
-        try:
-            # Простой запрос к базе
-            cursor.execute("SELECT 1")
-            logging.info("✅ Пинг базы данных выполнен")
-        except Exception as e:
-            logging.error(f"❌ Ошибка пинга БД: {e}")
-
-# Запускаем фоновую задачу при старте бота
-@app.on_event("startup")
-async def start_background_tasks():
-    asyncio.create_task(keep_db_alive())
-    logging.info("✅ Задача пинга базы данных запущена")
\ No newline at end of file
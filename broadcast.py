@@ -0,0 +1,262 @@
+import json
+import time
+import asyncio
+import logging
+import database
+from outbox import BULK
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated, TelegramAPIError
+
+# Личные рассылки о старте и итогах розыгрыша.
+#
+# Получатели — все, кто запускал бота (referral_sources), плюс участники раунда.
+# При первом запуске рассылки они одним INSERT … SELECT копируются в
+# broadcast_deliveries со статусом pending; дальше рассылка читает их короткими
+# запросами по ключу user_id и не держит транзакцию, пока идёт отправка, — иначе
+# DETACH секции и LOCK TABLE participants в розыгрыше ждали бы её до таймаута.
+# Статус каждой доставки записывается пачками; рассылка в статусе running после
+# перезапуска продолжается с того же места и пропускает уже доставленных, так что
+# при падении процесса повторно могут уйти только последние несколько сообщений.
+# Рассылку ведёт процесс, взявший по ней сессионный advisory lock. Каждый процесс
+# раз в resume_interval пробует подхватить незавершённые рассылки, поэтому рассылку
+# упавшего процесса доводит другой.
+#
+# Отправка идёт через Outbox с приоритетом BULK: ответы пользователям и посты
+# в канал обгоняют рассылку, а лимиты Telegram соблюдаются общей очередью.
+
+SQL_PREPARE_RECIPIENTS = """
+    WITH round_tickets AS (
+        SELECT user_id, ticket_number FROM participants WHERE round_id = $2 AND user_id IS NOT NULL
+        UNION ALL
+        SELECT user_id, ticket_number FROM participants_archive WHERE round_id = $2 AND user_id IS NOT NULL
+    ),
+    recipients AS (
+        SELECT user_id FROM referral_sources WHERE user_id IS NOT NULL
+        UNION
+        SELECT user_id FROM round_tickets
+    )
+    INSERT INTO broadcast_deliveries (broadcast_id, user_id, ticket_number, status)
+    SELECT DISTINCT ON (r.user_id) $1, r.user_id, t.ticket_number, 'pending'
+    FROM recipients r
+    LEFT JOIN round_tickets t ON t.user_id = r.user_id
+    ON CONFLICT (broadcast_id, user_id) DO NOTHING
+"""
+
+SQL_PENDING_PAGE = """
+    SELECT user_id, ticket_number FROM broadcast_deliveries
+    WHERE broadcast_id = $1 AND status = 'pending' AND user_id > $2
+    ORDER BY user_id
+    LIMIT $3
+"""
+
+SQL_SAVE_DELIVERIES = """
+    UPDATE broadcast_deliveries d SET status = r.status, error = r.error
+    FROM unnest($2::bigint[], $3::text[], $4::text[]) AS r(user_id, status, error)
+    WHERE d.broadcast_id = $1 AND d.user_id = r.user_id
+"""
+
+SQL_LOCK = "SELECT pg_try_advisory_lock(hashtext('broadcast'), $1)"
+SQL_UNLOCK = "SELECT pg_advisory_unlock(hashtext('broadcast'), $1)"
+
+
+class Broadcaster:
+    """Запускает и продолжает рассылки.
+
+    renderers — {вид рассылки: функция(payload, ticket_number) -> текст}; ticket_number
+    равен None для тех, кто не участвовал в раунде. Функции не должны ходить в базу:
+    они вызываются для каждого получателя. Текст уходит без разметки, чтобы
+    username с подчёркиваниями не ломал Markdown.
+    """
+
+    def __init__(self, outbox, renderers, workers=50, flush_every=200, flush_interval=2, page_size=500,
+                 resume_interval=30):
+        self.outbox = outbox
+        self.renderers = renderers
+        self.workers = workers
+        self.page_size = page_size
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.resume_interval = resume_interval
+        self._tasks = {}
+        self._resume_task = None
+
+    async def start(self, kind, round_id, payload):
+        """Создаёт рассылку и запускает её в фоне. Возвращает id рассылки"""
+        broadcast_id = await database.fetchval(
+            "INSERT INTO broadcasts (kind, round_id, payload) VALUES ($1, $2, $3) RETURNING id",
+            kind, round_id, json.dumps(payload)
+        )
+        self._spawn(broadcast_id, kind, round_id, payload)
+        return broadcast_id
+
+    async def start_once(self, kind, round_id, payload):
+        """Как start, но не создаёт вторую рассылку того же вида по раунду.
+
+        Для шагов розыгрыша, которые после перезапуска могут выполниться повторно.
+        Возвращает id новой рассылки или None, если она уже была.
+        """
+        exists = await database.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM broadcasts WHERE kind = $1 AND round_id = $2)", kind, round_id
+        )
+        if exists:
+            return None
+        return await self.start(kind, round_id, payload)
+
+    async def resume(self):
+        """Продолжает рассылки, прерванные перезапуском или падением другого процесса"""
+        rows = await database.fetch("SELECT id, kind, round_id, payload FROM broadcasts WHERE status = 'running'")
+        for row in rows:
+            if row['id'] not in self._tasks:
+                self._spawn(row['id'], row['kind'], row['round_id'], json.loads(row['payload']), resumed=True)
+
+    def start_resuming(self):
+        """Запускает фоновый цикл resume()"""
+        self._resume_task = asyncio.create_task(self._resume_loop())
+
+    async def stop(self):
+        """Останавливает рассылки; они останутся в статусе running и продолжатся при старте"""
+        tasks = list(self._tasks.values())
+        if self._resume_task:
+            tasks.append(self._resume_task)
+            self._resume_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _resume_loop(self):
+        while True:
+            try:
+                await self.resume()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ Ошибка при продолжении рассылок: {type(e).__name__}: {e}")
+            await asyncio.sleep(self.resume_interval)
+
+    def _spawn(self, broadcast_id, kind, round_id, payload, resumed=False):
+        task = asyncio.create_task(self._run(broadcast_id, kind, round_id, payload, resumed))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id, kind, round_id, payload, resumed):
+        # Блокировка живёт, пока открыто соединение: упавший процесс отдаёт рассылку другому
+        async with database.acquire() as lock_conn:
+            if not await lock_conn.fetchval(SQL_LOCK, broadcast_id):
+                logging.debug(f"Рассылку #{broadcast_id} уже ведёт другой процесс")
+                return
+            if resumed:
+                logging.info(f"🔁 Продолжаю рассылку #{broadcast_id} ({kind})")
+            try:
+                await self._prepare(lock_conn, broadcast_id, round_id)
+                await self._send_all(broadcast_id, kind, payload)
+            except Exception as e:
+                logging.error(f"❌ Рассылка #{broadcast_id} прервана, продолжится позже: {type(e).__name__}: {e}")
+            finally:
+                if not lock_conn.is_closed():
+                    await lock_conn.fetchval(SQL_UNLOCK, broadcast_id)
+
+    @staticmethod
+    async def _prepare(conn, broadcast_id, round_id):
+        """Один раз копирует получателей рассылки в broadcast_deliveries"""
+        async with conn.transaction():
+            prepared = await conn.fetchval("SELECT prepared FROM broadcasts WHERE id = $1 FOR UPDATE", broadcast_id)
+            if prepared:
+                return
+            await conn.execute(SQL_PREPARE_RECIPIENTS, broadcast_id, round_id)
+            await conn.execute("UPDATE broadcasts SET prepared = TRUE WHERE id = $1", broadcast_id)
+
+    async def _send_all(self, broadcast_id, kind, payload):
+        render = self.renderers[kind]
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        results = []
+        flush_needed = asyncio.Event()
+        flushing = set()
+        started = time.monotonic()
+
+        async def flush():
+            if not results:
+                return
+            batch = results[:]
+            results.clear()
+            sent = sum(1 for _, status, _ in batch if status == 'sent')
+            try:
+                async with database.transaction() as conn:
+                    await conn.execute(
+                        SQL_SAVE_DELIVERIES, broadcast_id,
+                        [r[0] for r in batch], [r[1] for r in batch], [r[2] for r in batch]
+                    )
+                    await conn.execute(
+                        "UPDATE broadcasts SET sent = sent + $2, failed = failed + $3 WHERE id = $1",
+                        broadcast_id, sent, len(batch) - sent
+                    )
+            except Exception:
+                # Пачка запишется со следующей, иначе эти получатели остались бы pending
+                results[:0] = batch
+                raise
+
+        async def flusher():
+            while True:
+                try:
+                    await asyncio.wait_for(flush_needed.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                flush_needed.clear()
+                # Запись пачки доводится до конца даже при остановке рассылки
+                task = asyncio.create_task(flush())
+                flushing.add(task)
+                task.add_done_callback(flushing.discard)
+                try:
+                    await asyncio.shield(task)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f"❌ Рассылка #{broadcast_id}: ошибка записи статусов: {type(e).__name__}: {e}")
+
+        async def worker():
+            while True:
+                user_id, ticket_number = await queue.get()
+                try:
+                    await self.outbox.submit("sendMessage", {
+                        "chat_id": user_id,
+                        "text": render(payload, ticket_number),
+                    }, priority=BULK)
+                    results.append((user_id, 'sent', None))
+                except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+                    results.append((user_id, 'blocked', str(e)))
+                except (TelegramAPIError, asyncio.TimeoutError) as e:
+                    results.append((user_id, 'failed', str(e)))
+                except Exception as e:
+                    # Любая другая ошибка не должна останавливать воркер, иначе queue.join() не дождётся
+                    logging.error(f"❌ Рассылка #{broadcast_id}, получатель {user_id}: {type(e).__name__}: {e}")
+                    results.append((user_id, 'failed', f"{type(e).__name__}: {e}"))
+                finally:
+                    queue.task_done()
+                if len(results) >= self.flush_every:
+                    flush_needed.set()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        flush_task = asyncio.create_task(flusher())
+        try:
+            last_user_id = 0
+            while True:
+                rows = await database.fetch(SQL_PENDING_PAGE, broadcast_id, last_user_id, self.page_size)
+                if not rows:
+                    break
+                for row in rows:
+                    await queue.put((row['user_id'], row['ticket_number']))
+                last_user_id = rows[-1]['user_id']
+            await queue.join()
+        finally:
+            for task in workers + [flush_task]:
+                task.cancel()
+            await asyncio.gather(*workers, flush_task, return_exceptions=True)
+            await asyncio.gather(*flushing, return_exceptions=True)
+            await flush()
+
+        counts = await database.fetchrow(
+            "UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = $1 RETURNING sent, failed",
+            broadcast_id
+        )
+        logging.info(
+            f"✅ Рассылка #{broadcast_id} ({kind}) завершена за {time.monotonic() - started:.0f} с: "
+            f"доставлено {counts['sent']}, не доставлено {counts['failed']}"
+        )
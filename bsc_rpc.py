@@ -0,0 +1,109 @@
+import time
+import asyncio
+import itertools
+import aiohttp
+import metrics
+import tracing
+
+
+class JsonRpcError(Exception):
+    """Ошибка транспорта или ответ JSON-RPC с полем error"""
+
+
+class ProviderError(JsonRpcError):
+    """Провайдер не ответил: сеть, таймаут, HTTP-ошибка. Запрос можно повторить у другого"""
+
+
+class BscRpcClient:
+    """Долгоживущий JSON-RPC клиент для MegaNode с пулом keep-alive соединений.
+
+    Сессия создаётся лениво при первом запросе и переиспользуется, поэтому
+    TLS-рукопожатие происходит один раз на соединение, а не на каждый вызов.
+    """
+
+    def __init__(self, url, timeout=10, pool_size=20):
+        self.url = url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        self._ids = itertools.count(1)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _post(self, payload, timeout):
+        session = self._get_session()
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        try:
+            async with session.post(self.url, json=payload, timeout=client_timeout) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    raise ProviderError(f"HTTP {response.status}: {text[:200]}")
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise ProviderError(f"{type(e).__name__}: {e}") from e
+
+    async def _observed_post(self, payload, timeout, methods, kind):
+        """_post с замером времени и ошибок для каждого метода запроса"""
+        started = time.perf_counter()
+        metrics.RPC_IN_FLIGHT.inc()
+        try:
+            with tracing.span(f"rpc {kind} {', '.join(sorted(methods))}"):
+                return await self._post(payload, timeout)
+        except JsonRpcError:
+            for method in methods:
+                metrics.RPC_ERRORS.labels(method, kind).inc()
+            raise
+        finally:
+            metrics.RPC_IN_FLIGHT.dec()
+            elapsed = time.perf_counter() - started
+            for method in methods:
+                metrics.RPC_LATENCY.labels(method, kind).observe(elapsed)
+
+    async def call(self, method, params=None, timeout=None):
+        """Один вызов метода, возвращает поле result"""
+        payload = {"jsonrpc": "2.0", "method": method, "params": params or [], "id": next(self._ids)}
+        data = await self._observed_post(payload, timeout, (method,), "single")
+        if data.get("error"):
+            metrics.RPC_ERRORS.labels(method, "single").inc()
+            raise JsonRpcError(f"{method}: {data['error']}")
+        return data.get("result")
+
+    async def batch(self, calls, timeout=None, return_exceptions=False):
+        """Пакетный вызов за один HTTP-запрос.
+
+        calls — список пар (method, params). Результаты возвращаются в том же порядке.
+        С return_exceptions=True ошибка отдельного вызова возвращается на его месте
+        как JsonRpcError, а не прерывает весь batch.
+        """
+        payload = [
+            {"jsonrpc": "2.0", "method": method, "params": params or [], "id": next(self._ids)}
+            for method, params in calls
+        ]
+        data = await self._observed_post(payload, timeout, {method for method, _ in calls}, "batch")
+        if not isinstance(data, list):
+            raise ProviderError(f"Неожиданный ответ на batch-запрос: {str(data)[:200]}")
+
+        by_id = {item.get("id"): item for item in data}
+        results = []
+        for request in payload:
+            item = by_id.get(request["id"])
+            if item is None:
+                error = JsonRpcError(f"{request['method']}: нет ответа в batch")
+            elif item.get("error"):
+                metrics.RPC_ERRORS.labels(request["method"], "batch").inc()
+                error = JsonRpcError(f"{request['method']}: {item['error']}")
+            else:
+                results.append(item.get("result"))
+                continue
+            if not return_exceptions:
+                raise error
+            results.append(error)
+        return results
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,147 @@
+import os
+import time
+import logging
+from contextlib import asynccontextmanager
+import asyncpg
+import metrics
+
+# Пул соединений создаётся в startup-хуке FastAPI (asyncpg требует запущенный event loop).
+# Каждый запрос берёт своё соединение из пула, поэтому обработчики не делят один курсор.
+#
+# asyncpg подготавливает каждый запрос на соединении один раз и дальше переиспользует
+# prepared statement из кэша соединения.
+#
+# Нужно прямое подключение к Postgres или pgbouncer в session-режиме (у Supabase —
+# порт 5432, не 6543). Выбор ведущего процесса (leader.py), единственность
+# планировщика розыгрышей (draws.py) и рассылок (broadcast.py) держатся на
+# сессионных advisory lock, которые живут, пока открыто соединение. В
+# transaction-режиме пулер отдаёт каждую транзакцию произвольному серверному
+# соединению, и такие блокировки перестают что-либо гарантировать.
+
+pool = None
+
+# Соединение, простаивавшее дольше этого времени, проверяется перед выдачей
+HEALTHCHECK_IDLE = float(os.getenv("DB_HEALTHCHECK_IDLE", 30))
+
+_last_used = {}
+
+# === ГОРЯЧИЕ ЗАПРОСЫ ===
+SQL_TXID_EXISTS = "SELECT 1 FROM transactions WHERE txid = $1"
+SQL_OPEN_ROUND = "SELECT id FROM rounds WHERE status = 'open'"
+# Запросы по текущему раунду фильтруют по round_id, поэтому читают только его секцию
+SQL_PARTICIPANT_EXISTS = f"SELECT 1 FROM participants WHERE round_id = ({SQL_OPEN_ROUND}) AND (username = $1 OR user_id = $2)"
+SQL_COUNT_PARTICIPANTS = f"SELECT COUNT(*) FROM participants WHERE round_id = ({SQL_OPEN_ROUND})"
+# Постраничный вывод по ключу (keyset): каждая страница — индексный проход по PK секции
+SQL_PARTICIPANTS_PAGE_AFTER = """
+    SELECT ticket_number, username FROM participants
+    WHERE round_id = $1 AND ticket_number > $2
+    ORDER BY ticket_number
+    LIMIT $3
+"""
+SQL_PARTICIPANTS_PAGE_BEFORE = """
+    SELECT ticket_number, username FROM (
+        SELECT ticket_number, username FROM participants
+        WHERE round_id = $1 AND ticket_number < $2
+        ORDER BY ticket_number DESC
+        LIMIT $3
+    ) page
+    ORDER BY ticket_number
+"""
+# Номер билета выдаётся атомарно счётчиком открытого раунда в том же запросе, что и вставка участника.
+# Если вставка падает (участник уже есть), откатывается и увеличение счётчика — номера идут без дыр.
+SQL_INSERT_PARTICIPANT = """
+    WITH ticket AS (
+        UPDATE rounds SET last_ticket = last_ticket + 1 WHERE status = 'open' RETURNING id, last_ticket
+    )
+    INSERT INTO participants (round_id, ticket_number, username, user_id)
+    SELECT id, last_ticket, $1, $2 FROM ticket
+    RETURNING round_id, ticket_number
+"""
+
+
+async def init_pool(dsn):
+    global pool
+    pool = await asyncpg.create_pool(
+        dsn,
+        min_size=int(os.getenv("DB_POOL_MIN", 1)),
+        max_size=int(os.getenv("DB_POOL_MAX", 10)),
+        max_inactive_connection_lifetime=float(os.getenv("DB_MAX_IDLE", 300)),
+        statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100)),
+        command_timeout=float(os.getenv("DB_COMMAND_TIMEOUT", 30)),
+        init=_init_connection
+    )
+    metrics.DB_CONNECTIONS_IN_USE.set_function(lambda: pool.get_size() - pool.get_idle_size() if pool else 0)
+    logging.info("✅ Пул соединений с базой данных создан")
+    return pool
+
+
+async def _init_connection(conn):
+    # Время и ошибки каждого запроса уходят в метрики /metrics
+    conn.add_query_logger(metrics.log_query)
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+    _last_used.clear()
+
+
+async def _is_healthy(conn):
+    pid = conn.get_server_pid()
+    last_used = _last_used.get(pid)
+    if last_used is not None and time.monotonic() - last_used < HEALTHCHECK_IDLE:
+        return True
+    try:
+        await conn.fetchval("SELECT 1", timeout=5)
+        return True
+    except (asyncpg.PostgresError, OSError, TimeoutError) as e:
+        logging.warning(f"⚠️ Соединение с БД не прошло проверку, пересоздаём: {e}")
+        return False
+
+
+@asynccontextmanager
+async def acquire():
+    """Берёт из пула проверенное соединение на время одного обработчика"""
+    conn = await pool.acquire()
+    if not await _is_healthy(conn):
+        _last_used.pop(conn.get_server_pid(), None)
+        conn.terminate()
+        await pool.release(conn)
+        # Пул сам переподключит закрытое соединение
+        conn = await pool.acquire()
+    try:
+        yield conn
+    finally:
+        if not conn.is_closed():
+            _last_used[conn.get_server_pid()] = time.monotonic()
+        await pool.release(conn)
+
+
+@asynccontextmanager
+async def transaction():
+    """Соединение из пула с открытой транзакцией"""
+    async with acquire() as conn:
+        async with conn.transaction():
+            yield conn
+
+
+async def fetch(query, *args):
+    async with acquire() as conn:
+        return await conn.fetch(query, *args)
+
+
+async def fetchrow(query, *args):
+    async with acquire() as conn:
+        return await conn.fetchrow(query, *args)
+
+
+async def fetchval(query, *args):
+    async with acquire() as conn:
+        return await conn.fetchval(query, *args)
+
+
+async def execute(query, *args):
+    async with acquire() as conn:
+        return await conn.execute(query, *args)
@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import database
+import rounds
+import stats
+from bsc_rpc import JsonRpcError
+
+# Розыгрыш — это запись в таблице draws, которая проходит состояния:
+#
+#   announced     — раунд заморожен, номер целевого блока выбран, пост в канал ещё не вышел;
+#   waiting_block — анонс опубликован, ждём хэш целевого блока BSC;
+#   resolved      — победитель определён, записан в draw_history и агрегаты статистики;
+#   archived      — итог опубликован, секция раунда перенесена в архив.
+#
+# Ошибка шага не двигает состояние: шаг повторяется в следующем цикле. После
+# max_attempts ошибок подряд розыгрыш переходит в failed. Раунд остаётся
+# замороженным, и /start_draw по нему либо продолжает упавший розыгрыш с того же
+# шага, либо начинает новый — второе только если анонс ещё ни разу не отправлялся.
+#
+# Целевой блок нельзя менять после того, как он мог попасть в канал: иначе, увидев
+# хэш блока, можно отменить неугодный итог и перезапустить розыгрыш с новым блоком.
+# Поэтому перед первой отправкой анонса ставится announce_attempted, и с этого
+# момента розыгрыш нельзя отменить (cancelled), а упавший продолжается с тем же блоком.
+#
+# Переходы выполняет фоновый DrawScheduler. Его цикл берёт сессионный advisory lock,
+# поэтому при нескольких воркерах и процессах розыгрыш ведёт ровно один из них; если
+# процесс упал, Postgres снимает блокировку вместе с соединением, и розыгрыш
+# подхватывает следующий — с того состояния, которое успело записаться. Изменения
+# в базе и смена состояния идут одной транзакцией. Посты в канал и запуск рассылок
+# транзакцией не покрыть: пост с итогом отмечается в result_posted сразу после
+# отправки, поэтому повториться он может, только если процесс упал между этими
+# двумя шагами; рассылки защищены от повтора в Broadcaster.start_once.
+#
+# Одновременно активен (не archived, failed или cancelled) не больше одного
+# розыгрыша — это гарантирует уникальный частичный индекс по draws, а не флаг
+# в памяти процесса.
+
+ANNOUNCED = "announced"
+WAITING_BLOCK = "waiting_block"
+RESOLVED = "resolved"
+ARCHIVED = "archived"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+SQL_ACTIVE_DRAW = "SELECT * FROM draws WHERE state NOT IN ('archived', 'failed', 'cancelled') ORDER BY id LIMIT 1"
+SQL_LOCK = "SELECT pg_try_advisory_lock(hashtext('draws'))"
+SQL_UNLOCK = "SELECT pg_advisory_unlock(hashtext('draws'))"
+
+
+async def start_draw(conn, round_id, round_number, target_block, chat_id):
+    """Запускает розыгрыш замороженного раунда. Вызывать в транзакции begin_draw.
+
+    Если прошлый розыгрыш раунда упал после отправки анонса, он продолжается с того же шага
+    и с тем же целевым блоком. Иначе создаётся новый. Возвращает (draw, resumed).
+    Если уже идёт другой розыгрыш, бросает asyncpg UniqueViolationError.
+    """
+    last = await conn.fetchrow(
+        "SELECT * FROM draws WHERE round_id = $1 ORDER BY id DESC LIMIT 1 FOR UPDATE", round_id
+    )
+    if last is not None and last['state'] == FAILED and last['announce_attempted']:
+        draw = await conn.fetchrow("""
+            UPDATE draws SET state = failed_state, failed_state = NULL, attempts = 0, last_error = NULL,
+                chat_id = $2, updated_at = CURRENT_TIMESTAMP
+            WHERE id = $1
+            RETURNING *
+        """, last['id'], chat_id)
+        return draw, True
+    draw = await conn.fetchrow("""
+        INSERT INTO draws (round_id, round_number, target_block, chat_id)
+        VALUES ($1, $2, $3, $4)
+        RETURNING *
+    """, round_id, round_number, target_block, chat_id)
+    return draw, False
+
+
+async def cancel_draw():
+    """Отменяет активный розыгрыш, пока анонс с целевым блоком не отправлялся.
+
+    Возвращает отменённую запись или None. Условие стоит в самом UPDATE: он ждёт
+    блокировку строки, если планировщик как раз ставит announce_attempted, и после
+    неё перепроверяет условие.
+    """
+    return await database.fetchrow("""
+        UPDATE draws SET state = 'cancelled', updated_at = CURRENT_TIMESTAMP
+        WHERE state = 'announced' AND NOT announce_attempted
+        RETURNING *
+    """)
+
+
+async def get_active_draw():
+    return await database.fetchrow(SQL_ACTIVE_DRAW)
+
+
+def winner_index(block_hash, tickets_count):
+    """Позиция победителя (с нуля) в списке билетов по возрастанию номера: хэш блока по модулю числа билетов.
+
+    Номера билетов могут идти не с 1 или с пропусками (перенесённые старые раунды),
+    поэтому публикуется и проверяется именно позиция, а не номер.
+    """
+    return int(block_hash, 16) % tickets_count
+
+
+def pick_winner(block_hash, tickets):
+    """Билет-победитель; tickets отсортированы по ticket_number"""
+    return tickets[winner_index(block_hash, len(tickets))]
+
+
+class DrawScheduler:
+    """Фоновый цикл, который доводит активный розыгрыш до архива.
+
+    Действия, видимые пользователям, передаются корутинами:
+    announce(draw, tickets) — анонс в канал и рассылка о старте;
+    publish_result(draw, tickets) — пост с итогом в канал;
+    on_archived(draw) — рассылка итогов и сброс кэшей;
+    on_stalled(draw, error) — первая ошибка шага (шаг будет повторён);
+    on_failed(draw, error) — max_attempts ошибок подряд, розыгрыш переведён в failed.
+    tickets — строки participants раунда (ticket_number, username) по возрастанию билета.
+    """
+
+    def __init__(self, block_follower, announce, publish_result, on_archived, on_stalled, on_failed,
+                 entry_fee, commission=0.10, poll_interval=5, block_timeout=180, max_attempts=10):
+        self._follower = block_follower
+        self._announce = announce
+        self._publish_result = publish_result
+        self._on_archived = on_archived
+        self._on_stalled = on_stalled
+        self._on_failed = on_failed
+        self.entry_fee = entry_fee
+        self.commission = commission
+        self.poll_interval = poll_interval
+        self.block_timeout = block_timeout
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logging.info("✅ Планировщик розыгрышей запущен")
+
+    async def stop(self):
+        """Останавливает цикл; недоведённый розыгрыш продолжится при следующем старте"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        """Новый розыгрыш создан — не ждать следующего опроса"""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ Ошибка планировщика розыгрышей: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _tick(self):
+        # Без активного розыгрыша — один запрос, блокировку не трогаем
+        if await get_active_draw() is None:
+            return
+        async with database.acquire() as conn:
+            if not await conn.fetchval(SQL_LOCK):
+                return  # розыгрыш ведёт другой процесс
+            try:
+                while True:
+                    # Перечитываем под блокировкой: прошлый владелец мог продвинуть розыгрыш
+                    draw = await conn.fetchrow(SQL_ACTIVE_DRAW)
+                    if draw is None:
+                        return
+                    try:
+                        await self._advance(conn, draw)
+                    except Exception as e:
+                        await self._record_failure(conn, draw, e)
+                        return
+            finally:
+                await conn.fetchval(SQL_UNLOCK)
+
+    async def _advance(self, conn, draw):
+        """Выполняет один переход; ошибка оставляет розыгрыш в прежнем состоянии"""
+        if draw['state'] == ANNOUNCED:
+            if not draw['announce_attempted']:
+                # Отметка до отправки: после неё целевой блок может быть публичным
+                draw = await conn.fetchrow(
+                    "UPDATE draws SET announce_attempted = TRUE WHERE id = $1 AND state = $2 RETURNING *",
+                    draw['id'], ANNOUNCED
+                )
+                if draw is None:
+                    raise RuntimeError("розыгрыш отменён до анонса")
+            await self._announce(draw, await self._tickets(conn, draw))
+            await self._transition(conn, draw, WAITING_BLOCK)
+            return
+
+        if draw['state'] == WAITING_BLOCK:
+            try:
+                block_hash = await self._follower.wait_for_block(draw['target_block'], timeout=self.block_timeout)
+            except asyncio.TimeoutError:
+                raise JsonRpcError(f"блок {draw['target_block']} не получен за {self.block_timeout:.0f} с")
+            await self._resolve(conn, draw, block_hash)
+            return
+
+        if draw['state'] == RESOLVED:
+            if not draw['result_posted']:
+                await self._publish_result(draw, await self._tickets(conn, draw))
+                # Отметка пишется сразу после поста: если перенос в архив сорвётся,
+                # следующий цикл повторит только его, а не пост в канал
+                await conn.execute("UPDATE draws SET result_posted = TRUE WHERE id = $1", draw['id'])
+            async with conn.transaction():
+                # Секция раунда уходит в архив вместе со сменой состояния
+                await rounds.close_round(conn, draw['round_id'], draw['round_number'])
+                draw = await self._transition(conn, draw, ARCHIVED)
+            logging.info(f"✅ Розыгрыш #{draw['round_number']} завершён и перенесён в архив")
+            await self._on_archived(draw)
+            return
+
+        raise RuntimeError(f"неизвестное состояние {draw['state']}")
+
+    async def _record_failure(self, conn, draw, e):
+        error = str(e) or type(e).__name__
+        logging.error(f"❌ Розыгрыш #{draw['round_number']}, шаг {draw['state']}: {error}")
+        # Условие по состоянию: розыгрыш могли отменить, пока шаг выполнялся
+        draw = await conn.fetchrow("""
+            UPDATE draws SET attempts = attempts + 1, last_error = $3, updated_at = CURRENT_TIMESTAMP
+            WHERE id = $1 AND state = $2
+            RETURNING *
+        """, draw['id'], draw['state'], error)
+        if draw is None:
+            return
+        if draw['attempts'] >= self.max_attempts:
+            draw = await self._transition(conn, draw, FAILED, failed_state=draw['state'], last_error=error)
+            logging.error(f"❌ Розыгрыш #{draw['round_number']} остановлен после {draw['attempts']} ошибок подряд")
+            await self._on_failed(draw, error)
+        elif draw['attempts'] == 1:
+            await self._on_stalled(draw, error)
+
+    async def _resolve(self, conn, draw, block_hash):
+        tickets = await self._tickets(conn, draw)
+        winner = pick_winner(block_hash, tickets)
+        participants_count = len(tickets)
+        total_bank = participants_count * self.entry_fee
+        commission = total_bank * self.commission
+        winner_prize = total_bank - commission
+
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO draw_history
+                (round_number, participants_count, total_bank, winner_username, winner_ticket, winner_prize, commission, target_block, block_hash, round_id)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+            """,
+                draw['round_number'], participants_count, total_bank, winner['username'], winner['ticket_number'],
+                winner_prize, commission, draw['target_block'], block_hash, draw['round_id']
+            )
+            # Агрегаты для /stats, /weekly и /monthly обновляются в той же транзакции
+            await stats.record_draw(conn, participants_count, total_bank, commission, winner['username'], winner_prize)
+            await self._transition(
+                conn, draw, RESOLVED,
+                block_hash=block_hash,
+                participants_count=participants_count,
+                winner_ticket=winner['ticket_number'],
+                winner_username=winner['username'],
+                winner_prize=winner_prize,
+            )
+
+    @staticmethod
+    async def _tickets(conn, draw):
+        return await conn.fetch(
+            "SELECT ticket_number, username FROM participants WHERE round_id = $1 ORDER BY ticket_number",
+            draw['round_id']
+        )
+
+    @staticmethod
+    async def _transition(conn, draw, state, **fields):
+        """Переводит розыгрыш из текущего состояния в state, возвращает обновлённую запись"""
+        fields = {"last_error": None, **fields}
+        columns = ["state = $3", "updated_at = CURRENT_TIMESTAMP"]
+        if state != FAILED:
+            columns.append("attempts = 0")
+        columns += [f"{name} = ${i}" for i, name in enumerate(fields, start=4)]
+        row = await conn.fetchrow(
+            f"UPDATE draws SET {', '.join(columns)} WHERE id = $1 AND state = $2 RETURNING *",
+            draw['id'], draw['state'], state, *fields.values()
+        )
+        if row is None:
+            raise RuntimeError(f"Розыгрыш #{draw['round_number']} уже не в состоянии {draw['state']}")
+        return row
@@ -0,0 +1,100 @@
+import time
+import metrics
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from outbox import TokenBucket
+
+# Ограничение частоты запросов до обработчиков.
+#
+# У каждого пользователя свой token bucket на все сообщения и нажатия кнопок.
+# Сообщения, похожие на TXID, дополнительно проходят через свой bucket пользователя
+# и общий bucket на всех — они ведут к запросам в БД и RPC, и общий лимит держит
+# нас в квоте провайдера. Запрос сверх лимита отбрасывается до обработчика; в ответ
+# уходит заранее заготовленный текст, и не чаще раза в notice_interval секунд,
+# чтобы сам флуд не превращался в поток исходящих сообщений.
+
+FLOOD_TEXT = "⏳ Слишком много сообщений. Подожди немного и попробуй снова."
+TXID_FLOOD_TEXT = "⏳ Слишком много проверок TXID. Отправь хэш ещё раз через минуту."
+
+
+class FloodControl(BaseMiddleware):
+    def __init__(self, is_txid, user_rate=1, user_burst=5, txid_rate=1 / 10, txid_burst=3,
+                 global_txid_rate=20, global_txid_burst=50, notice_interval=10, exempt_ids=(), idle_ttl=600):
+        super().__init__()
+        self._is_txid = is_txid
+        self._user_limits = (user_rate, user_burst)
+        self._txid_limits = (txid_rate, txid_burst)
+        self._global_txid = TokenBucket(global_txid_rate, global_txid_burst)
+        self.notice_interval = notice_interval
+        self.exempt_ids = set(exempt_ids)
+        self.idle_ttl = idle_ttl
+        self._users = {}
+        self._txids = {}
+        self._noticed = {}
+        self._last_sweep = time.monotonic()
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        user_id = message.from_user.id if message.from_user else message.chat.id
+        if user_id in self.exempt_ids:
+            return
+        now = time.monotonic()
+        self._maybe_sweep(now)
+
+        if not self._take(self._users, self._user_limits, user_id, now):
+            await self._reject(message, user_id, now, FLOOD_TEXT, "user")
+
+        if message.text and not message.text.startswith("/") and self._is_txid(message.text.strip()):
+            txid_bucket = self._bucket(self._txids, self._txid_limits, user_id)
+            if txid_bucket.delay(now) > 0:
+                await self._reject(message, user_id, now, TXID_FLOOD_TEXT, "txid_user")
+            if self._global_txid.delay(now) > 0:
+                await self._reject(message, user_id, now, TXID_FLOOD_TEXT, "txid_global")
+            txid_bucket.take()
+            self._global_txid.take()
+
+    async def on_pre_process_callback_query(self, query: types.CallbackQuery, data: dict):
+        user_id = query.from_user.id
+        if user_id in self.exempt_ids:
+            return
+        now = time.monotonic()
+        self._maybe_sweep(now)
+        if not self._take(self._users, self._user_limits, user_id, now):
+            metrics.FLOOD_REJECTED.labels("user").inc()
+            # На нажатие кнопки нужно ответить в любом случае, иначе у пользователя крутятся часики
+            await query.answer(FLOOD_TEXT)
+            raise CancelHandler()
+
+    @staticmethod
+    def _bucket(buckets, limits, user_id):
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            bucket = buckets[user_id] = TokenBucket(*limits)
+        return bucket
+
+    def _take(self, buckets, limits, user_id, now):
+        bucket = self._bucket(buckets, limits, user_id)
+        if bucket.delay(now) > 0:
+            return False
+        bucket.take()
+        return True
+
+    async def _reject(self, message, user_id, now, text, kind):
+        metrics.FLOOD_REJECTED.labels(kind).inc()
+        if now - self._noticed.get(user_id, float("-inf")) >= self.notice_interval:
+            self._noticed[user_id] = now
+            await message.answer(text)
+        raise CancelHandler()
+
+    def _maybe_sweep(self, now):
+        """Забывает пользователей, чьи bucket'ы давно восстановились"""
+        if now - self._last_sweep < self.idle_ttl:
+            return
+        for buckets in (self._users, self._txids):
+            for user_id, bucket in list(buckets.items()):
+                if bucket.full:
+                    del buckets[user_id]
+        for user_id, noticed_at in list(self._noticed.items()):
+            if now - noticed_at >= self.notice_interval:
+                del self._noticed[user_id]
+        self._last_sweep = now
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import database
+
+# Выбор ведущего процесса среди воркеров и инстансов бота.
+#
+# Ведущим становится процесс, взявший сессионный advisory lock; пока соединение
+# с блокировкой живо, работа, которая должна идти в одном экземпляре (опрос
+# головы BSC, индексация переводов), выполняется только у него. Остальные раз
+# в retry_interval пробуют взять блокировку. Если ведущий упал, Postgres снимает
+# блокировку вместе с его соединением и её берёт следующий. Если у ведущего
+# оборвалось соединение с базой, он замечает это при проверке раз в
+# check_interval и останавливает свою работу — до этого момента работа может
+# ненадолго идти в двух процессах, поэтому она должна быть идемпотентной.
+
+
+class LeaderLock:
+    """Держит блокировку name; on_acquire() и on_release() — корутины запуска и остановки работы ведущего"""
+
+    def __init__(self, name, on_acquire, on_release, retry_interval=5, check_interval=5):
+        self.name = name
+        self._on_acquire = on_acquire
+        self._on_release = on_release
+        self.retry_interval = retry_interval
+        self.check_interval = check_interval
+        self.is_leader = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                async with database.acquire() as conn:
+                    if await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", self.name):
+                        await self._lead(conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ Ошибка блокировки ведущего процесса {self.name}: {type(e).__name__}: {e}")
+            await asyncio.sleep(self.retry_interval)
+
+    async def _lead(self, conn):
+        logging.info(f"👑 Процесс стал ведущим ({self.name})")
+        self.is_leader = True
+        try:
+            await self._on_acquire()
+            while True:
+                await asyncio.sleep(self.check_interval)
+                # Ошибка здесь — соединение потеряно, а с ним и блокировка
+                await conn.fetchval("SELECT 1", timeout=self.check_interval)
+        finally:
+            self.is_leader = False
+            # Остановка работы доводится до конца, даже если нас самих отменяют
+            await asyncio.shield(self._on_release())
+            if not conn.is_closed():
+                try:
+                    await conn.fetchval("SELECT pg_advisory_unlock(hashtext($1))", self.name)
+                except Exception:
+                    pass
+            logging.info(f"Процесс больше не ведущий ({self.name})")
@@ -0,0 +1,153 @@
+import math
+import time
+import asyncio
+import hashlib
+import logging
+import database
+
+
+class BloomFilter:
+    """Компактный фильтр Блума: «точно нет» или «возможно есть»"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+
+
+class LiveRound:
+    """Состояние открытого раунда в памяти процесса.
+
+    Прогревается из базы при старте и обновляется при каждой вставке участника
+    и смене раунда. Используется для быстрых отказов: «Банк» и проверки дублей
+    не ходят в базу, а база запрашивается только для подтверждения возможного
+    совпадения. Окончательную уникальность по-прежнему гарантируют ограничения
+    в базе, поэтому рассинхронизация между процессами не приводит к ошибкам.
+
+    Раунд могут сменить, а участников добавить в другом процессе: refresh() не чаще
+    раза в refresh_ttl секунд сверяет открытый раунд и его счётчик билетов с базой.
+
+    Фильтр TXID заполняется в фоне страницами по txid_page строк, чтобы старт не
+    зависел от размера таблицы transactions; пока он не готов, might_have_txid()
+    отвечает «возможно есть» и проверка идёт в базу.
+    """
+
+    def __init__(self, txid_capacity=1_000_000, refresh_ttl=5, txid_page=10_000):
+        self.round_id = None
+        self.count = 0
+        self.refresh_ttl = refresh_ttl
+        self.txid_page = txid_page
+        self._checked_at = float("-inf")
+        self.usernames = set()
+        self.user_ids = set()
+        self.txids = BloomFilter(txid_capacity)
+        self.txids_ready = False
+        self._warm_task = None
+
+    async def warm(self):
+        """Загружает открытый раунд и запускает фоновое заполнение фильтра TXID"""
+        await self.reload_round()
+        await self.stop()
+        self.txids_ready = False
+        self.txids.clear()
+        self._warm_task = asyncio.create_task(self._warm_txids())
+        logging.info(f"✅ Состояние раунда загружено: {self.count} участников")
+
+    async def stop(self):
+        if self._warm_task:
+            self._warm_task.cancel()
+            await asyncio.gather(self._warm_task, return_exceptions=True)
+            self._warm_task = None
+
+    async def _warm_txids(self):
+        started = time.monotonic()
+        loaded = 0
+        last_txid = ""
+        while True:
+            try:
+                # Постранично по первичному ключу: соединение берётся на одну страницу
+                rows = await database.fetch(
+                    "SELECT txid FROM transactions WHERE txid > $1 ORDER BY txid LIMIT $2", last_txid, self.txid_page
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ Ошибка заполнения фильтра TXID: {type(e).__name__}: {e}")
+                await asyncio.sleep(5)
+                continue
+            if not rows:
+                break
+            for row in rows:
+                self.txids.add(row['txid'])
+            loaded += len(rows)
+            last_txid = rows[-1]['txid']
+        self.txids_ready = True
+        logging.info(f"✅ Фильтр TXID заполнен: {loaded} TXID за {time.monotonic() - started:.1f} с")
+
+    async def reload_round(self):
+        """Перечитывает участников открытого раунда (после смены раунда)"""
+        async with database.acquire() as conn:
+            self.round_id = await conn.fetchval(database.SQL_OPEN_ROUND)
+            rows = await conn.fetch(
+                "SELECT username, user_id FROM participants WHERE round_id = $1", self.round_id
+            )
+        self.usernames = {row['username'] for row in rows}
+        self.user_ids = {row['user_id'] for row in rows if row['user_id'] is not None}
+        self.count = len(rows)
+        self._checked_at = time.monotonic()
+
+    async def refresh(self):
+        """Подтягивает смену раунда и число участников из других процессов (один запрос раз в refresh_ttl)"""
+        now = time.monotonic()
+        if now - self._checked_at < self.refresh_ttl:
+            return
+        self._checked_at = now
+        row = await database.fetchrow("SELECT id, last_ticket FROM rounds WHERE status = 'open'")
+        if row is None:
+            return
+        if row['id'] != self.round_id:
+            await self.reload_round()
+        else:
+            # Билеты раунда выдаются счётчиком без пропусков, поэтому last_ticket — число участников
+            self.count = row['last_ticket']
+
+    def count_for(self, round_id):
+        """Число участников, если round_id — открытый раунд, иначе None"""
+        return self.count if round_id == self.round_id else None
+
+    def might_have_txid(self, txid):
+        return not self.txids_ready or txid in self.txids
+
+    def might_have_participant(self, username, user_id=None):
+        return username in self.usernames or (user_id is not None and user_id in self.user_ids)
+
+    async def on_participant_added(self, round_id, username, user_id, txid=None):
+        if txid:
+            self.txids.add(txid)
+        if round_id != self.round_id:
+            # Раунд сменился в другом процессе — перечитываем
+            await self.reload_round()
+            return
+        self.usernames.add(username)
+        if user_id is not None:
+            self.user_ids.add(user_id)
+        self.count += 1
+
+    def on_txid_used(self, txid):
+        self.txids.add(txid)
@@ -0,0 +1,93 @@
+import re
+import time
+import functools
+import tracing
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Метрики Prometheus для /metrics: обработчики aiogram, запросы JSON-RPC к провайдерам BSC,
+# SQL-запросы и исходы проверки TXID.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Время обработчика aiogram", ["handler"], buckets=LATENCY_BUCKETS)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках aiogram", ["handler"])
+HANDLER_IN_FLIGHT = Gauge("bot_handler_in_flight", "Обработчики, выполняющиеся сейчас", ["handler"])
+
+RPC_LATENCY = Histogram("bsc_rpc_seconds", "Время запроса JSON-RPC", ["method", "kind"], buckets=LATENCY_BUCKETS)
+RPC_ERRORS = Counter("bsc_rpc_errors_total", "Ошибки JSON-RPC", ["method", "kind"])
+RPC_IN_FLIGHT = Gauge("bsc_rpc_in_flight", "Запросы JSON-RPC в полёте")
+RPC_PROVIDER_SCORE = Gauge("bsc_rpc_provider_score", "Оценка здоровья RPC-провайдера (вес маршрутизации)", ["provider"])
+RPC_PROVIDER_OPEN = Gauge("bsc_rpc_provider_open", "Circuit breaker провайдера разомкнут (1) или нет (0)", ["provider"])
+RPC_HEDGES = Counter("bsc_rpc_hedged_total", "Дублирующие (hedged) запросы к запасному провайдеру", ["method"])
+RPC_FAILOVERS = Counter("bsc_rpc_failovers_total", "Повторы запроса у другого провайдера после ошибки", ["provider"])
+
+SQL_LATENCY = Histogram("db_query_seconds", "Время SQL-запроса", ["statement"], buckets=LATENCY_BUCKETS)
+SQL_ERRORS = Counter("db_query_errors_total", "Ошибки SQL-запросов", ["statement"])
+DB_CONNECTIONS_IN_USE = Gauge("db_connections_in_use", "Соединения пула, выданные сейчас")
+
+VERIFICATIONS = Counter("txid_verifications_total", "Исходы проверки TXID", ["outcome"])
+FLOOD_REJECTED = Counter("bot_flood_rejected_total", "Сообщения, отброшенные ограничением частоты", ["limit"])
+
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue_depth", "Апдейты в очереди на обработку")
+OUTBOX_PENDING = Gauge("bot_outbox_pending", "Сообщения в очереди на отправку")
+VERIFY_QUEUE_PENDING = Gauge("txid_verify_pending", "TXID в очереди на проверку")
+
+
+def render():
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+# === ОБРАБОТЧИКИ ===
+def _timed_handler(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        HANDLER_IN_FLIGHT.labels(name).inc()
+        try:
+            with tracing.span(f"handler {name}"):
+                return await handler(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_IN_FLIGHT.labels(name).dec()
+            HANDLER_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+def instrument_dispatcher(dp):
+    """Оборачивает замером все зарегистрированные обработчики; вызывать после регистрации"""
+    for handlers in (dp.message_handlers, dp.callback_query_handlers):
+        for obj in handlers.handlers:
+            obj.handler = _timed_handler(obj.handler)
+
+
+# === SQL ===
+_statement_names = {}
+_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([a-z_][a-z0-9_]*)", re.I)
+
+
+def statement_name(query):
+    """Короткая метка запроса: «глагол таблица», например «SELECT transactions»"""
+    name = _statement_names.get(query)
+    if name is None:
+        verb = query.split(None, 1)[0].rstrip(";").upper() if query.strip() else "?"
+        match = _TABLE_RE.search(query)
+        table = re.sub(r"_r\d+$", "_rN", match.group(1).lower()) if match else ""
+        name = f"{verb} {table}".strip()
+        if len(_statement_names) < 1000:
+            _statement_names[query] = name
+    return name
+
+
+def log_query(record):
+    """Колбэк asyncpg add_query_logger: вызывается после каждого запроса на соединении"""
+    name = statement_name(record.query)
+    SQL_LATENCY.labels(name).observe(record.elapsed)
+    if record.exception is not None:
+        SQL_ERRORS.labels(name).inc()
+    # Колбэк выполняется в контексте запроса, поэтому попадает в текущий трейс
+    tracing.record(f"sql {name}", record.elapsed, type(record.exception).__name__ if record.exception else None)
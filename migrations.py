@@ -0,0 +1,455 @@
+import time
+import logging
+import asyncpg
+import database
+
+# Версионированные миграции схемы.
+#
+# Каждая миграция применяется один раз, номер записывается в schema_migrations.
+# При старте с актуальной схемой выполняется один запрос — MAX(version), — и больше
+# ничего. Если схема отстаёт, недостающие миграции применяются одной транзакцией
+# (каждая — в своей точке сохранения) под транзакционным advisory lock: его держит
+# первый процесс, остальные ждут и видят уже готовую схему. Блокировка снимается
+# вместе с транзакцией, поэтому не зависит от того, какое соединение выдаст пулер.
+#
+# Базы, созданные до появления schema_migrations, проходят все миграции с нуля,
+# поэтому миграции написаны идемпотентно (IF NOT EXISTS, заполнение только пустых таблиц).
+
+MIGRATIONS = []
+
+SQL_SCHEMA_VERSION = "SELECT MAX(version) FROM schema_migrations"
+
+
+def migration(version, name):
+    def register(apply):
+        MIGRATIONS.append((version, name, apply))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return apply
+    return register
+
+
+async def migrate():
+    """Доводит схему до последней версии, возвращает её номер"""
+    latest = MIGRATIONS[-1][0]
+    async with database.acquire() as conn:
+        try:
+            current = await conn.fetchval(SQL_SCHEMA_VERSION) or 0
+        except asyncpg.exceptions.UndefinedTableError:
+            current = 0
+        if current >= latest:
+            return current
+
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Пока ждали блокировку, миграции мог применить другой процесс
+            current = await conn.fetchval(SQL_SCHEMA_VERSION) or 0
+            for version, name, apply in MIGRATIONS:
+                if version <= current:
+                    continue
+                started = time.perf_counter()
+                async with conn.transaction():
+                    await apply(conn)
+                    await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                logging.info(f"✅ Миграция {version} ({name}) выполнена за {time.perf_counter() - started:.2f} с")
+                current = version
+    return current
+
+
+# === МИГРАЦИИ ===
+@migration(1, "rounds_and_participants")
+async def _rounds_and_participants(conn):
+    # Раунды: номер билета выдаётся счётчиком last_ticket своего раунда, см. rounds.py
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS rounds (
+            id SERIAL PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'open',
+            last_ticket INTEGER NOT NULL DEFAULT 0,
+            round_number INTEGER,
+            opened_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            closed_at TIMESTAMP
+        )
+    """)
+    # Открытым может быть только один раунд
+    await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS rounds_single_open_idx ON rounds (status) WHERE status = 'open'")
+
+    # Старая несекционированная таблица участников переносится в секцию первого раунда
+    legacy = await conn.fetchval(
+        "SELECT relkind = 'r' FROM pg_class WHERE oid = to_regclass('participants')"
+    )
+    if legacy:
+        # Если таблица уже существовала без ticket_number/user_id, добавляем колонки
+        await conn.execute("ALTER TABLE participants ADD COLUMN IF NOT EXISTS ticket_number INTEGER")
+        await conn.execute("ALTER TABLE participants ADD COLUMN IF NOT EXISTS user_id BIGINT")
+        await conn.execute("ALTER TABLE participants RENAME TO participants_legacy")
+        logging.info("✅ Таблица participants переносится в секционированную по раундам")
+
+    # Таблица участников (с номерами билетов), секции — по раундам
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS participants (
+            round_id INTEGER NOT NULL,
+            ticket_number INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            user_id BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (round_id, ticket_number),
+            UNIQUE (round_id, username)
+        ) PARTITION BY LIST (round_id)
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS participants_user_id_idx ON participants (user_id)")
+
+    # Архив разыгранных раундов: сюда присоединяются отсоединённые секции
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS participants_archive (
+            round_id INTEGER NOT NULL,
+            ticket_number INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            user_id BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY LIST (round_id)
+    """)
+
+    # Секции следующих раундов создаёт rounds.begin_draw, здесь — только для открытого
+    round_id = await conn.fetchval(database.SQL_OPEN_ROUND)
+    if round_id is None:
+        round_id = await conn.fetchval("INSERT INTO rounds (status) VALUES ('open') RETURNING id")
+    await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS participants_r{int(round_id)} "
+        f"PARTITION OF participants FOR VALUES IN ({int(round_id)})"
+    )
+
+    if legacy:
+        await conn.execute("""
+            INSERT INTO participants (round_id, ticket_number, username, user_id, created_at)
+            SELECT $1,
+                -- Участникам без номера — номера после самого большого, чтобы не совпасть с существующими
+                COALESCE(ticket_number, (SELECT COALESCE(MAX(ticket_number), 0) FROM participants_legacy)
+                    + ROW_NUMBER() OVER (PARTITION BY ticket_number IS NULL ORDER BY id)),
+                username, user_id, created_at
+            FROM participants_legacy
+            WHERE username IS NOT NULL
+        """, round_id)
+        await conn.execute("""
+            UPDATE rounds SET last_ticket = (SELECT COALESCE(MAX(ticket_number), 0) FROM participants WHERE round_id = $1)
+            WHERE id = $1
+        """, round_id)
+        await conn.execute("DROP TABLE participants_legacy")
+        await conn.execute("DROP TABLE IF EXISTS ticket_counter")
+
+
+@migration(2, "transactions")
+async def _transactions(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            txid TEXT PRIMARY KEY,
+            user_id BIGINT,
+            username TEXT,
+            amount REAL,
+            status TEXT DEFAULT 'confirmed',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS transactions_user_id_idx ON transactions (user_id)")
+
+    # Раунд, в котором транзакция дала билет. Сама таблица не секционируется:
+    # txid должен быть уникален во всех раундах, а первичный ключ секционированной
+    # таблицы обязан включать round_id
+    await conn.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS round_id INTEGER")
+    await conn.execute("CREATE INDEX IF NOT EXISTS transactions_round_id_idx ON transactions (round_id)")
+
+
+@migration(3, "draw_history")
+async def _draw_history(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS draw_history (
+            id SERIAL PRIMARY KEY,
+            round_number INTEGER,
+            draw_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            participants_count INTEGER,
+            total_bank REAL,
+            winner_username TEXT,
+            winner_prize REAL,
+            commission REAL,
+            target_block INTEGER,
+            block_hash TEXT
+        )
+    """)
+    # Колонки, которых не было в первых версиях таблицы
+    await conn.execute("ALTER TABLE draw_history ADD COLUMN IF NOT EXISTS winner_ticket INTEGER")
+    await conn.execute("ALTER TABLE draw_history ADD COLUMN IF NOT EXISTS round_id INTEGER")
+    await conn.execute("ALTER TABLE draw_history ADD COLUMN IF NOT EXISTS block_hash TEXT")
+
+
+@migration(4, "draw_stats")
+async def _draw_stats(conn):
+    # Накопительные итоги по всем розыгрышам (одна строка) для /stats
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS draw_totals (
+            id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            total_draws INTEGER NOT NULL DEFAULT 0,
+            total_participants BIGINT NOT NULL DEFAULT 0,
+            total_bank DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_commission DOUBLE PRECISION NOT NULL DEFAULT 0,
+            max_prize DOUBLE PRECISION NOT NULL DEFAULT 0,
+            max_bank DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+    """)
+
+    # Первичное заполнение из уже накопленной истории (только если строки ещё нет)
+    if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM draw_totals)"):
+        await conn.execute("""
+            INSERT INTO draw_totals
+                (id, total_draws, total_participants, total_bank, total_commission, max_prize, max_bank)
+            SELECT 1, COUNT(*), COALESCE(SUM(participants_count), 0), COALESCE(SUM(total_bank), 0),
+                   COALESCE(SUM(commission), 0), COALESCE(MAX(winner_prize), 0), COALESCE(MAX(total_bank), 0)
+            FROM draw_history
+        """)
+
+    # Дневные корзины статистики для /weekly, /monthly и /period
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS draw_daily_stats (
+            day DATE PRIMARY KEY,
+            draws INTEGER NOT NULL DEFAULT 0,
+            participants BIGINT NOT NULL DEFAULT 0,
+            total_bank DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_commission DOUBLE PRECISION NOT NULL DEFAULT 0,
+            max_prize DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS draw_daily_winners (
+            day DATE NOT NULL,
+            winner_username TEXT NOT NULL,
+            wins INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, winner_username)
+        )
+    """)
+
+    # Первичное заполнение корзин из истории (только если корзин ещё нет)
+    if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM draw_daily_stats)"):
+        await conn.execute("""
+            INSERT INTO draw_daily_stats (day, draws, participants, total_bank, total_commission, max_prize)
+            SELECT draw_date::date, COUNT(*), COALESCE(SUM(participants_count), 0),
+                   COALESCE(SUM(total_bank), 0), COALESCE(SUM(commission), 0), COALESCE(MAX(winner_prize), 0)
+            FROM draw_history
+            WHERE draw_date IS NOT NULL
+            GROUP BY draw_date::date
+        """)
+        await conn.execute("""
+            INSERT INTO draw_daily_winners (day, winner_username, wins)
+            SELECT draw_date::date, winner_username, COUNT(*)
+            FROM draw_history
+            WHERE draw_date IS NOT NULL AND winner_username IS NOT NULL
+            GROUP BY draw_date::date, winner_username
+        """)
+
+
+@migration(5, "referrals")
+async def _referrals(conn):
+    # Переходы по реферальным ссылкам
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_sources (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            source TEXT,
+            medium TEXT,
+            campaign TEXT,
+            invited_by BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS referral_sources_user_id_idx ON referral_sources (user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS referral_sources_source_idx ON referral_sources (source)")
+
+    # Воронка по источникам для /sources, см. referrals.py
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS source_users (
+            source TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            paid BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (source, user_id)
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS source_users_user_id_idx ON source_users (user_id)")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS source_funnel (
+            source TEXT PRIMARY KEY,
+            visits INTEGER NOT NULL DEFAULT 0,
+            unique_users INTEGER NOT NULL DEFAULT 0,
+            paid_users INTEGER NOT NULL DEFAULT 0,
+            referrals INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+    # Первичное заполнение воронки из накопленных переходов и транзакций
+    if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM source_funnel)"):
+        await conn.execute("""
+            INSERT INTO source_users (source, user_id, paid)
+            SELECT DISTINCT rs.source, rs.user_id,
+                   EXISTS (SELECT 1 FROM transactions t WHERE t.user_id = rs.user_id)
+            FROM referral_sources rs
+            WHERE rs.source IS NOT NULL AND rs.user_id IS NOT NULL
+            ON CONFLICT (source, user_id) DO NOTHING
+        """)
+        await conn.execute("""
+            INSERT INTO source_funnel (source, visits, unique_users, paid_users, referrals)
+            SELECT rs.source, COUNT(*), COUNT(DISTINCT rs.user_id),
+                   (SELECT COUNT(*) FROM source_users su WHERE su.source = rs.source AND su.paid),
+                   COUNT(rs.invited_by)
+            FROM referral_sources rs
+            WHERE rs.source IS NOT NULL
+            GROUP BY rs.source
+        """)
+
+
+@migration(6, "broadcasts")
+async def _broadcasts(conn):
+    # Массовые рассылки и статус доставки по каждому получателю, см. broadcast.py
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            round_id INTEGER,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+    """)
+
+
+@migration(7, "transfer_index")
+async def _transfer_index(conn):
+    # Локальный индекс входящих переводов USDT и место, где остановился индексер, см. transfer_indexer.py
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS incoming_transfers (
+            tx_hash TEXT NOT NULL,
+            log_index INTEGER NOT NULL,
+            block_number BIGINT NOT NULL,
+            from_address TEXT NOT NULL,
+            amount NUMERIC(78, 0) NOT NULL,
+            indexed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (tx_hash, log_index)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS indexer_checkpoints (
+            name TEXT PRIMARY KEY,
+            last_block BIGINT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+@migration(8, "transactions_network")
+async def _transactions_network(conn):
+    # Сеть, в которой пришла оплата: bsc или tron, см. payments.py
+    await conn.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS network TEXT NOT NULL DEFAULT 'bsc'")
+
+
+@migration(9, "draws")
+async def _draws(conn):
+    # Состояние розыгрышей для планировщика, см. draws.py
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS draws (
+            id SERIAL PRIMARY KEY,
+            round_id INTEGER NOT NULL UNIQUE,
+            round_number INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'announced',
+            target_block BIGINT NOT NULL,
+            chat_id BIGINT,
+            block_hash TEXT,
+            participants_count INTEGER,
+            winner_ticket INTEGER,
+            winner_username TEXT,
+            winner_prize REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Не больше одного незавершённого розыгрыша на все процессы
+    await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS draws_one_active_idx ON draws ((true)) WHERE state <> 'archived'")
+
+
+@migration(10, "broadcast_pending_deliveries")
+async def _broadcast_pending_deliveries(conn):
+    # Получатели копируются в broadcast_deliveries со статусом pending до начала отправки, см. broadcast.py
+    await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS prepared BOOLEAN NOT NULL DEFAULT FALSE")
+    await conn.execute("ALTER TABLE broadcast_deliveries ADD COLUMN IF NOT EXISTS ticket_number INTEGER")
+
+
+@migration(11, "transactions_lower_txid")
+async def _transactions_lower_txid(conn):
+    # Хэш BSC хранится в нижнем регистре, см. BscVerifier.normalize. Строку, у которой уже
+    # есть двойник в нижнем регистре, не трогаем — по ней билет уже выдан дважды
+    result = await conn.execute("""
+        UPDATE transactions t SET txid = lower(t.txid)
+        WHERE t.network = 'bsc' AND t.txid <> lower(t.txid)
+          AND NOT EXISTS (SELECT 1 FROM transactions d WHERE d.txid = lower(t.txid))
+    """)
+    duplicates = await conn.fetchval(
+        "SELECT COUNT(*) FROM transactions WHERE network = 'bsc' AND txid <> lower(txid)"
+    )
+    logging.info(f"✅ TXID BSC приведены к нижнему регистру: {result}")
+    if duplicates:
+        logging.warning(f"⚠️ {duplicates} TXID BSC повторяют уже записанный хэш в другом регистре — проверь /find_txid")
+
+
+@migration(12, "draws_result_posted")
+async def _draws_result_posted(conn):
+    # Пост с итогом уже ушёл в канал — при повторе шага archived его не отправлять, см. draws.py
+    await conn.execute("ALTER TABLE draws ADD COLUMN IF NOT EXISTS result_posted BOOLEAN NOT NULL DEFAULT FALSE")
+
+
+@migration(13, "draws_failed_and_cancelled")
+async def _draws_failed_and_cancelled(conn):
+    # Розыгрыш может упасть (failed) или быть отменён (cancelled) и смениться новым
+    # по тому же раунду, поэтому round_id больше не уникален, см. draws.py
+    await conn.execute("ALTER TABLE draws ADD COLUMN IF NOT EXISTS failed_state TEXT")
+    await conn.execute("ALTER TABLE draws DROP CONSTRAINT IF EXISTS draws_round_id_key")
+    await conn.execute("CREATE INDEX IF NOT EXISTS draws_round_id_idx ON draws (round_id)")
+    await conn.execute("DROP INDEX IF EXISTS draws_one_active_idx")
+    await conn.execute(
+        "CREATE UNIQUE INDEX draws_one_active_idx ON draws ((true)) "
+        "WHERE state NOT IN ('archived', 'failed', 'cancelled')"
+    )
+
+
+@migration(14, "chain_heads")
+async def _chain_heads(conn):
+    # Голова сети, которую публикует ведущий процесс для остальных, см. block_follower.py
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS chain_heads (
+            name TEXT PRIMARY KEY,
+            number BIGINT NOT NULL,
+            hash TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+@migration(15, "draws_announce_attempted")
+async def _draws_announce_attempted(conn):
+    # Анонс с целевым блоком мог уйти в канал — розыгрыш нельзя отменить или начать
+    # с другим блоком, см. draws.py. Про старые розыгрыши это неизвестно: считаем, что уходил
+    await conn.execute("ALTER TABLE draws ADD COLUMN IF NOT EXISTS announce_attempted BOOLEAN NOT NULL DEFAULT FALSE")
+    await conn.execute("UPDATE draws SET announce_attempted = TRUE")
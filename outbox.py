@@ -0,0 +1,285 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import tracing
+from collections import deque
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter, NetworkError
+
+# Все исходящие сообщения идут через одну очередь с учётом лимитов Telegram:
+#   ~30 сообщений в секунду на бота, ~1 в секунду в личный чат, ~20 в минуту в группу/канал.
+# У каждого чата свой token bucket и своя очередь (порядок сообщений в чате сохраняется),
+# поверх — общий bucket на бота. Из готовых к отправке чатов первым уходит тот,
+# у чьего сообщения выше приоритет. RetryAfter ставит чат на паузу и повторяет отправку.
+
+# Приоритеты: меньше — раньше
+CHANNEL = 0   # посты в канал
+REPLY = 1     # ответы пользователям
+BULK = 2      # массовые рассылки
+
+QUEUED_METHODS = {
+    "sendMessage", "editMessageText", "editMessageReplyMarkup",
+    "sendPhoto", "sendDocument", "forwardMessage", "copyMessage",
+}
+# Правки одного сообщения, ещё не ушедшие в Telegram, склеиваются в одну (последнюю)
+COALESCED_METHODS = {"editMessageText", "editMessageReplyMarkup"}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд появится целый токен (0 — уже есть)"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    @property
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class _Item:
+    __slots__ = ("method", "data", "files", "priority", "seq", "futures", "attempts")
+
+    def __init__(self, method, data, files, priority, seq):
+        self.method = method
+        self.data = data
+        self.files = files
+        self.priority = priority
+        self.seq = seq
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.attempts = 0
+
+
+class _Lane:
+    """Очередь одного чата"""
+    __slots__ = ("items", "bucket", "busy", "scheduled", "blocked_until", "last_used")
+
+    def __init__(self, bucket):
+        self.items = deque()
+        self.bucket = bucket
+        self.busy = False
+        self.scheduled = False
+        self.blocked_until = 0
+        self.last_used = time.monotonic()
+
+
+class Outbox:
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, group_burst=3,
+                 channel_id=None, max_attempts=5, idle_ttl=60):
+        self.transport = None
+        self.channel_id = channel_id
+        self.max_attempts = max_attempts
+        self.idle_ttl = idle_ttl
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_limits = (chat_rate, chat_burst)
+        self._group_limits = (group_rate, group_burst)
+        self._lanes = {}
+        self._edits = {}
+        self._ready = []
+        self._sleeping = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = set()
+        self._last_sweep = time.monotonic()
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logging.info("✅ Очередь исходящих сообщений запущена")
+
+    async def stop(self, drain_timeout=5):
+        """Даёт очереди доотправить сообщения, затем останавливает её"""
+        if not self._task:
+            return
+        deadline = time.monotonic() + drain_timeout
+        while (self._ready or self._sleeping or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        for lane in self._lanes.values():
+            for item in lane.items:
+                for future in item.futures:
+                    if not future.done():
+                        future.cancel()
+        self._lanes.clear()
+        self._edits.clear()
+
+    def pending(self):
+        return sum(len(lane.items) for lane in self._lanes.values())
+
+    def default_priority(self, chat_id):
+        return CHANNEL if self.channel_id is not None and str(chat_id) == str(self.channel_id) else REPLY
+
+    async def submit(self, method, data, files=None, priority=None):
+        """Ставит запрос в очередь и ждёт ответ Telegram"""
+        with tracing.span(f"tg {method}"):
+            return await self._submit(method, data, files, priority)
+
+    async def _submit(self, method, data, files, priority):
+        chat_id = data["chat_id"]
+        if priority is None:
+            priority = self.default_priority(chat_id)
+
+        if method in COALESCED_METHODS:
+            key = (method, chat_id, data.get("message_id"))
+            queued = self._edits.get(key)
+            if queued:
+                # Предыдущая правка ещё не ушла — отправится только последний вариант
+                queued.data = data
+                queued.priority = min(queued.priority, priority)
+                future = asyncio.get_running_loop().create_future()
+                queued.futures.append(future)
+                return await future
+
+        item = _Item(method, data, files, priority, next(self._seq))
+        if method in COALESCED_METHODS:
+            self._edits[key] = item
+
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = _Lane(self._bucket_for(chat_id))
+        lane.items.append(item)
+        self._schedule(chat_id)
+        return await item.futures[0]
+
+    def _bucket_for(self, chat_id):
+        # Личные чаты — положительные id, группы и каналы — отрицательные или @username
+        is_private = isinstance(chat_id, int) or str(chat_id).isdigit()
+        rate, burst = self._chat_limits if is_private and int(chat_id) > 0 else self._group_limits
+        return TokenBucket(rate, burst)
+
+    def _schedule(self, chat_id):
+        lane = self._lanes.get(chat_id)
+        if lane and lane.items and not lane.busy and not lane.scheduled:
+            head = lane.items[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+            lane.scheduled = True
+            self._wakeup.set()
+
+    def _sweep(self, now):
+        """Удаляет очереди чатов, в которые давно ничего не отправлялось"""
+        for chat_id, lane in list(self._lanes.items()):
+            if not lane.items and not lane.busy and now - lane.last_used > self.idle_ttl and lane.bucket.full:
+                del self._lanes[chat_id]
+        self._last_sweep = now
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._sleeping and self._sleeping[0][0] <= now:
+                _, chat_id = heapq.heappop(self._sleeping)
+                self._lanes[chat_id].scheduled = False
+                self._schedule(chat_id)
+
+            if now - self._last_sweep > self.idle_ttl:
+                self._sweep(now)
+
+            if not self._ready:
+                timeout = self._sleeping[0][0] - now if self._sleeping else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_wait = self._global.delay(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            lane = self._lanes[chat_id]
+            chat_wait = max(lane.blocked_until - now, lane.bucket.delay(now))
+            if chat_wait > 0:
+                heapq.heappush(self._sleeping, (now + chat_wait, chat_id))
+                continue
+
+            lane.scheduled = False
+            self._global.take()
+            lane.bucket.take()
+            item = lane.items.popleft()
+            if item.method in COALESCED_METHODS:
+                key = (item.method, chat_id, item.data.get("message_id"))
+                if self._edits.get(key) is item:
+                    del self._edits[key]
+            lane.busy = True
+            task = asyncio.create_task(self._deliver(chat_id, lane, item))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _deliver(self, chat_id, lane, item):
+        try:
+            result = await self.transport(item.method, item.data, item.files)
+        except RetryAfter as e:
+            logging.warning(f"⚠️ Flood control в чате {chat_id}: пауза {e.timeout} с")
+            lane.blocked_until = time.monotonic() + e.timeout
+            lane.items.appendleft(item)
+        except (NetworkError, asyncio.TimeoutError) as e:
+            item.attempts += 1
+            if item.attempts >= self.max_attempts:
+                self._resolve(item, error=e)
+            else:
+                logging.warning(f"⚠️ Ошибка отправки в чат {chat_id} ({e}), повтор {item.attempts}")
+                lane.blocked_until = time.monotonic() + 2 ** item.attempts
+                lane.items.appendleft(item)
+        except Exception as e:
+            self._resolve(item, error=e)
+        else:
+            self._resolve(item, result=result)
+        finally:
+            lane.busy = False
+            lane.last_used = time.monotonic()
+            self._schedule(chat_id)
+
+    @staticmethod
+    def _resolve(item, result=None, error=None):
+        for future in item.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class QueuedBot(Bot):
+    """Bot, у которого отправка сообщений идёт через Outbox.
+
+    Обработчики по-прежнему вызывают message.answer / bot.send_message / edit_message_text
+    и получают ответ Telegram, но сам запрос уходит только когда позволяют лимиты.
+    Пока очередь не запущена, запросы идут напрямую.
+    """
+
+    def __init__(self, *args, outbox=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = outbox or Outbox()
+        self.outbox.transport = self._send_now
+
+    async def _send_now(self, method, data, files):
+        return await super().request(method, data, files)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if self.outbox.running and method in QUEUED_METHODS and data and "chat_id" in data:
+            return await self.outbox.submit(method, data, files)
+        return await super().request(method, data, files, **kwargs)
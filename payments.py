@@ -0,0 +1,316 @@
+import re
+import time
+import asyncio
+import hashlib
+import logging
+from decimal import Decimal
+import aiohttp
+import metrics
+import tracing
+from bsc_rpc import JsonRpcError
+from verify_queue import RetryLater
+from transfer_indexer import USDT_CONTRACT, TRANSFER_TOPIC, USDT_DECIMALS
+
+# Проверка оплаты в разных сетях через общий интерфейс PaymentVerifier.
+#
+# Сеть определяется по формату TXID: в BSC это 0x и 64 шестнадцатеричных символа,
+# в TRON — те же 64 символа без префикса. Хэш BSC часто копируют без 0x, поэтому
+# 64 символа без префикса подходят обеим сетям — тогда сеть выбирается по тому,
+# какая из них знает транзакцию, см. resolve_verifier. Суммы сравниваются в
+# минимальных единицах токена (целые числа), у каждой сети своё число знаков
+# после запятой.
+
+USDT_TRC20_CONTRACT = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+USDT_TRC20_DECIMALS = 6
+
+_BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+def tron_address_to_hex(address):
+    """Base58Check-адрес TRON (T...) → 20 байт адреса в hex, без префикса 41"""
+    number = 0
+    for char in address:
+        number = number * 58 + _BASE58_ALPHABET.index(char)
+    raw = number.to_bytes(25, "big")
+    payload, checksum = raw[:-4], raw[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum or payload[0] != 0x41:
+        raise ValueError(f"Некорректный адрес TRON: {address}")
+    return payload[1:].hex()
+
+
+class PaymentVerifier:
+    """Проверка оплаты в одной сети.
+
+    verify(txid, expected_amount) возвращает (success, msg) или бросает RetryLater,
+    если транзакцию пока нельзя проверить — повторами управляет очередь проверки.
+    """
+
+    network = None
+    title = None
+    token = "USDT"
+    # Среднее время блока в секундах — для ожидания повторной проверки
+    block_time = 3
+
+    def __init__(self, address, decimals):
+        self.address = address
+        self.decimals = decimals
+
+    def matches(self, txid):
+        """Похож ли txid на хэш транзакции этой сети (проверка формата, без запросов)"""
+        raise NotImplementedError
+
+    def normalize(self, txid):
+        return txid.strip()
+
+    async def knows(self, txid):
+        """Есть ли транзакция в сети (txid уже нормализован); ошибки сети не глотает"""
+        raise NotImplementedError
+
+    async def verify(self, txid, expected_amount):
+        raise NotImplementedError
+
+    async def wait_blocks(self, count):
+        """Ждёт, пока в сети выйдет ещё count блоков"""
+        await asyncio.sleep(count * self.block_time)
+
+    async def close(self):
+        pass
+
+    def format_amount(self, raw_amount):
+        return f"{Decimal(raw_amount).scaleb(-self.decimals).normalize():f}"
+
+    def _result(self, raw_amount, expected_amount):
+        amount = self.format_amount(raw_amount)
+        if raw_amount >= int(Decimal(str(expected_amount)).scaleb(self.decimals)):
+            return True, f"OK: {amount} {self.token}"
+        return False, f"Недостаточно средств: {amount} {self.token}"
+
+
+def detect_verifiers(verifiers, txid):
+    """Проверяющие всех сетей, на хэш которых похож txid"""
+    return [verifier for verifier in verifiers.values() if verifier.matches(txid)]
+
+
+async def resolve_verifier(candidates, txid):
+    """Из сетей, на хэш которых похож txid, — та, что знает транзакцию.
+
+    Если подходит одна сеть, запросов нет. Если транзакцию не знает ни одна сеть,
+    знают обе или сеть не ответила — None: по такому хэшу сеть не угадать.
+    """
+    if len(candidates) == 1:
+        return candidates[0]
+    found = await asyncio.gather(
+        *(verifier.knows(verifier.normalize(txid)) for verifier in candidates), return_exceptions=True
+    )
+    known = [verifier for verifier, result in zip(candidates, found) if result is True]
+    return known[0] if len(known) == 1 else None
+
+
+# === BSC ===
+class BscVerifier(PaymentVerifier):
+    """USDT BEP-20: сначала локальный индекс переводов, при промахе — JSON-RPC.
+
+    Запросы к RPC от одновременно проверяемых TXID копятся batch_window секунд
+    и уходят одним batch-запросом (транзакция и receipt на каждый TXID).
+    """
+
+    network = "bsc"
+    title = "BSC (BEP-20)"
+
+    def __init__(self, rpc, block_follower, transfer_indexer, address, min_confirmations=1,
+                 batch_window=0.02, batch_size=50):
+        super().__init__(address, USDT_DECIMALS)
+        self._rpc = rpc
+        self._follower = block_follower
+        self._index = transfer_indexer
+        self.min_confirmations = min_confirmations
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    _TXID_RE = re.compile(r"^(0x)?[0-9a-fA-F]{64}$")
+
+    def matches(self, txid):
+        return bool(self._TXID_RE.match(txid))
+
+    def normalize(self, txid):
+        # Узлы принимают хэш в любом регистре — в transactions он должен храниться в одном
+        txid = txid.strip().lower()
+        return txid if txid.startswith("0x") else "0x" + txid
+
+    async def knows(self, txid):
+        if self._index is not None and await self._index.lookup(txid) is not None:
+            return True
+        tx, _ = await self._lookup(txid)
+        if isinstance(tx, JsonRpcError):
+            raise tx
+        return bool(tx)
+
+    async def wait_blocks(self, count):
+        head = await self._follower.wait_for_head(timeout=30)
+        await self._follower.wait_for_block(head + count, timeout=count * self.block_time * 3 + 30)
+
+    async def verify(self, txid, expected_amount):
+        if self._index is not None:
+            amount = await self._index.lookup(txid)
+            if amount is not None:
+                return self._result(amount, expected_amount)
+
+        tx, receipt = await self._lookup(txid)
+        for result in (tx, receipt):
+            if isinstance(result, JsonRpcError):
+                if "invalid" in str(result).lower():
+                    # Узел не принял сам хэш — повторять бесполезно
+                    return False, "Некорректный хэш транзакции"
+                logging.error(f"Ошибка BSCTrace: {result}")
+                raise RetryLater("Ошибка при обращении к BSCTrace")
+
+        if not tx:
+            raise RetryLater("Транзакция не найдена")
+
+        if not receipt:
+            raise RetryLater("Транзакция не подтверждена")
+
+        if self.min_confirmations > 1 and self._follower.confirmations(int(receipt['blockNumber'], 16)) < self.min_confirmations:
+            raise RetryLater("Транзакция ещё не набрала нужное число подтверждений")
+
+        for log in receipt.get('logs', []):
+            if log['address'].lower() != USDT_CONTRACT or len(log['topics']) < 3 or log['topics'][0] != TRANSFER_TOPIC:
+                continue
+            to_address = '0x' + log['topics'][2][-40:]
+            logging.debug(f"🔍 Найден Transfer: получатель {to_address}, ожидаемый {self.address}")
+            if to_address.lower() == self.address.lower():
+                return self._result(int(log['data'], 16), expected_amount)
+
+        return False, "Не найден перевод USDT в этой транзакции"
+
+    async def _lookup(self, txid):
+        """(транзакция, receipt) для txid; запрос уходит в общем batch с соседями"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((txid, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        calls = []
+        for txid, _ in batch:
+            calls.append(("eth_getTransactionByHash", [txid]))
+            calls.append(("eth_getTransactionReceipt", [txid]))
+        try:
+            results = await self._rpc.batch(calls, return_exceptions=True)
+        except JsonRpcError as e:
+            results = [e] * len(calls)
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result((results[2 * i], results[2 * i + 1]))
+
+
+# === TRON ===
+class TronVerifier(PaymentVerifier):
+    """USDT TRC-20 через HTTP API TronGrid с пулом keep-alive соединений.
+
+    Транзакция (есть ли она в сети) и её результат в подтверждённом
+    (solidified) блоке запрашиваются параллельно.
+    """
+
+    network = "tron"
+    title = "TRON (TRC-20)"
+
+    _TXID_RE = re.compile(r"^[0-9a-fA-F]{64}$")
+
+    def __init__(self, api_url, address, api_key=None, contract=USDT_TRC20_CONTRACT,
+                 decimals=USDT_TRC20_DECIMALS, timeout=10, pool_size=20):
+        super().__init__(address, decimals)
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._headers = {"TRON-PRO-API-KEY": api_key} if api_key else {}
+        self._address_hex = tron_address_to_hex(address)
+        self._contract_hex = tron_address_to_hex(contract)
+        self._session = None
+
+    def matches(self, txid):
+        return bool(self._TXID_RE.match(txid))
+
+    def normalize(self, txid):
+        return txid.strip().lower()
+
+    async def knows(self, txid):
+        return bool(await self._post("/wallet/gettransactionbyid", {"value": txid}))
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self._headers)
+        return self._session
+
+    async def _post(self, path, payload):
+        method = path.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        metrics.RPC_IN_FLIGHT.inc()
+        try:
+            with tracing.span(f"tron {method}"):
+                async with self._get_session().post(
+                    self.api_url + path, json=payload, timeout=aiohttp.ClientTimeout(total=self.timeout)
+                ) as response:
+                    if response.status != 200:
+                        text = await response.text()
+                        raise JsonRpcError(f"HTTP {response.status}: {text[:200]}")
+                    return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.RPC_ERRORS.labels(method, "tron").inc()
+            raise JsonRpcError(f"{type(e).__name__}: {e}") from e
+        except JsonRpcError:
+            metrics.RPC_ERRORS.labels(method, "tron").inc()
+            raise
+        finally:
+            metrics.RPC_IN_FLIGHT.dec()
+            metrics.RPC_LATENCY.labels(method, "tron").observe(time.perf_counter() - started)
+
+    async def verify(self, txid, expected_amount):
+        try:
+            tx, info = await asyncio.gather(
+                self._post("/wallet/gettransactionbyid", {"value": txid}),
+                self._post("/walletsolidity/gettransactioninfobyid", {"value": txid}),
+            )
+        except JsonRpcError as e:
+            logging.error(f"Ошибка TronGrid: {e}")
+            raise RetryLater("Ошибка при обращении к TronGrid")
+
+        if not tx:
+            raise RetryLater("Транзакция не найдена")
+
+        if not info:
+            raise RetryLater("Транзакция не подтверждена")
+
+        if info.get("receipt", {}).get("result", "SUCCESS") != "SUCCESS":
+            return False, "Транзакция завершилась с ошибкой"
+
+        for log in info.get("log", []):
+            topics = log.get("topics", [])
+            if log.get("address", "")[-40:].lower() != self._contract_hex or len(topics) < 3:
+                continue
+            if topics[0].lower() != TRANSFER_TOPIC[2:] or topics[2][-40:].lower() != self._address_hex:
+                continue
+            return self._result(int(log.get("data") or "0", 16), expected_amount)
+
+        return False, "Не найден перевод USDT в этой транзакции"
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
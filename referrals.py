@@ -0,0 +1,49 @@
+import database
+
+# Воронка по источникам переходов поддерживается инкрементально и привязана к telegram user_id:
+#   source_users  — пара (источник, пользователь) и флаг «оплатил хотя бы раз»;
+#   source_funnel — по строке на источник: переходы, уникальные пользователи,
+#                   оплатившие пользователи, рефералы.
+# Отчёт /sources читает source_funnel одним запросом.
+
+
+async def record_visit(conn, source_info, user_id):
+    """Учитывает переход по ссылке; вызывается в транзакции вставки в referral_sources"""
+    await conn.execute("""
+        WITH new_user AS (
+            INSERT INTO source_users (source, user_id, paid)
+            VALUES ($1, $2, EXISTS (SELECT 1 FROM transactions WHERE user_id = $2))
+            ON CONFLICT (source, user_id) DO NOTHING
+            RETURNING paid
+        )
+        INSERT INTO source_funnel (source, visits, unique_users, paid_users, referrals)
+        SELECT $1, 1, COUNT(*), COUNT(*) FILTER (WHERE paid), $3 FROM new_user
+        ON CONFLICT (source) DO UPDATE SET
+            visits = source_funnel.visits + 1,
+            unique_users = source_funnel.unique_users + EXCLUDED.unique_users,
+            paid_users = source_funnel.paid_users + EXCLUDED.paid_users,
+            referrals = source_funnel.referrals + EXCLUDED.referrals
+    """, source_info['source'], user_id, 1 if source_info['invited_by'] is not None else 0)
+
+
+async def record_payment(conn, user_id):
+    """Отмечает пользователя оплатившим во всех источниках, откуда он пришёл"""
+    await conn.execute("""
+        WITH newly_paid AS (
+            UPDATE source_users SET paid = TRUE
+            WHERE user_id = $1 AND NOT paid
+            RETURNING source
+        )
+        UPDATE source_funnel f SET paid_users = f.paid_users + 1
+        FROM newly_paid n
+        WHERE f.source = n.source
+    """, user_id)
+
+
+async def reset(conn):
+    await conn.execute("DELETE FROM source_users")
+    await conn.execute("DELETE FROM source_funnel")
+
+
+async def get_funnel():
+    return await database.fetch("SELECT * FROM source_funnel ORDER BY visits DESC")
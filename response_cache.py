@@ -0,0 +1,62 @@
+import time
+import asyncio
+
+# Кэш готовых текстов ответов (/stats, /history, /weekly, /monthly, /announce).
+# Текст меняется только после розыгрыша или записи участника, поэтому кэш
+# сбрасывается явно из этих мест; TTL ограничивает устаревание, если запись
+# прошла в другом процессе.
+
+# Какие представления зависят от каких событий
+DRAW_VIEWS = ("stats", "history", "weekly", "monthly", "announce")
+PARTICIPANT_VIEWS = ("announce",)
+
+
+class ResponseCache:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._entries = {}
+        self._inflight = {}
+        self._generation = 0
+
+    async def get(self, view, render, *key):
+        """Текст представления view; при промахе вызывает render() один раз на всех ждущих"""
+        entry = self._entries.get((view, key))
+        if entry and time.monotonic() < entry[0]:
+            return entry[1]
+
+        future = self._inflight.get((view, key))
+        if future:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[(view, key)] = future
+        generation = self._generation
+        try:
+            text = await render()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # ошибку увидит вызывающий, не логгер asyncio
+            raise
+        else:
+            # Если кэш сбросили, пока текст строился, он мог устареть — не сохраняем
+            if generation == self._generation:
+                self._entries[(view, key)] = (time.monotonic() + self.ttl, text)
+            future.set_result(text)
+            return text
+        finally:
+            del self._inflight[(view, key)]
+
+    def invalidate(self, *views):
+        """Сбрасывает указанные представления (все, если не указаны)"""
+        self._generation += 1
+        if not views:
+            self._entries.clear()
+            return
+        for cache_key in [k for k in self._entries if k[0] in views]:
+            del self._entries[cache_key]
+
+    def on_draw_recorded(self):
+        self.invalidate(*DRAW_VIEWS)
+
+    def on_participant_added(self):
+        self.invalidate(*PARTICIPANT_VIEWS)
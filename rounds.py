@@ -0,0 +1,128 @@
+import time
+import logging
+import database
+
+# Участники хранятся по раундам: participants — таблица, секционированная по round_id
+# (PARTITION BY LIST), у каждого раунда своя секция participants_r<id>.
+#
+# Жизненный цикл раунда: open → drawing → closed.
+#   open    — ровно один раунд принимает новых участников;
+#   drawing — раунд заморожен на время розыгрыша, новые оплаты уже идут в следующий;
+#             если розыгрыш не удался, раунд остаётся в drawing и разыгрывается повторно;
+#   closed  — секция отсоединена от participants и присоединена к participants_archive.
+# Закрытие раунда — это DETACH/ATTACH секции, а не DELETE по строкам.
+
+# Кэш числа участников по раундам; сбрасывается при вставке участника и закрытии раунда
+COUNT_CACHE_TTL = 30
+_counts = {}
+
+
+def partition_name(round_id):
+    return f"participants_r{int(round_id)}"
+
+
+async def open_round(conn):
+    """Создаёт новый открытый раунд и его секцию"""
+    round_id = await conn.fetchval("INSERT INTO rounds (status) VALUES ('open') RETURNING id")
+    await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(round_id)} "
+        f"PARTITION OF participants FOR VALUES IN ({int(round_id)})"
+    )
+    logging.info(f"✅ Открыт раунд {round_id}")
+    return round_id
+
+
+async def ensure_open_round(conn):
+    round_id = await conn.fetchval(database.SQL_OPEN_ROUND)
+    if round_id is None:
+        round_id = await open_round(conn)
+    return round_id
+
+
+async def get_open_round_id():
+    return await database.fetchval(database.SQL_OPEN_ROUND)
+
+
+async def count_participants(round_id):
+    """Число участников раунда из кэша; в базу — только после сброса или истечения TTL"""
+    cached = _counts.get(round_id)
+    if cached and time.monotonic() - cached[1] < COUNT_CACHE_TTL:
+        return cached[0]
+    count = await database.fetchval("SELECT COUNT(*) FROM participants WHERE round_id = $1", round_id)
+    _counts[round_id] = (count, time.monotonic())
+    return count
+
+
+def invalidate_count(round_id=None):
+    if round_id is None:
+        _counts.clear()
+    else:
+        _counts.pop(round_id, None)
+
+
+async def add_participant(conn, username, user_id):
+    """Добавляет участника в открытый раунд. Возвращает (round_id, ticket_number).
+
+    Если раунд закрылся для записи прямо во время вставки, запрос не находит
+    открытый раунд — тогда повторяем его уже для следующего раунда.
+    """
+    for _ in range(3):
+        row = await conn.fetchrow(database.SQL_INSERT_PARTICIPANT, username, user_id)
+        if row:
+            invalidate_count(row['round_id'])
+            return row['round_id'], row['ticket_number']
+    raise RuntimeError("Нет открытого раунда")
+
+
+async def begin_draw(conn, min_participants=2):
+    """Выбирает раунд для розыгрыша и замораживает его.
+
+    Сначала берётся незавершённый раунд в статусе drawing (прошлый розыгрыш не удался),
+    иначе — открытый раунд, если в нём достаточно участников; он переводится в drawing,
+    а для новых оплат открывается следующий. Вызывать в транзакции.
+    Возвращает (round_id, участники по возрастанию номера билета).
+    """
+    round_id = await conn.fetchval(
+        "SELECT id FROM rounds WHERE status = 'drawing' ORDER BY id LIMIT 1 FOR UPDATE"
+    )
+    if round_id is None:
+        # Создание секции нового раунда берёт эксклюзивную блокировку participants.
+        # Берём её первой: иначе идущая вставка (держит participants, ждёт строку раунда)
+        # и розыгрыш (держит строку раунда, ждёт participants) ловят deadlock.
+        await conn.execute("LOCK TABLE participants IN ACCESS EXCLUSIVE MODE")
+        # Блокировка строки раунда ждёт завершения идущих вставок и не пускает новые
+        round_id = await conn.fetchval("SELECT id FROM rounds WHERE status = 'open' FOR UPDATE")
+        count = await conn.fetchval("SELECT COUNT(*) FROM participants WHERE round_id = $1", round_id)
+        if count < min_participants:
+            return round_id, []
+        await conn.execute("UPDATE rounds SET status = 'drawing' WHERE id = $1", round_id)
+        await open_round(conn)
+
+    rows = await conn.fetch(
+        "SELECT ticket_number, username FROM participants WHERE round_id = $1 ORDER BY ticket_number",
+        round_id
+    )
+    return round_id, rows
+
+
+async def close_round(conn, round_id, round_number):
+    """Закрывает разыгранный раунд и переносит его секцию в архив. Вызывать в транзакции"""
+    await conn.execute(
+        "UPDATE rounds SET status = 'closed', round_number = $2, closed_at = CURRENT_TIMESTAMP WHERE id = $1",
+        round_id, round_number
+    )
+    invalidate_count(round_id)
+    name = partition_name(round_id)
+    await conn.execute(f"ALTER TABLE participants DETACH PARTITION {name}")
+    await conn.execute(
+        f"ALTER TABLE participants_archive ATTACH PARTITION {name} FOR VALUES IN ({int(round_id)})"
+    )
+
+
+async def drop_all(conn):
+    """Удаляет все раунды вместе с секциями (для /reset_db) и открывает новый"""
+    for row in await conn.fetch("SELECT id FROM rounds"):
+        await conn.execute(f"DROP TABLE IF EXISTS {partition_name(row['id'])}")
+    await conn.execute("TRUNCATE rounds RESTART IDENTITY")
+    invalidate_count()
+    await open_round(conn)
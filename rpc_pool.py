@@ -0,0 +1,215 @@
+import time
+import random
+import asyncio
+import logging
+from urllib.parse import urlparse
+import metrics
+from bsc_rpc import ProviderError
+from outbox import TokenBucket
+
+# Пул JSON-RPC провайдеров BSC с тем же интерфейсом, что у BscRpcClient (call, batch, close).
+#
+# У каждого провайдера скользящие средние задержки и доли ошибок; из них считается
+# оценка, пропорционально которой провайдер выбирается для запроса. После
+# failure_threshold ошибок подряд circuit breaker выключает провайдера на cooldown
+# секунд, затем пропускает пробный запрос. Бюджет запросов в секунду держит нас
+# в квотах API: провайдер без бюджета пропускается, пока токен не восстановится.
+#
+# Если провайдер не ответил (ProviderError), запрос повторяется у следующего.
+# Ошибка в самом ответе JSON-RPC — это ответ, его у другого провайдера не переспрашиваем.
+# Для методов из hedged_methods, если основной провайдер молчит дольше hedge_delay,
+# тот же запрос уходит запасному и берётся первый ответ.
+
+
+class Provider:
+    def __init__(self, client, name=None, weight=1.0, rps=None):
+        self.client = client
+        self.name = name or urlparse(client.url).hostname or client.url
+        self.weight = weight
+        self.budget = TokenBucket(rps, max(1, rps)) if rps else None
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0
+        self.in_flight = 0
+
+    @property
+    def score(self):
+        latency = self.latency if self.latency is not None else 0.2
+        return self.weight * (1 - self.error_rate) / (max(latency, 0.01) * (1 + self.in_flight))
+
+    def is_open(self, now):
+        return now < self.open_until
+
+    def budget_delay(self, now):
+        return self.budget.delay(now) if self.budget else 0
+
+
+class RpcPool:
+    def __init__(self, providers, failure_threshold=5, cooldown=30, hedge_delay=0.3,
+                 hedged_methods=("eth_getBlockByNumber",), smoothing=0.2):
+        if not providers:
+            raise ValueError("Нужен хотя бы один RPC-провайдер")
+        self.providers = providers
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedge_delay = hedge_delay
+        self.hedged_methods = set(hedged_methods)
+        self.smoothing = smoothing
+        # Провайдеры с одинаковым хостом различаются номером
+        names = [p.name for p in providers]
+        for i, provider in enumerate(providers):
+            if names.count(provider.name) > 1:
+                provider.name = f"{provider.name}#{i + 1}"
+        for provider in providers:
+            self._publish(provider)
+
+    async def call(self, method, params=None, timeout=None, hedge=None):
+        """Один вызов метода; hedge=None — дублировать, если метод в hedged_methods"""
+        if hedge is None:
+            hedge = method in self.hedged_methods
+        return await self._run(lambda client: client.call(method, params, timeout), method, hedge)
+
+    async def batch(self, calls, timeout=None, return_exceptions=False):
+        return await self._run(lambda client: client.batch(calls, timeout, return_exceptions), "batch", False)
+
+    async def close(self):
+        for provider in self.providers:
+            await provider.client.close()
+
+    def status(self):
+        now = time.monotonic()
+        return [
+            {
+                "provider": p.name,
+                "score": round(p.score, 2),
+                "latency_ms": round(p.latency * 1000, 1) if p.latency is not None else None,
+                "error_rate": round(p.error_rate, 3),
+                "open": p.is_open(now),
+                "in_flight": p.in_flight,
+            }
+            for p in self.providers
+        ]
+
+    # === ВЫБОР ПРОВАЙДЕРА ===
+    def _pick(self, exclude):
+        """Провайдер с учётом оценок, breaker'ов и бюджета. None — сейчас некого спросить"""
+        now = time.monotonic()
+        candidates = [p for p in self.providers if p not in exclude and not p.is_open(now) and p.budget_delay(now) == 0]
+        if not candidates:
+            return None
+        return random.choices(candidates, weights=[p.score for p in candidates])[0]
+
+    async def _acquire(self, exclude):
+        """Ждёт провайдера с бюджетом; если у всех разомкнут breaker — берёт того, кто откроется раньше"""
+        while True:
+            provider = self._pick(exclude)
+            if provider is not None:
+                return provider
+            now = time.monotonic()
+            rest = [p for p in self.providers if p not in exclude]
+            if not rest:
+                return None
+            closed = [p for p in rest if not p.is_open(now)]
+            if not closed:
+                # Все выключены — пробуем ближайшего к восстановлению, а не отказываем сразу
+                provider = min(rest, key=lambda p: p.open_until)
+                if provider.budget_delay(now) == 0:
+                    return provider
+                closed = [provider]
+            await asyncio.sleep(min(p.budget_delay(now) for p in closed))
+
+    # === ВЫПОЛНЕНИЕ ===
+    async def _run(self, request, method, hedge):
+        tried = []
+        error = None
+        while True:
+            provider = await self._acquire(tried)
+            if provider is None:
+                raise error or ProviderError("Нет доступных RPC-провайдеров")
+            if tried:
+                metrics.RPC_FAILOVERS.labels(tried[-1].name).inc()
+            tried.append(provider)
+            try:
+                if hedge and len(self.providers) > len(tried):
+                    return await self._hedged(provider, request, method, tried)
+                return await self._attempt(provider, request)
+            except ProviderError as e:
+                error = e
+
+    async def _attempt(self, provider, request):
+        if provider.budget:
+            provider.budget.take()
+        if provider.failures >= self.failure_threshold:
+            # Пробный запрос после cooldown: пока он идёт, остальные провайдера не трогают
+            provider.open_until = time.monotonic() + self.cooldown
+        provider.in_flight += 1
+        started = time.perf_counter()
+        try:
+            result = await request(provider.client)
+        except asyncio.CancelledError:
+            # Проиграл hedged-запросу: время ожидания всё равно говорит о задержке провайдера
+            self._record_latency(provider, time.perf_counter() - started)
+            raise
+        except ProviderError as e:
+            self._record(provider, time.perf_counter() - started, error=e)
+            raise
+        else:
+            self._record(provider, time.perf_counter() - started)
+            return result
+        finally:
+            provider.in_flight -= 1
+
+    async def _hedged(self, primary, request, method, tried):
+        tasks = {asyncio.ensure_future(self._attempt(primary, request))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                backup = self._pick(tried)
+                if backup is not None:
+                    tried.append(backup)
+                    metrics.RPC_HEDGES.labels(method).inc()
+                    tasks.add(asyncio.ensure_future(self._attempt(backup, request)))
+
+            error = None
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    exc = task.exception()
+                    if exc is None:
+                        return task.result()
+                    if not isinstance(exc, ProviderError):
+                        raise exc
+                    error = exc
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _record_latency(self, provider, elapsed):
+        a = self.smoothing
+        provider.latency = elapsed if provider.latency is None else (1 - a) * provider.latency + a * elapsed
+
+    def _record(self, provider, elapsed, error=None):
+        a = self.smoothing
+        if error is None:
+            self._record_latency(provider, elapsed)
+            provider.error_rate *= 1 - a
+            if provider.failures >= self.failure_threshold:
+                logging.info(f"✅ RPC-провайдер {provider.name} снова отвечает")
+            provider.failures = 0
+            provider.open_until = 0
+        else:
+            provider.error_rate = (1 - a) * provider.error_rate + a
+            provider.failures += 1
+            if provider.failures >= self.failure_threshold:
+                provider.open_until = time.monotonic() + self.cooldown
+            if provider.failures == self.failure_threshold:
+                logging.warning(f"⚠️ RPC-провайдер {provider.name} выключен на {self.cooldown} с после {provider.failures} ошибок подряд ({error})")
+        self._publish(provider)
+
+    @staticmethod
+    def _publish(provider):
+        metrics.RPC_PROVIDER_SCORE.labels(provider.name).set(provider.score)
+        metrics.RPC_PROVIDER_OPEN.labels(provider.name).set(1 if provider.open_until > time.monotonic() else 0)
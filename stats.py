@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+import database
+
+# Статистика розыгрышей поддерживается инкрементально:
+#   draw_totals         — одна строка с итогами за всё время (/stats);
+#   draw_daily_stats    — дневные корзины: число розыгрышей, банк, комиссия, макс. приз;
+#   draw_daily_winners  — число побед каждого игрока по дням.
+# Любое окно (неделя, месяц, произвольный период) считается слиянием дневных корзин,
+# то есть стоит O(дней), а не O(розыгрышей). Дни считаются по UTC.
+
+
+def utc_today():
+    return datetime.now(timezone.utc).date()
+
+
+async def record_draw(conn, participants_count, total_bank, commission, winner_username, winner_prize):
+    """Учитывает завершённый розыгрыш; вызывается в транзакции вставки в draw_history"""
+    day = utc_today()
+    await conn.execute("""
+        UPDATE draw_totals SET
+            total_draws = total_draws + 1,
+            total_participants = total_participants + $1,
+            total_bank = total_bank + $2,
+            total_commission = total_commission + $3,
+            max_prize = GREATEST(max_prize, $4),
+            max_bank = GREATEST(max_bank, $2)
+        WHERE id = 1
+    """, participants_count, total_bank, commission, winner_prize)
+
+    await conn.execute("""
+        INSERT INTO draw_daily_stats (day, draws, participants, total_bank, total_commission, max_prize)
+        VALUES ($5, 1, $1, $2, $3, $4)
+        ON CONFLICT (day) DO UPDATE SET
+            draws = draw_daily_stats.draws + 1,
+            participants = draw_daily_stats.participants + EXCLUDED.participants,
+            total_bank = draw_daily_stats.total_bank + EXCLUDED.total_bank,
+            total_commission = draw_daily_stats.total_commission + EXCLUDED.total_commission,
+            max_prize = GREATEST(draw_daily_stats.max_prize, EXCLUDED.max_prize)
+    """, participants_count, total_bank, commission, winner_prize, day)
+
+    await conn.execute("""
+        INSERT INTO draw_daily_winners (day, winner_username, wins)
+        VALUES ($2, $1, 1)
+        ON CONFLICT (day, winner_username) DO UPDATE SET wins = draw_daily_winners.wins + 1
+    """, winner_username, day)
+
+
+async def reset(conn):
+    """Обнуляет все агрегаты (вместе с очисткой draw_history)"""
+    await conn.execute("""
+        UPDATE draw_totals SET total_draws = 0, total_participants = 0, total_bank = 0,
+            total_commission = 0, max_prize = 0, max_bank = 0
+        WHERE id = 1
+    """)
+    await conn.execute("DELETE FROM draw_daily_stats")
+    await conn.execute("DELETE FROM draw_daily_winners")
+
+
+async def get_totals():
+    return await database.fetchrow("SELECT * FROM draw_totals WHERE id = 1")
+
+
+async def get_last_days(days):
+    """Сводка за последние days дней, включая сегодняшний"""
+    today = utc_today()
+    return await get_window(today - timedelta(days=days - 1), today)
+
+
+async def get_window(date_from, date_to):
+    """Сводка за дни [date_from, date_to] включительно и лучший игрок окна"""
+    async with database.acquire() as conn:
+        window = await conn.fetchrow("""
+            SELECT COALESCE(SUM(draws), 0) as draws,
+                   COALESCE(SUM(participants), 0) as participants,
+                   COALESCE(SUM(total_bank), 0) as total_bank,
+                   COALESCE(SUM(total_commission), 0) as total_commission,
+                   COALESCE(MAX(max_prize), 0) as max_prize
+            FROM draw_daily_stats
+            WHERE day BETWEEN $1 AND $2
+        """, date_from, date_to)
+
+        top_winner = await conn.fetchrow("""
+            SELECT winner_username, SUM(wins) as wins
+            FROM draw_daily_winners
+            WHERE day BETWEEN $1 AND $2
+            GROUP BY winner_username
+            ORDER BY wins DESC
+            LIMIT 1
+        """, date_from, date_to)
+
+    return window, top_winner
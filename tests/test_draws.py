@@ -0,0 +1,24 @@
+from draws import pick_winner, winner_index
+
+
+def tickets(*numbers):
+    return [{"ticket_number": n, "username": f"@u{n}"} for n in numbers]
+
+
+def test_winner_index_is_block_hash_modulo_ticket_count():
+    block_hash = "0x" + "f" * 64
+    assert winner_index(block_hash, 7) == int(block_hash, 16) % 7
+    assert winner_index("0x" + "0" * 63 + "a", 4) == 2
+
+
+def test_pick_winner_indexes_sorted_tickets_not_numbers():
+    # Номера с пропусками: победитель — билет на позиции хэш % N, а не билет с номером хэш % N
+    block_hash = "0x" + "0" * 63 + "4"
+    assert pick_winner(block_hash, tickets(5, 9, 12))["ticket_number"] == 9
+
+
+def test_pick_winner_is_deterministic_for_block():
+    block_hash = "0x9a3f" + "1" * 60
+    round_tickets = tickets(*range(1, 101))
+    assert pick_winner(block_hash, round_tickets) == pick_winner(block_hash, round_tickets)
+    assert pick_winner(block_hash, round_tickets)["ticket_number"] == int(block_hash, 16) % 100 + 1
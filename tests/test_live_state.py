@@ -0,0 +1,35 @@
+from live_state import BloomFilter, LiveRound
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000)
+    items = [f"0x{i:064x}" for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+
+
+def test_bloom_filter_false_positive_rate_near_target():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f"in-{i}")
+    false_positives = sum(f"out-{i}" in bloom for i in range(10000))
+    # Целевая доля 1%; запас на разброс
+    assert false_positives < 300
+
+
+def test_bloom_filter_clear():
+    bloom = BloomFilter(100)
+    bloom.add("0xabc")
+    bloom.clear()
+    assert "0xabc" not in bloom
+
+
+def test_live_round_answers_maybe_until_txids_loaded():
+    live = LiveRound(txid_capacity=100)
+    # Фильтр ещё не заполнен — проверка должна уйти в базу
+    assert live.might_have_txid("0xabc")
+    live.txids_ready = True
+    assert not live.might_have_txid("0xabc")
+    live.on_txid_used("0xabc")
+    assert live.might_have_txid("0xabc")
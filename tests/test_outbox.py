@@ -0,0 +1,100 @@
+import time
+import asyncio
+from aiogram.utils.exceptions import RetryAfter
+from outbox import Outbox, TokenBucket, BULK
+
+
+class FakeTransport:
+    """Запоминает отправленные запросы; ответы и ошибки задаются заранее"""
+
+    def __init__(self, errors=None):
+        self.calls = []
+        self.errors = list(errors or [])
+
+    async def __call__(self, method, data, files):
+        self.calls.append((time.monotonic(), method, dict(data)))
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"method": method, "text": data.get("text")}
+
+
+def run_with_outbox(scenario, transport, **kwargs):
+    async def main():
+        outbox = Outbox(**kwargs)
+        outbox.transport = transport
+        outbox.start()
+        try:
+            return await scenario(outbox)
+        finally:
+            await outbox.stop()
+    return asyncio.run(main())
+
+
+def test_token_bucket_delay():
+    bucket = TokenBucket(rate=10, capacity=1)
+    now = time.monotonic()
+    assert bucket.delay(now) == 0
+    bucket.take()
+    assert 0.09 < bucket.delay(now) <= 0.1
+
+
+def test_queued_edits_of_one_message_are_coalesced():
+    transport = FakeTransport()
+
+    async def scenario(outbox):
+        # Первое сообщение забирает единственный токен чата, правки ждут в очереди
+        send = asyncio.create_task(outbox.submit("sendMessage", {"chat_id": 1, "text": "🔄"}))
+        await asyncio.sleep(0)
+        edits = [
+            asyncio.create_task(outbox.submit("editMessageText", {"chat_id": 1, "message_id": 5, "text": f"v{i}"}))
+            for i in range(3)
+        ]
+        return await send, await asyncio.gather(*edits)
+
+    _, edit_results = run_with_outbox(scenario, transport, chat_rate=20, chat_burst=1)
+    assert [(method, data["text"]) for _, method, data in transport.calls] == [("sendMessage", "🔄"), ("editMessageText", "v2")]
+    # Все вызывающие получают ответ на последнюю правку
+    assert [r["text"] for r in edit_results] == ["v2", "v2", "v2"]
+
+
+def test_retry_after_pauses_chat_and_resends():
+    transport = FakeTransport(errors=[RetryAfter(0.2)])
+
+    async def scenario(outbox):
+        return await outbox.submit("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    result = run_with_outbox(scenario, transport)
+    assert result["text"] == "hi"
+    assert len(transport.calls) == 2
+    assert transport.calls[1][0] - transport.calls[0][0] >= 0.2
+
+
+def test_channel_post_overtakes_bulk_messages():
+    transport = FakeTransport()
+
+    async def scenario(outbox):
+        # Все запросы встают в очередь раньше, чем проснётся цикл отправки: порядок решают приоритеты
+        first = asyncio.create_task(outbox.submit("sendMessage", {"chat_id": 1, "text": "first"}))
+        await asyncio.sleep(0)
+        bulk = [
+            asyncio.create_task(outbox.submit("sendMessage", {"chat_id": 100 + i, "text": "bulk"}, priority=BULK))
+            for i in range(3)
+        ]
+        channel = asyncio.create_task(outbox.submit("sendMessage", {"chat_id": "@channel", "text": "post"}))
+        await asyncio.gather(first, channel, *bulk)
+
+    run_with_outbox(scenario, transport, channel_id="@channel")
+    assert [data["text"] for _, _, data in transport.calls] == ["first", "post", "bulk", "bulk", "bulk"]
+
+
+def test_other_errors_are_raised_to_caller():
+    transport = FakeTransport(errors=[ValueError("bad request")])
+
+    async def scenario(outbox):
+        try:
+            await outbox.submit("sendMessage", {"chat_id": 1, "text": "hi"})
+        except ValueError as e:
+            return str(e)
+
+    assert run_with_outbox(scenario, transport) == "bad request"
+    assert len(transport.calls) == 1
@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+from bsc_rpc import JsonRpcError
+from payments import (
+    BscVerifier, TronVerifier, USDT_TRC20_CONTRACT, tron_address_to_hex, detect_verifiers, resolve_verifier
+)
+
+BSC_WALLET = "0xFd434c30aCeF2815fE895a2144b11122e31c0B93"
+BARE_HASH = "AB" * 32
+
+
+def test_tron_address_to_hex():
+    # Контракт USDT в TRON: 41a614f8… в hex
+    assert tron_address_to_hex(USDT_TRC20_CONTRACT) == "a614f803b6fd780986a42c78ec9c7f77e6ded13c"
+
+
+def test_tron_address_with_bad_checksum_is_rejected():
+    broken = USDT_TRC20_CONTRACT[:-1] + ("u" if USDT_TRC20_CONTRACT[-1] != "u" else "v")
+    with pytest.raises(ValueError):
+        tron_address_to_hex(broken)
+
+
+def verifiers(bsc_knows=False, tron_knows=False):
+    bsc = BscVerifier(None, None, None, BSC_WALLET)
+    tron = TronVerifier("http://tron.test", USDT_TRC20_CONTRACT)
+
+    def knows(result):
+        async def check(txid):
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return check
+
+    bsc.knows = knows(bsc_knows)
+    tron.knows = knows(tron_knows)
+    return {"bsc": bsc, "tron": tron}
+
+
+def test_bsc_hash_is_normalized_with_prefix_and_lower_case():
+    bsc = verifiers()["bsc"]
+    assert bsc.normalize(" " + BARE_HASH + "\n") == "0x" + BARE_HASH.lower()
+    assert bsc.normalize("0x" + BARE_HASH) == "0x" + BARE_HASH.lower()
+
+
+def test_detect_verifiers_by_format():
+    available = verifiers()
+    assert [v.network for v in detect_verifiers(available, "0x" + BARE_HASH)] == ["bsc"]
+    assert [v.network for v in detect_verifiers(available, BARE_HASH)] == ["bsc", "tron"]
+    assert detect_verifiers(available, "not a hash") == []
+
+
+def test_resolve_verifier_picks_network_that_knows_transaction():
+    available = verifiers(bsc_knows=True)
+    candidates = detect_verifiers(available, BARE_HASH)
+    assert asyncio.run(resolve_verifier(candidates, BARE_HASH)).network == "bsc"
+
+    available = verifiers(tron_knows=True, bsc_knows=JsonRpcError("timeout"))
+    candidates = detect_verifiers(available, BARE_HASH)
+    assert asyncio.run(resolve_verifier(candidates, BARE_HASH)).network == "tron"
+
+
+def test_resolve_verifier_gives_up_when_network_is_unclear():
+    for bsc_knows, tron_knows in [(False, False), (True, True)]:
+        available = verifiers(bsc_knows, tron_knows)
+        candidates = detect_verifiers(available, BARE_HASH)
+        assert asyncio.run(resolve_verifier(candidates, BARE_HASH)) is None
+
+
+def test_single_candidate_needs_no_lookup():
+    available = verifiers(bsc_knows=JsonRpcError("не должно вызываться"))
+    candidates = detect_verifiers(available, "0x" + BARE_HASH)
+    assert asyncio.run(resolve_verifier(candidates, "0x" + BARE_HASH)).network == "bsc"
@@ -0,0 +1,125 @@
+import time
+import asyncio
+import pytest
+from bsc_rpc import JsonRpcError, ProviderError
+from rpc_pool import RpcPool, Provider
+
+
+class FakeClient:
+    """Клиент с заданной задержкой; fail — исключение, которое бросает каждый вызов"""
+
+    def __init__(self, url, result=None, delay=0, fail=None):
+        self.url = url
+        self.result = result
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    async def call(self, method, params=None, timeout=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail is not None:
+            raise self.fail
+        return self.result
+
+    async def batch(self, calls, timeout=None, return_exceptions=False):
+        return [await self.call(method, params) for method, params in calls]
+
+    async def close(self):
+        pass
+
+
+def call_many(pool, count, method="eth_blockNumber"):
+    async def scenario():
+        return await asyncio.gather(*(pool.call(method) for _ in range(count)))
+    return asyncio.run(scenario())
+
+
+def provider(url, **kwargs):
+    rps = kwargs.pop("rps", None)
+    return Provider(FakeClient(url, **kwargs), rps=rps)
+
+
+def test_provider_error_fails_over_to_next_provider():
+    down = provider("http://down.test", fail=ProviderError("timeout"))
+    up = provider("http://up.test", result="0x10")
+    pool = RpcPool([down, up])
+
+    results = call_many(pool, 10)
+    assert results == ["0x10"] * 10
+    assert up.client.calls == 10
+    assert down.failures == down.client.calls
+
+
+def test_json_rpc_error_is_not_retried_elsewhere():
+    providers = [provider(f"http://{name}.test", fail=JsonRpcError("execution reverted")) for name in "ab"]
+    pool = RpcPool(providers)
+
+    # Ответ с ошибкой — это ответ: другой провайдер его не переспрашивает
+    with pytest.raises(JsonRpcError):
+        asyncio.run(pool.call("eth_call"))
+    assert sum(p.client.calls for p in providers) == 1
+    assert all(p.failures == 0 for p in providers)
+
+
+def test_breaker_opens_after_threshold_and_closes_on_success():
+    flaky = provider("http://flaky.test", fail=ProviderError("HTTP 502"))
+    pool = RpcPool([flaky], failure_threshold=3, cooldown=0.05)
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(ProviderError):
+                await pool.call("eth_blockNumber")
+        assert flaky.is_open(time.monotonic())
+        await asyncio.sleep(0.06)
+        # Пробный запрос после cooldown удался — провайдер снова в строю
+        flaky.client.fail = None
+        flaky.client.result = "0x2"
+        assert await pool.call("eth_blockNumber") == "0x2"
+
+    asyncio.run(scenario())
+    assert flaky.failures == 0
+    assert not flaky.is_open(time.monotonic())
+
+
+def test_open_provider_is_skipped():
+    broken = provider("http://broken.test", result="0x1")
+    healthy = provider("http://healthy.test", result="0x2")
+    pool = RpcPool([broken, healthy], failure_threshold=2, cooldown=60)
+    for _ in range(2):
+        pool._record(broken, 0.1, error=ProviderError("timeout"))
+
+    results = call_many(pool, 20)
+    assert results == ["0x2"] * 20
+    assert broken.client.calls == 0
+
+
+def test_hedged_request_takes_first_answer():
+    slow = provider("http://slow.test", result="slow", delay=1)
+    fast = provider("http://fast.test", result="fast", delay=0.01)
+    pool = RpcPool([slow, fast], hedge_delay=0.05, hedged_methods=("eth_getBlockByNumber",))
+
+    async def scenario():
+        started = time.perf_counter()
+        result = await pool.call("eth_getBlockByNumber", ["latest", False])
+        return result, time.perf_counter() - started
+
+    for _ in range(5):
+        result, elapsed = asyncio.run(scenario())
+        assert result == "fast"
+        assert elapsed < 0.5
+
+
+def test_budget_limits_requests_per_second():
+    limited = provider("http://limited.test", result="0x1", rps=5)
+    pool = RpcPool([limited])
+
+    async def scenario():
+        started = time.perf_counter()
+        for _ in range(7):
+            await pool.call("eth_blockNumber")
+        return time.perf_counter() - started
+
+    # Пять запросов уходят сразу, ещё два ждут токенов по 0,2 с
+    assert asyncio.run(scenario()) >= 0.35
+    assert limited.client.calls == 7
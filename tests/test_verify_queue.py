@@ -0,0 +1,179 @@
+import asyncio
+from verify_queue import VerificationQueue, VerificationJob, RetryLater, ShutdownInterrupted
+
+
+def make_queue(check, done, errors=None, blocks=None, **kwargs):
+    async def on_done(job, success, msg):
+        done.append((job.txid, success, msg, [f[1] for f in job.followers]))
+
+    async def on_error(job, exc):
+        errors.append((job.txid, type(exc).__name__))
+
+    async def wait_blocks(job, count):
+        if blocks is not None:
+            blocks.append(count)
+
+    return VerificationQueue(check, on_done, wait_blocks, on_error, workers=2, **kwargs)
+
+
+def job(txid="0xabc", message_id=1):
+    return VerificationJob(txid, chat_id=10, user_id=20, username="alice", message_id=message_id)
+
+
+async def wait_for(condition, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("условие не выполнилось")
+
+
+def test_retries_while_not_found_with_growing_block_wait():
+    attempts = []
+    done, blocks = [], []
+
+    async def check(j):
+        attempts.append(j.attempt)
+        if len(attempts) < 4:
+            raise RetryLater("Транзакция не найдена")
+        return True, "OK"
+
+    async def scenario():
+        queue = make_queue(check, done, blocks=blocks)
+        queue.start()
+        assert queue.submit(job())
+        await wait_for(lambda: done)
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert attempts == [0, 1, 2, 3]
+    assert blocks == [1, 2, 4]
+    assert done == [("0xabc", True, "OK", [])]
+
+
+def test_not_found_after_max_wait_is_cached_as_expired():
+    done = []
+
+    async def check(j):
+        raise RetryLater("Транзакция не найдена")
+
+    async def scenario():
+        queue = make_queue(check, done, max_wait=0, not_found_ttl=60)
+        queue.start()
+        queue.submit(job())
+        await wait_for(lambda: done)
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert done == [("0xabc", False, "Транзакция не найдена", [])]
+    assert queue.cached_rejection("0xabc") == ("Транзакция не найдена", True)
+    assert not queue.is_pending("0xabc")
+
+
+def test_rejection_cache_expires_after_ttl():
+    done = []
+
+    async def check(j):
+        return False, "Недостаточно средств"
+
+    async def scenario():
+        queue = make_queue(check, done, invalid_ttl=0)
+        queue.start()
+        queue.submit(job())
+        await wait_for(lambda: done)
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.cached_rejection("0xabc") is None
+
+
+def test_join_attaches_to_running_check():
+    done = []
+    release = None
+
+    async def check(j):
+        await release.wait()
+        return True, "OK"
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        queue = make_queue(check, done)
+        queue.start()
+        queue.submit(job())
+        assert queue.is_pending("0xabc")
+        assert queue.join("0xabc", chat_id=11, message_id=2, user_id=21)
+        release.set()
+        await wait_for(lambda: done)
+        # Проверка закончилась — присоединяться не к чему
+        assert not queue.join("0xabc", chat_id=12, message_id=3, user_id=22)
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert done == [("0xabc", True, "OK", [2])]
+
+
+def test_submit_fails_when_queue_is_full():
+    async def check(j):
+        await asyncio.sleep(10)
+
+    async def scenario():
+        queue = VerificationQueue(check, None, None, None, workers=0, maxsize=1)
+        queue.start()
+        assert queue.submit(job("0x1"))
+        assert not queue.submit(job("0x2"))
+        assert not queue.is_pending("0x2")
+
+    asyncio.run(scenario())
+
+
+def test_unexpected_error_is_reported_and_job_dropped():
+    done, errors = [], []
+
+    async def check(j):
+        raise ConnectionError("connection was closed")
+
+    async def scenario():
+        queue = make_queue(check, done, errors)
+        queue.start()
+        queue.submit(job())
+        await wait_for(lambda: errors)
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert errors == [("0xabc", "ConnectionError")]
+    assert done == []
+    assert not queue.is_pending("0xabc")
+
+
+def test_stop_reports_unfinished_jobs():
+    done, errors = [], []
+
+    async def check(j):
+        raise RetryLater("Транзакция не найдена")
+
+    async def wait_blocks(j, count):
+        await asyncio.sleep(10)
+
+    async def on_done(j, success, msg):
+        done.append(j.txid)
+
+    async def on_error(j, exc):
+        errors.append((j.txid, type(exc)))
+
+    async def scenario():
+        queue = VerificationQueue(check, on_done, wait_blocks, on_error, workers=1)
+        queue.start()
+        queue.submit(job("0x1"))
+        queue.submit(job("0x2"))
+        await wait_for(lambda: queue.pending_count == 2 and not queue._queue.qsize())
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert sorted(errors) == [("0x1", ShutdownInterrupted), ("0x2", ShutdownInterrupted)]
+    assert done == []
+    assert queue.pending_count == 0
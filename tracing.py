@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import logging
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# Лёгкая трассировка: на каждый апдейт (и на каждую проверку TXID) открывается корневой
+# span, запросы к БД, вызовы RPC и отправки в Telegram добавляют в него дочерние.
+# Если апдейт обрабатывался дольше SLOW_TRACE_MS, дерево span'ов с длительностями
+# пишется в лог slow_updates и сохраняется в памяти для команды /slow.
+# Вне корневого span'а span() ничего не делает, так что фоновые задачи ничего не платят.
+
+SLOW_TRACE_MS = float(os.getenv("SLOW_TRACE_MS", 1000))
+
+slow_log = logging.getLogger("slow_updates")
+slow_traces = deque(maxlen=20)
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "start", "end", "children", "error")
+
+    def __init__(self, name, start=None):
+        self.name = name
+        self.start = start if start is not None else time.perf_counter()
+        self.end = None
+        self.children = []
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def render(self, root_start=None, depth=0):
+        """Дерево span'ов: смещение от начала, длительность, имя"""
+        root_start = self.start if root_start is None else root_start
+        line = f"{'  ' * depth}+{(self.start - root_start) * 1000:7.1f} ms {self.duration * 1000:8.1f} ms  {self.name}"
+        if self.error:
+            line += f"  ❌ {self.error}"
+        lines = [line]
+        for child in sorted(self.children, key=lambda s: s.start):
+            lines.append(child.render(root_start, depth + 1))
+        return "\n".join(lines)
+
+
+@contextmanager
+def trace(name):
+    """Корневой span; по завершении медленный трейс уходит в slow log"""
+    root = Span(name)
+    token = _current.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = type(e).__name__
+        raise
+    finally:
+        root.end = time.perf_counter()
+        _current.reset(token)
+        if root.duration * 1000 >= SLOW_TRACE_MS:
+            text = root.render()
+            slow_traces.append(text)
+            slow_log.warning(f"🐢 Медленная обработка:\n{text}")
+
+
+@contextmanager
+def span(name):
+    """Дочерний span текущего трейса (без трейса — ничего не делает)"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name)
+    parent.children.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        child.end = time.perf_counter()
+        _current.reset(token)
+
+
+def record(name, elapsed, error=None):
+    """Добавляет уже завершившийся span (например, из логгера запросов asyncpg)"""
+    parent = _current.get()
+    if parent is None:
+        return
+    end = time.perf_counter()
+    child = Span(name, start=end - elapsed)
+    child.end = end
+    child.error = error
+    parent.children.append(child)
+
+
+# === СЭМПЛИРУЮЩИЙ ПРОФАЙЛЕР ===
+# Чаще сэмплировать нельзя: поток профайлера перестаёт отдавать GIL и тормозит event loop
+MIN_PROFILE_INTERVAL = 0.001
+
+
+class SamplingProfiler:
+    """Раз в interval секунд снимает стек главного потока из отдельного потока.
+
+    Накладные расходы не зависят от числа вызовов, поэтому профайлер можно включать
+    на живом процессе. Итог — функции, чаще всего оказывавшиеся на вершине стека
+    (собственное время) и где-либо в стеке (суммарное время).
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._own = Counter()
+        self._total = Counter()
+        self.samples = 0
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.interval = max(self.interval, MIN_PROFILE_INTERVAL)
+        self._own.clear()
+        self._total.clear()
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        target = threading.get_ident()
+        self._thread = threading.Thread(target=self._sample, args=(target,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _sample(self, target):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                continue
+            self.samples += 1
+            self._own[self._label(frame)] += 1
+            seen = set()
+            while frame is not None:
+                label = self._label(frame)
+                if label not in seen:
+                    seen.add(label)
+                    self._total[label] += 1
+                frame = frame.f_back
+
+    @staticmethod
+    def _label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def report(self, top=15):
+        if not self.samples:
+            return "Нет сэмплов"
+        elapsed = time.monotonic() - self.started_at
+        lines = [f"Сэмплов: {self.samples} за {elapsed:.0f} с (каждые {self.interval * 1000:.0f} мс)", "", "Собственное время:"]
+        for label, count in self._own.most_common(top):
+            lines.append(f"{count / self.samples * 100:5.1f}%  {label}")
+        lines += ["", "Суммарное время:"]
+        for label, count in self._total.most_common(top):
+            lines.append(f"{count / self.samples * 100:5.1f}%  {label}")
+        return "\n".join(lines)
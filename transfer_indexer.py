@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import database
+from bsc_rpc import JsonRpcError
+
+# Локальный индекс входящих переводов USDT на кошелёк бота.
+#
+# Фоновая задача забирает логи Transfer контракта USDT с topic «to» = кошелёк бота
+# через eth_getLogs большими диапазонами блоков и складывает их в incoming_transfers.
+# Последний обработанный блок хранится в indexer_checkpoints и пишется в той же
+# транзакции, что и переводы, поэтому после перезапуска индексация продолжается
+# ровно с того же места. Индексируются только блоки с нужным числом подтверждений.
+#
+# Проверка TXID сначала смотрит в индекс (один запрос по первичному ключу) и только
+# при промахе идёт в RPC — например, если индексер ещё не дошёл до блока транзакции.
+
+USDT_CONTRACT = "0x55d398326f99059ff775485246999027b3197955"
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+USDT_DECIMALS = 18
+
+SQL_LOOKUP = """
+    SELECT amount FROM incoming_transfers
+    WHERE tx_hash = $1
+    ORDER BY log_index
+    LIMIT 1
+"""
+
+SQL_INSERT_TRANSFERS = """
+    INSERT INTO incoming_transfers (tx_hash, log_index, block_number, from_address, amount)
+    SELECT * FROM unnest($1::text[], $2::int[], $3::bigint[], $4::text[], $5::numeric[])
+    ON CONFLICT (tx_hash, log_index) DO NOTHING
+"""
+
+
+class TransferIndexer:
+    def __init__(self, rpc, block_follower, wallet_address, name="usdt_bsc",
+                 confirmations=1, batch_blocks=5000, backfill_blocks=20000, start_block=None, poll_interval=3):
+        self._rpc = rpc
+        self._follower = block_follower
+        self.wallet_topic = "0x" + "0" * 24 + wallet_address.lower()[2:]
+        self.name = name
+        self.confirmations = max(1, confirmations)
+        self.batch_blocks = batch_blocks
+        self.backfill_blocks = backfill_blocks
+        self.start_block = start_block
+        self.poll_interval = poll_interval
+        self.last_block = None
+        self._task = None
+
+    def start(self):
+        # Пока индексер стоял, индексировать мог другой процесс — продолжаем с записанного места
+        self.last_block = None
+        self._task = asyncio.create_task(self._run())
+        logging.info("✅ Индексер входящих переводов USDT запущен")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def lookup(self, txid):
+        """Сумма перевода на кошелёк в минимальных единицах USDT по TXID или None, если перевода нет в индексе"""
+        amount = await database.fetchval(SQL_LOOKUP, txid.lower())
+        return None if amount is None else int(amount)
+
+    async def _load_checkpoint(self):
+        last_block = await database.fetchval(
+            "SELECT last_block FROM indexer_checkpoints WHERE name = $1", self.name
+        )
+        if last_block is not None:
+            return last_block
+        if self.start_block is not None:
+            return self.start_block - 1
+        # Первый запуск — начинаем с недавнего прошлого, а не с генезиса
+        head = await self._follower.wait_for_head()
+        return max(0, head - self.backfill_blocks)
+
+    async def _fetch_logs(self, from_block, to_block):
+        return await self._rpc.call("eth_getLogs", [{
+            "fromBlock": hex(from_block),
+            "toBlock": hex(to_block),
+            "address": USDT_CONTRACT,
+            "topics": [TRANSFER_TOPIC, None, self.wallet_topic],
+        }], timeout=30)
+
+    async def _index_range(self, from_block, to_block):
+        logs = await self._fetch_logs(from_block, to_block)
+        rows = [
+            (log["transactionHash"].lower(), int(log["logIndex"], 16), int(log["blockNumber"], 16),
+             "0x" + log["topics"][1][-40:], int(log["data"], 16))
+            for log in logs
+            if not log.get("removed")
+        ]
+        async with database.transaction() as conn:
+            if rows:
+                await conn.execute(SQL_INSERT_TRANSFERS, *map(list, zip(*rows)))
+            await conn.execute("""
+                INSERT INTO indexer_checkpoints (name, last_block) VALUES ($1, $2)
+                ON CONFLICT (name) DO UPDATE SET last_block = EXCLUDED.last_block, updated_at = CURRENT_TIMESTAMP
+            """, self.name, to_block)
+        self.last_block = to_block
+        return len(rows)
+
+    async def _step(self):
+        """Индексирует следующий диапазон. Возвращает True, если есть ещё работа"""
+        head = await self._follower.wait_for_head()
+        safe_head = head - self.confirmations + 1
+        from_block = self.last_block + 1
+        if from_block > safe_head:
+            return False
+
+        to_block = min(from_block + self.batch_blocks - 1, safe_head)
+        try:
+            found = await self._index_range(from_block, to_block)
+        except JsonRpcError as e:
+            if self.batch_blocks > 1 and ("limit" in str(e).lower() or "range" in str(e).lower() or "timeout" in str(e).lower()):
+                # Провайдер не тянет такой диапазон — уменьшаем окно и больше его не превышаем
+                self.batch_blocks = max(1, self.batch_blocks // 2)
+                logging.warning(f"⚠️ eth_getLogs: уменьшаю окно до {self.batch_blocks} блоков ({e})")
+                return True
+            raise
+        if found:
+            logging.info(f"✅ Проиндексировано переводов: {found} (блоки {from_block}–{to_block})")
+        return to_block < safe_head
+
+    async def _run(self):
+        delay = self.poll_interval
+        while True:
+            try:
+                if self.last_block is None:
+                    self.last_block = await self._load_checkpoint()
+                more = await self._step()
+                delay = self.poll_interval
+                if more:
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Любая ошибка (RPC, разрыв с БД при её перезапуске) — повтор с паузой, а не конец задачи
+                logging.error(f"❌ Ошибка индексации переводов: {type(e).__name__}: {e}")
+                delay = min(delay * 2, 60)
+            await asyncio.sleep(delay)
@@ -0,0 +1,135 @@
+import time
+import asyncio
+import logging
+import tracing
+from collections import deque, OrderedDict
+from aiogram import Bot, Dispatcher, types
+
+# Приём апдейтов вебхука без ожидания обработчиков.
+#
+# Вебхук кладёт апдейт в очередь и сразу отвечает Telegram 200 OK; обработку ведёт
+# фиксированный пул воркеров. Апдейты одного чата обрабатываются строго по порядку
+# (в каждый момент чат занят не больше чем одним воркером), разные чаты — параллельно.
+# Повторная доставка того же update_id отбрасывается. Если очередь заполнена,
+# вебхук отвечает 503 — Telegram доставит апдейт позже, это и есть backpressure.
+
+
+def chat_key(update):
+    """Ключ упорядочивания: чат апдейта, иначе пользователь, иначе сам апдейт"""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        obj = update.get(field)
+        if obj:
+            return obj["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback:
+        if callback.get("message"):
+            return callback["message"]["chat"]["id"]
+        return callback["from"]["id"]
+    for obj in update.values():
+        if isinstance(obj, dict) and "from" in obj:
+            return obj["from"]["id"]
+    return ("update", update.get("update_id"))
+
+
+class UpdateQueue:
+    def __init__(self, dp, workers=16, maxsize=1000, dedup_size=10000):
+        self.dp = dp
+        self.workers = workers
+        self.maxsize = maxsize
+        self._chats = {}
+        self._ready = asyncio.Queue()
+        self._size = 0
+        self._seen = OrderedDict()
+        self._dedup_size = dedup_size
+        self._tasks = []
+        # Метрики
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.failed = 0
+        self.processed = 0
+        self.max_depth = 0
+        self._wait_times = deque(maxlen=1000)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"✅ Очередь апдейтов запущена ({self.workers} воркеров)")
+
+    async def stop(self, drain_timeout=10):
+        """Доделывает принятые апдейты (не дольше drain_timeout) и останавливает воркеров"""
+        deadline = time.monotonic() + drain_timeout
+        while self._size and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, update):
+        """Принимает апдейт в очередь. False — очередь полна, апдейт нужно отклонить"""
+        update_id = update.get("update_id")
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        if self._size >= self.maxsize:
+            self.rejected += 1
+            return False
+
+        self._seen[update_id] = None
+        if len(self._seen) > self._dedup_size:
+            self._seen.popitem(last=False)
+
+        key = chat_key(update)
+        pending = self._chats.get(key)
+        if pending is None:
+            # Чат свободен — ставим его в очередь на обработку
+            pending = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        pending.append((time.monotonic(), update))
+        self._size += 1
+        self.accepted += 1
+        self.max_depth = max(self.max_depth, self._size)
+        return True
+
+    @property
+    def depth(self):
+        return self._size
+
+    def metrics(self):
+        waits = sorted(self._wait_times)
+        return {
+            "depth": self._size,
+            "max_depth": self.max_depth,
+            "busy_chats": len(self._chats),
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "wait_p50": waits[len(waits) // 2] if waits else 0,
+            "wait_max": waits[-1] if waits else 0,
+        }
+
+    async def _worker(self):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            # Чат остаётся за этим воркером, пока у него есть апдейты
+            while pending:
+                queued_at, update = pending.popleft()
+                self._wait_times.append(time.monotonic() - queued_at)
+                try:
+                    kind = next((k for k in update if k != "update_id"), "?")
+                    with tracing.trace(f"update {update.get('update_id')} {kind} chat {key}"):
+                        await self.dp.process_update(types.Update.to_object(update))
+                    self.processed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.failed += 1
+                    logging.exception(f"❌ Ошибка обработки апдейта {update.get('update_id')}")
+                finally:
+                    self._size -= 1
+            del self._chats[key]
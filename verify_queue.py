@@ -0,0 +1,194 @@
+import time
+import asyncio
+import logging
+import tracing
+from collections import OrderedDict
+
+
+class RetryLater(Exception):
+    """Транзакция пока не может быть проверена — повторить позже"""
+
+
+class ShutdownInterrupted(Exception):
+    """Проверка не закончена, потому что процесс останавливается"""
+
+
+class VerificationJob:
+    """Задание на проверку одного TXID"""
+
+    def __init__(self, txid, chat_id, user_id, username, message_id, network="bsc"):
+        self.txid = txid
+        self.network = network
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.username = username
+        self.message_id = message_id
+        self.attempt = 0
+        self.created_at = time.monotonic()
+        # Транзакция так и не нашлась в сети за отведённое время
+        self.expired = False
+        # Повторные отправки того же TXID: (chat_id, message_id, user_id) сообщений, ждущих результат
+        self.followers = []
+
+
+class VerificationQueue:
+    """Очередь проверки TXID: ограниченный пул воркеров и повторы по мере выхода блоков.
+
+    check(job) — корутина, возвращает (success, msg) или бросает RetryLater.
+    on_done(job, success, msg) — корутина, вызывается с итоговым результатом.
+    wait_blocks(job, count) — корутина, ждёт count новых блоков в сети задания.
+    on_error(job, exc) — корутина, вызывается, если проверка или on_done упали с
+    неожиданной ошибкой: пользователь должен узнать, что проверка не закончилась.
+    Задания живут только в памяти процесса, поэтому stop() вызывает on_error и для
+    всех незаконченных заданий — с ошибкой ShutdownInterrupted.
+
+    Пока транзакция не найдена, повтор назначается через 1, 2, 4, … блоков (не больше
+    max_retry_blocks), пока с первой попытки не пройдёт max_wait секунд. Отказ
+    запоминается на время: «не найдена» — на not_found_ttl, «недействительна» — на
+    invalid_ttl, и повторная отправка того же TXID в это время не идёт в сеть.
+    Повторная отправка TXID, который ещё проверяется, присоединяется к текущей проверке.
+    """
+
+    def __init__(self, check, on_done, wait_blocks, on_error, workers=8, max_wait=600, max_retry_blocks=64,
+                 not_found_ttl=60, invalid_ttl=600, cache_size=10000, maxsize=1000, stop_timeout=10):
+        self._check = check
+        self._on_done = on_done
+        self._wait_blocks = wait_blocks
+        self._on_error = on_error
+        self._workers_count = workers
+        self.max_wait = max_wait
+        self.max_retry_blocks = max_retry_blocks
+        self.not_found_ttl = not_found_ttl
+        self.invalid_ttl = invalid_ttl
+        self._cache_size = cache_size
+        self._maxsize = maxsize
+        self.stop_timeout = stop_timeout
+        self._queue = None
+        self._workers = []
+        self._waiting = set()
+        self._jobs = {}
+        self._rejected = OrderedDict()
+
+    def start(self):
+        self._queue = asyncio.Queue(self._maxsize)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._workers_count)]
+        logging.info(f"✅ Очередь проверки TXID запущена ({self._workers_count} воркеров)")
+
+    async def stop(self):
+        for task in self._waiting:
+            task.cancel()
+        await asyncio.gather(*self._waiting, return_exceptions=True)
+        self._waiting.clear()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        # Незаконченные проверки после перезапуска никто не продолжит — сообщаем пользователям
+        jobs = list(self._jobs.values())
+        self._jobs.clear()
+        if jobs:
+            logging.warning(f"⚠️ Остановка: {len(jobs)} TXID не проверены до конца")
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(self._notify_error(job, ShutdownInterrupted()) for job in jobs)),
+                    self.stop_timeout
+                )
+            except asyncio.TimeoutError:
+                logging.error(f"❌ Не все сообщения о прерванных проверках обновлены за {self.stop_timeout} с")
+
+    @property
+    def pending_count(self):
+        return len(self._jobs)
+
+    def is_pending(self, txid):
+        return txid in self._jobs
+
+    def cached_rejection(self, txid):
+        """(msg, expired) недавнего отказа по этому TXID или None"""
+        entry = self._rejected.get(txid)
+        if entry is None:
+            return None
+        expires_at, msg, expired = entry
+        if expires_at <= time.monotonic():
+            del self._rejected[txid]
+            return None
+        return msg, expired
+
+    def join(self, txid, chat_id, message_id, user_id):
+        """Присоединяет сообщение к идущей проверке TXID. False — проверка уже закончилась"""
+        job = self._jobs.get(txid)
+        if job is None:
+            return False
+        job.followers.append((chat_id, message_id, user_id))
+        return True
+
+    def submit(self, job):
+        """Ставит задание в очередь. Возвращает False, если очередь переполнена"""
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return False
+        self._jobs[job.txid] = job
+        return True
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                with tracing.trace(f"verify {job.txid[:12]}… попытка {job.attempt + 1}"):
+                    await self._run(job)
+            except Exception as e:
+                logging.error(f"❌ Ошибка проверки TXID {job.txid}: {type(e).__name__}: {e}")
+                self._jobs.pop(job.txid, None)
+                await self._notify_error(job, e)
+            finally:
+                self._queue.task_done()
+
+    async def _notify_error(self, job, error):
+        try:
+            await self._on_error(job, error)
+        except Exception as notify_error:
+            logging.error(f"❌ Не удалось сообщить об ошибке проверки TXID {job.txid}: {notify_error}")
+
+    async def _run(self, job):
+        try:
+            success, msg = await self._check(job)
+        except RetryLater as e:
+            if time.monotonic() - job.created_at < self.max_wait:
+                blocks = min(2 ** job.attempt, self.max_retry_blocks)
+                job.attempt += 1
+                self._schedule(job, blocks)
+                return
+            job.expired = True
+            success, msg = False, str(e)
+
+        self._jobs.pop(job.txid, None)
+        if not success:
+            self._remember_rejection(job, msg)
+        await self._on_done(job, success, msg)
+
+    def _remember_rejection(self, job, msg):
+        ttl = self.not_found_ttl if job.expired else self.invalid_ttl
+        self._rejected[job.txid] = (time.monotonic() + ttl, msg, job.expired)
+        self._rejected.move_to_end(job.txid)
+        while len(self._rejected) > self._cache_size:
+            self._rejected.popitem(last=False)
+
+    def _schedule(self, job, blocks):
+        task = asyncio.create_task(self._retry_after(job, blocks))
+        self._waiting.add(task)
+        task.add_done_callback(self._waiting.discard)
+
+    async def _retry_after(self, job, blocks):
+        try:
+            await self._wait_blocks(job, blocks)
+        except Exception as e:
+            logging.warning(f"⚠️ Не дождались блоков для повтора {job.txid}: {e}")
+        while True:
+            try:
+                self._queue.put_nowait(job)
+                return
+            except asyncio.QueueFull:
+                # Очередь забита — откладываем повтор ещё немного
+                await asyncio.sleep(1)